@@ -1,5 +1,5 @@
-from flask import Flask, render_template, request, Response, redirect, url_for
-from markupsafe import escape
+from flask import Flask, render_template, request, Response, redirect, url_for, g
+from markupsafe import escape, Markup
 import random
 import datetime
 import time
@@ -9,18 +9,395 @@ import collections
 import queue
 import secrets
 import json
+import asyncio
+import os
+import hashlib
+import math
+
+from append_log import AppendLog
+from chat_store import ChatMessage, MemoryChatStore, create_store
+from compression import StreamCompressor, negotiate
+from limits import AdmissionGate, RateLimiter
+from metrics import Counter, Gauge, Histogram, WAIT_BUCKETS, counter, gauge, render
+from room import Room
+from spam import SpamFilter
+from tracing import MessageTracer
 
 app = Flask(__name__)
 MAX_MESSAGE_LENGTH = 999  # Limit message length to 999 characters
+PENDING_TIMEOUT = 300  # Drop users who waited more than 5 minutes for a partner
+MAX_HISTORY = int(os.environ.get('CHAT_HISTORY_LIMIT', 200))  # Messages kept per conversation
+CHATTER_COUNT_INTERVAL = 3  # Seconds between recounts of unique chatters
+SEARCH_ANIMATION_PERIOD = 3  # Seconds between "Searching for a random..." frames
+SESSION_TIMEOUT = 600  # Forget clients after 10 minutes without activity
+SESSION_LOCK_STRIPES = 256  # Locks shared out among all clients by hash
+CLEANUP_INTERVAL = 5  # Seconds between expiry runs
+CLEANUP_BATCH = 1000  # Sessions claimed from the store per expiry query
+MAX_QUEUED_UPDATES = 256  # Updates a stream may fall behind by before its reader counts as stalled
+STALL_TIMEOUT = 30  # Seconds an update may wait unsent before its reader counts as stalled
+TRANSIENT_EVENTS = frozenset({'search'})  # Stream events that a newer one makes obsolete
+EVENTS_KEEPALIVE_INTERVAL = 15  # Seconds between keepalives on /rchat/events
+POLL_TIMEOUT = 25  # Seconds /rchat/poll waits for an event before answering with none
+ROOM_HISTORY = int(os.environ.get('ROOM_HISTORY', 200))  # Messages the public room keeps for new readers
+ROOM_KEEPALIVE_INTERVAL = 15  # Seconds between keepalives on an idle /chat stream
+MAX_NAME_LENGTH = 20  # Longest name in the public room
+COMPRESS_STREAMS = os.environ.get('COMPRESS_STREAMS', '1') != '0'  # gzip/deflate chat streams when accepted
+LIMIT_BY_IP = os.environ.get('RATE_LIMIT_BY_IP', '1') != '0'  # Off behind Tor or a proxy (one shared address)
+MAX_STREAMS = int(os.environ.get('MAX_STREAMS', 5000))  # Open streams per process; past that new ones get a 503
+NEW_SESSION_RATE = float(os.environ.get('NEW_SESSION_RATE', 20))  # New chat sessions per second per process, all clients together
+TRACE_MESSAGES = float(os.environ.get('TRACE_MESSAGES', 0))  # Fraction of messages traced, see tracing.py
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # Bearer token for the metrics routes, see operator_only
+
+# Shared chat state (tokens, waiting list, pairs, history); see chat_store.py
+store = create_store(os.environ.get('CHAT_STORE_URL'), max_wait=PENDING_TIMEOUT, max_history=MAX_HISTORY)
+
+# Per-process data structures
+active_connections = {}  # Track active streaming connections, guarded by session_locks
+feedback_log = AppendLog('feedback.txt')  # /contact/ messages, appended in batches
+spam_filter = SpamFilter()  # Ghost messages and flood lockdown of the 1:1 chats, see spam.py
+room_spam_filter = SpamFilter()  # The same for the public room, so a flood there doesn't lock the chats down
+public_room = Room(ROOM_HISTORY)  # The "All" group chat of /chat, see room.py
+# Rate limits as (per second, burst); see limits.py. The IP limit is checked
+# before any session work, the client limit once the session's token checks
+# out, so a made-up ``h`` gets no bucket of its own.
+stream_limits = (RateLimiter(2, 20), RateLimiter(0.5, 5))  # /rchat loads per IP, per client
+send_limits = (RateLimiter(20, 60), RateLimiter(2, 10))  # /rchat/send posts per IP, per client
+poll_limits = (RateLimiter(10, 60), RateLimiter(2, 10))  # /rchat/poll requests per IP, per client
+session_limit = RateLimiter(NEW_SESSION_RATE, NEW_SESSION_RATE * 10)  # /rchat loads that start a session, one shared key
+stream_gate = AdmissionGate(MAX_STREAMS)
+
+# Metrics of this process, served at /metrics
+TIMED_ROUTES = ('/rchat', '/rchat/send', '/rchat/input', '/rchat/events')
+match_wait = Histogram('rchat_match_wait_seconds', 'How long matched users waited for a partner.', WAIT_BUCKETS)
+delivery_latency = Histogram('rchat_delivery_seconds', 'Time from queueing a stream update to sending it.')
+request_latency = Histogram('rchat_request_seconds',
+                            'Time to handle chat requests; for /rchat, until the stream starts.', label='route')
+open_streams = Gauge('rchat_open_streams', 'Chat streams open in this process.')
+stalled_evictions = Counter('rchat_stalled_streams_evicted_total',
+                            'Sessions evicted because their stream stopped reading.')
+compressed_raw_bytes = Counter('rchat_compressed_stream_raw_bytes_total',
+                               'Bytes written to compressed streams, before compression.')
+compressed_sent_bytes = Counter('rchat_compressed_stream_sent_bytes_total',
+                                'Bytes written to compressed streams, after compression.')
+replayed_events = Counter('rchat_replayed_events_total',
+                          'Missed events sent to clients resuming from a cursor.')
+# Stage timings of sampled messages, also served at /metrics/traces
+tracer = MessageTracer(TRACE_MESSAGES, path=os.environ.get('TRACE_FILE'))
+store.set_match_observer(match_wait.observe)
+
+class UpdateQueue:
+    """Thread-safe, bounded FIFO of pending stream updates.
+
+    Works like ``queue.Queue`` for the threaded WSGI streams, and can also
+    wake coroutines on an asyncio event loop (see ``asgi.py``) so that an
+    idle chat stream costs no thread while it waits.
+
+    A reader that stops reading (a slow Tor circuit, a throttled tab)
+    leaves updates piling up. Transient updates, events whose type is in
+    ``transient``, are superseded by the next one and dropped first. If
+    ``max_items`` updates are still waiting, or the oldest has waited
+    ``max_age`` seconds, the queue is marked stalled: it is emptied and
+    refuses further updates, and the caller should evict the reader.
+    """
+
+    def __init__(self, max_items=MAX_QUEUED_UPDATES, max_age=STALL_TIMEOUT, transient=TRANSIENT_EVENTS):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.transient = transient
+        self.stalled = False
+        self._items = collections.deque()  # (queued at, update)
+        self._cond = threading.Condition(threading.Lock())
+        self._async_waiters = []
+
+    def put(self, item):
+        """Queue an update; returns False if the reader has stalled."""
+        now = time.monotonic()
+        with self._cond:
+            if self.stalled:
+                return False
+            if item['type'] in self.transient:
+                self._drop_transient()
+            items = self._items
+            if len(items) >= self.max_items or (items and now - items[0][0] >= self.max_age):
+                self._drop_transient()
+                if len(items) >= self.max_items or (items and now - items[0][0] >= self.max_age):
+                    self.stalled = True
+                    items.clear()
+                    return False
+            items.append((now, item))
+            self._cond.notify()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve_waiter, future)
+        return True
+
+    def _drop_transient(self):
+        if self.transient and self._items:
+            kept = [entry for entry in self._items if entry[1]['type'] not in self.transient]
+            if len(kept) < len(self._items):
+                self._items = collections.deque(kept)
+
+    def get_nowait(self):
+        with self._cond:
+            if not self._items:
+                raise queue.Empty
+            return self._items.popleft()[1]
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items, timeout):
+                raise queue.Empty
+            return self._items.popleft()[1]
+
+    def wait(self, timeout=None):
+        """Block until an update is queued; returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._items, timeout)
+
+    def drain(self, observe=None):
+        """Remove and return every queued update, oldest first.
+
+        ``observe(seconds)`` is called with how long each update waited.
+        """
+        with self._cond:
+            items = list(self._items)
+            self._items.clear()
+        if observe is not None:
+            now = time.monotonic()
+            for queued_at, _ in items:
+                observe(now - queued_at)
+        return [item for _, item in items]
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    async def wait_async(self, timeout):
+        """Wait on the running event loop until an update is queued.
+
+        Returns True if an update is available, False on timeout.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self._items:
+                return True
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._async_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                if waiter in self._async_waiters:
+                    self._async_waiters.remove(waiter)
+        return bool(self._items)
+
+def _resolve_waiter(future):
+    if not future.done():
+        future.set_result(None)
+
+class SlidingUniqueCounter:
+    """Approximate number of distinct keys seen in a sliding time window.
+
+    The window is split into one-minute buckets, each holding a HyperLogLog
+    sketch (4 KiB at the default precision, about 1.6% standard error).
+    Adding a key touches a single register, and memory stays bounded no
+    matter how many requests or distinct IPs arrive. The sketches of the
+    full buckets are merged once per minute; a count then only has to fold
+    in the current bucket.
+    """
+
+    def __init__(self, window=3600, bucket_seconds=60, precision=12):
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = window // bucket_seconds
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self._alpha = 0.7213 / (1 + 1.079 / self.num_registers)
+        self._powers = [2.0 ** -rank for rank in range(65)]
+        self._buckets = collections.deque()  # [(bucket_number, registers)], oldest first
+        self._merged = None  # Union of every bucket but the newest
+        self._lock = threading.Lock()
+
+    def add(self, key, now=None):
+        """Record one sighting of ``key``."""
+        bucket = int((time.time() if now is None else now) // self.bucket_seconds)
+        digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, 'big')
+        index = value >> (64 - self.precision)
+        remainder = value & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - remainder.bit_length() + 1
+        with self._lock:
+            registers = self._current(bucket)
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self, now=None):
+        """Estimate the number of distinct keys in the window."""
+        bucket = int((time.time() if now is None else now) // self.bucket_seconds)
+        with self._lock:
+            self._expire(bucket)
+            if not self._buckets:
+                return 0
+            if self._merged is None:
+                self._merged = bytearray(self.num_registers)
+                for _, registers in list(self._buckets)[:-1]:
+                    self._merged = bytearray(map(max, self._merged, registers))
+            registers = bytes(map(max, self._merged, self._buckets[-1][1]))
+
+        powers = self._powers
+        estimate = self._alpha * self.num_registers ** 2 / sum(powers[rank] for rank in registers)
+        zeros = registers.count(0)
+        if estimate <= 2.5 * self.num_registers and zeros:
+            # Small-range correction (linear counting)
+            estimate = self.num_registers * math.log(self.num_registers / zeros)
+        return int(round(estimate))
+
+    def _expire(self, bucket):
+        while self._buckets and self._buckets[0][0] <= bucket - self.num_buckets:
+            self._buckets.popleft()
+            self._merged = None
+
+    def _current(self, bucket):
+        self._expire(bucket)
+        if not self._buckets or self._buckets[-1][0] != bucket:
+            self._buckets.append((bucket, bytearray(self.num_registers)))
+            self._merged = None
+        return self._buckets[-1][1]
+
+class PageShell:
+    """A page template compiled once into UTF-8 byte segments.
+
+    The template uses ``str.format`` syntax. Rendering only escapes and
+    splices the per-request fields between the prebuilt segments; pass
+    ``Markup`` for values that are already HTML.
+    """
+
+    def __init__(self, template):
+        self.segments = []
+        self.fields = []
+        literal_text = ''
+        for literal, field, _, _ in string.Formatter().parse(template):
+            literal_text += literal
+            if field is not None:
+                self.segments.append(literal_text.encode('utf-8'))
+                self.fields.append(field)
+                literal_text = ''
+        self.segments.append(literal_text.encode('utf-8'))
+
+    def render(self, **values):
+        parts = [self.segments[0]]
+        for field, segment in zip(self.fields, self.segments[1:]):
+            parts.append(str(escape(values[field])).encode('utf-8'))
+            parts.append(segment)
+        return b''.join(parts)
+
+    def render_apart(self, isolated, **values):
+        """Render as three byte strings: the page before the field ``isolated``, the field and the rest."""
+        parts, current = [], [self.segments[0]]
+        for field, segment in zip(self.fields, self.segments[1:]):
+            value = str(escape(values[field])).encode('utf-8')
+            if field == isolated:
+                parts += [b''.join(current), value]
+                current = [segment]
+            else:
+                current += [value, segment]
+        parts.append(b''.join(current))
+        return parts
+
+class TimerWheel:
+    """Runs ``callback(key, data, now)`` for every key once per ``period`` seconds.
+
+    Keys are spread over one slot per second, so a tick only visits the
+    keys due in that second. A single daemon thread, started with the first
+    key, drives all of them. The callback returns False to drop its key.
+    """
+
+    def __init__(self, period, callback):
+        self.period = period
+        self.callback = callback
+        self._slots = [{} for _ in range(period)]  # [{key: data}]
+        self._slot_of = {}  # {key: slot index}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def add(self, key, data, now=None):
+        slot = int(time.time() if now is None else now) % self.period
+        with self._lock:
+            self._remove(key)
+            self._slots[slot][key] = data
+            self._slot_of[key] = slot
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def discard(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def tick(self, now):
+        """Fire the callbacks due in the current second."""
+        slot = int(now) % self.period
+        with self._lock:
+            due = list(self._slots[slot].items())
+        for key, data in due:
+            if not self.callback(key, data, now):
+                with self._lock:
+                    if self._slot_of.get(key) == slot and self._slots[slot].get(key) is data:
+                        self._remove(key)
+
+    def _remove(self, key):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            self._slots[slot].pop(key, None)
+
+    def _run(self):
+        # Wake just after each whole second, so keys fire 3, 6, 9... seconds after being added
+        while True:
+            time.sleep(1 - time.time() % 1)
+            try:
+                self.tick(time.time())
+            except Exception:
+                app.logger.exception("Timer wheel callback failed")
+
+class SessionLocks:
+    """Striped locks that serialize changes to each client's session.
+
+    ``session_locks(client_id)`` returns one of a fixed set of locks picked
+    by hashing the id, so there is no per-client lock to create or clean
+    up, and unrelated clients rarely share one. The locks are reentrant,
+    so helpers such as check_partner_left lock for themselves even when
+    the caller already does. A thread holds at most one client's lock at a
+    time, which keeps the stripes free of lock-order deadlocks; the
+    time; the message log shared by a pair has its own lock in the store.
+
+    The locks are per process: with workers.py or Redis they give no
+    guarantee across workers. What must happen once in the whole chat is
+    a single store operation instead: pairing (find_partner), and telling
+    a partner they were left (only the caller whose end_chat ends the chat
+    reports it). Starting a session is not one. Two page loads of the same
+    client landing in two workers at the same moment can both start a
+    search and pair it twice; the first partner is then told "The random
+    left." on its next message or page load.
+    """
+
+    def __init__(self, stripes=SESSION_LOCK_STRIPES):
+        self._locks = [threading.RLock() for _ in range(stripes)]
 
-# Data structures for chat functionality
-active_chats = {}  # {client_id: {partner_id, messages, last_active}}
-pending_users = {}  # {client_id: timestamp}
-chat_messages = {}  # {client_id: [{time, sender, message}]}
-recent_ips = collections.deque(maxlen=1000)  # Store recent IPs with timestamps
-chat_locks = {}  # Locks for thread safety when modifying chat data
-active_connections = {}  # Track active streaming connections
-client_tokens = {}  # {client_id: submission_token} for security
+    def __call__(self, client_id):
+        return self._locks[hash(client_id) % len(self._locks)]
+
+session_locks = SessionLocks()
+
+unique_chatters = SlidingUniqueCounter()  # IPs seen in the last hour
+
+_chatter_count = {'value': 0, 'expires': 0.0}  # Shared by all waiting streams
 
 # Helper functions for chat functionality
 def generate_client_id():
@@ -44,153 +421,84 @@ def generate_random_gradient_css():
     gradient = f"linear-gradient({angle}deg, {', '.join(colors)})"
     return gradient
 
+# Gradients are drawn once at startup and reused, one picked per page
+GRADIENT_POOL_SIZE = 512
+GRADIENT_POOL = [generate_random_gradient_css() for _ in range(GRADIENT_POOL_SIZE)]
+
 def get_utc_time():
     """Get the current UTC time in 24-hour format (HH:MM)."""
     now = datetime.datetime.utcnow()
     return now.strftime("%H:%M")
 
 def count_unique_chatters():
-    """Count unique IPs from the last hour."""
-    one_hour_ago = time.time() - 3600
-    unique_ips = set()
-    for ip, timestamp in recent_ips:
-        if timestamp >= one_hour_ago:
-            unique_ips.add(ip)
-    return len(unique_ips)
+    """Count unique IPs from the last hour (recounted every few seconds)."""
+    now = time.time()
+    if now >= _chatter_count['expires']:
+        _chatter_count['value'] = unique_chatters.count(now)
+        _chatter_count['expires'] = now + CHATTER_COUNT_INTERVAL
+    return _chatter_count['value']
 
 def clear_client_session(client_id):
     """Clear all data associated with a client."""
-    # Remove from active chats
-    if client_id in active_chats:
-        partner_id = active_chats[client_id].get('partner_id')
-        if partner_id and partner_id in active_chats:
-            active_chats[partner_id].pop('partner_id', None)
-            add_system_message(partner_id, "The random left.")
-        active_chats.pop(client_id, None)
-    
-    # Remove from pending users
-    pending_users.pop(client_id, None)
-    
-    # Clear messages
-    chat_messages.pop(client_id, None)
-    
-    # Clear tokens
-    client_tokens.pop(client_id, None)
+    with session_locks(client_id):
+        partner_id = store.get_partner(client_id)
+        store.end_chat(client_id)
+        
+        # Clear pending entry, messages and tokens
+        store.remove_client(client_id)
+        search_wheel.discard(client_id)
+        spam_filter.forget(client_id)
     
-    # Clear locks
-    chat_locks.pop(client_id, None)
+    # Close the stream, on whichever worker holds it
+    store.publish(client_id, None)
     
-    # Clear connections
-    active_connections.pop(client_id, None)
+    # Tell the partner we left; outside our lock, check_partner_left takes theirs
+    if partner_id:
+        check_partner_left(partner_id)
 
 def find_chat_partner(client_id):
     """Find a chat partner for the client."""
-    now = time.time()
-    # Remove old pending users (waited > 5 minutes)
-    for cid, timestamp in list(pending_users.items()):
-        if now - timestamp > 300:
-            pending_users.pop(cid, None)
+    # Pair with the longest-waiting user, or join the waiting list
+    partner_id = store.find_partner(client_id, time.time())
+    if not partner_id:
+        return False
+    search_wheel.discard(partner_id)
     
-    # Find an available partner
-    if pending_users:
-        partner_id = next(iter(pending_users))
-        if partner_id != client_id:  # Don't match with self
-            pending_users.pop(partner_id, None)
-            # Create chat session for both users
-            active_chats[client_id] = {'partner_id': partner_id, 'last_active': now}
-            active_chats[partner_id] = {'partner_id': client_id, 'last_active': now}
-            # Initialize message lists
-            if client_id not in chat_messages:
-                chat_messages[client_id] = []
-            if partner_id not in chat_messages:
-                chat_messages[partner_id] = []
-            
-            # Add system message for both users
-            add_system_message(client_id, "A random was found, say hi!")
-            add_system_message(partner_id, "A random was found, say hi!")
-            
-            # Notify partner's streaming connection if active
-            if partner_id in active_connections and 'queue' in active_connections[partner_id]:
-                # Queue an update to ADD the "found" message (not replace searching)
-                update_html = '''
-            <script>
-                // Add found message without removing searching message
-                var section = document.querySelector("section");
-                var newMsg = document.createElement("p");
-                newMsg.innerHTML = "<i>A random was found, say hi!</i>";
-                section.appendChild(newMsg);
-                // Scroll to bottom
-                var d = document.querySelector("div");
-                d.scrollTo(0, d.scrollHeight);
-            </script>
-'''
-                active_connections[partner_id]['queue'].put(update_html)
-            
-            return True
-    
-    # No partner found, add to pending
-    pending_users[client_id] = now
-    return False
-
-def add_message(client_id, message, is_from_partner=False):
-    """Add a message to the chat history."""
-    if client_id not in chat_messages:
-        chat_messages[client_id] = []
+    # Add system message for both users
+    add_system_message(client_id, "A random was found, say hi!")
+    found = add_system_message(partner_id, "A random was found, say hi!")
     
+    # Notify partner's streaming connection, ADDING the "found" message (not replacing searching)
+    store.publish(partner_id, message_event(found, partner_id))
+    return True
+
+def add_message(client_id, message, is_from_partner=False, trace=None):
+    """Add a message to the chat history and return its record."""
     time_str = get_utc_time()
+    partner_id = store.get_partner(client_id)
     if is_from_partner:
-        chat_messages[client_id].append({
-            'time': time_str,
-            'sender': 'Random',
-            'message': message,
-            'is_system': False
-        })
-    else:
-        chat_messages[client_id].append({
-            'time': time_str,
-            'sender': 'You',
-            'message': message,
-            'is_system': False
-        })
-        
-        # Forward message to partner
-        if client_id in active_chats and 'partner_id' in active_chats[client_id]:
-            partner_id = active_chats[client_id]['partner_id']
-            if partner_id in chat_messages:
-                chat_messages[partner_id].append({
-                    'time': time_str,
-                    'sender': 'Random',
-                    'message': message,
-                    'is_system': False
-                })
-                
-                # Push update to partner's streaming connection if active
-                if partner_id in active_connections and 'queue' in active_connections[partner_id]:
-                    # Create HTML for the new message
-                    escaped_message = escape(message)
-                    update_html = f'''
-            <script>
-                var section = document.querySelector("section");
-                var newMsg = document.createElement("p");
-                newMsg.innerHTML = "<u>{time_str} - </u><b>Random:</b> {escaped_message}";
-                section.appendChild(newMsg);
-                // Scroll to bottom
-                var d = document.querySelector("div");
-                d.scrollTo(0, d.scrollHeight);
-            </script>
-'''
-                    active_connections[partner_id]['queue'].put(update_html)
+        record = ChatMessage(time_str, message, sender=partner_id or '')
+        store.append_message(client_id, record)
+        return record
+    
+    # Repeated and flooded messages are ghosted: kept, but only the sender sees them
+    ghosted = spam_filter.check(client_id, message)
+    
+    # Both sides share one log, so this also lands in the partner's history
+    record = ChatMessage(time_str, message, sender=client_id, audience=client_id if ghosted else None)
+    store.append_message(client_id, record)
+    tracer.stamp(trace, 'appended')
+    
+    if partner_id and not ghosted:
+        # Push update to partner's streaming connection
+        store.publish(partner_id, tracer.attach(message_event(record, partner_id), trace, 'partner'))
+    return record
 
 def add_system_message(client_id, message):
     """Add a system message to the chat history."""
-    if client_id not in chat_messages:
-        chat_messages[client_id] = []
-    
-    chat_messages[client_id].append({
-        'time': get_utc_time(),
-        'message': message,
-        'is_system': True
-    })
+    record = ChatMessage(get_utc_time(), message, audience=client_id)
+    store.append_message(client_id, record)
+    return record
 
 def get_searching_message(elapsed_seconds):
     """Get the searching message with appropriate number of dots."""
@@ -201,135 +509,107 @@ def get_searching_message(elapsed_seconds):
 
 def check_partner_left(client_id):
     """Check if partner has left the chat."""
-    if client_id in active_chats and 'partner_id' in active_chats[client_id]:
-        partner_id = active_chats[client_id]['partner_id']
-        if partner_id not in active_chats or active_chats[partner_id].get('partner_id') != client_id:
-            # Partner left
-            active_chats.pop(client_id, None)
-            add_system_message(client_id, "The random left.")
-            
-            # Push update to streaming connection if active
-            if client_id in active_connections and 'queue' in active_connections[client_id]:
-                update_html = '''
-            <script>
-                var section = document.querySelector("section");
-                var newMsg = document.createElement("p");
-                newMsg.innerHTML = "<i>The random left.</i>";
-                section.appendChild(newMsg);
-                // Scroll to bottom
-                var d = document.querySelector("div");
-                d.scrollTo(0, d.scrollHeight);
-            </script>
-'''
-                active_connections[client_id]['queue'].put(update_html)
-            
-            return True
-    return False
+    with session_locks(client_id):
+        partner_id = store.get_partner(client_id)
+        if not partner_id or store.get_partner(partner_id) == client_id:
+            return False
+        
+        # Partner left; only the caller whose end_chat ended the chat
+        # reports it, even if another worker checks at the same time
+        if not store.end_chat(client_id):
+            return False
+        left = add_system_message(client_id, "The random left.")
+        
+        # Push update to streaming connection
+        store.publish(client_id, message_event(left, client_id, 'left'))
+        return True
 
-def initialize_chat_session(client_id, message, start_time, token):
+def initialize_chat_session(client_id, message, start_time, token, client_ip=None):
     """Initialize or update chat session state."""
     # Record IP for unique chatter count
-    client_ip = request.remote_addr
-    recent_ips.append((client_ip, time.time()))
+    if client_ip is None:
+        client_ip = request.remote_addr
+    unique_chatters.add(client_ip)
+    start_cleanup()
     
     # Validate token if client_id exists
-    if client_id and client_id in client_tokens:
-        if client_tokens.get(client_id) != token:
+    issued_token = store.get_token(client_id) if client_id else None
+    if issued_token is not None:
+        if issued_token != token:
             # Invalid token, generate new session
             client_id = generate_client_id()
             token = generate_submission_token()
-            client_tokens[client_id] = token
+            store.set_token(client_id, token)
             start_time = get_utc_time()
     elif not client_id:
         # No client_id provided, generate new session
         client_id = generate_client_id()
         token = generate_submission_token()
-        client_tokens[client_id] = token
+        store.set_token(client_id, token)
         start_time = get_utc_time()
     
-    # Initialize new session if needed
-    if client_id not in active_chats and client_id not in pending_users:
-        # Initialize lock for this client
-        chat_locks[client_id] = threading.Lock()
-        
-        # Clear any old messages
-        if client_id in chat_messages:
-            chat_messages[client_id] = []
+    # Initialize new session if needed; under the client's lock, so two
+    # page loads at once can't both start looking for a partner
+    with session_locks(client_id):
+        if not store.is_active(client_id) and not store.is_pending(client_id):
+            # Clear any old messages
+            store.clear_messages(client_id)
             
-        # Add initial system message
-        add_system_message(client_id, get_searching_message(0))
-        
-        # Start looking for a partner
-        has_partner = find_chat_partner(client_id)
+            # Add initial system message
+            searching = add_system_message(client_id, get_searching_message(0))
+            
+            # Start looking for a partner, animating the dots while we wait
+            has_partner = find_chat_partner(client_id)
+            if not has_partner:
+                search_wheel.add(client_id, (store.pending_since(client_id), searching.seq))
     
     # Process message if provided
     if message and len(message) <= MAX_MESSAGE_LENGTH:
-        with chat_locks.get(client_id, threading.Lock()):
+        with session_locks(client_id):
             # Check if partner left before processing message
             check_partner_left(client_id)
             
             # Add message to chat
-            add_message(client_id, escape(message))
-            
-            # Update last active time
-            if client_id in active_chats:
-                active_chats[client_id]['last_active'] = time.time()
+            add_message(client_id, message)
+    
+    # Every page load keeps the session from expiring
+    store.touch(client_id, time.time())
     
     # Check if we have a partner or still searching
-    has_partner = client_id in active_chats and 'partner_id' in active_chats[client_id]
+    has_partner = store.get_partner(client_id) is not None
     
     # Check if partner left
     if has_partner:
         check_partner_left(client_id)
-        has_partner = client_id in active_chats  # Update has_partner status
+        has_partner = store.is_active(client_id)  # Update has_partner status
     
     # Register connection for updates
-    active_connections[client_id] = {'timestamp': time.time(), 'queue': queue.Queue()}
+    register_connection(client_id)
     
     return client_id, start_time, has_partner, token
 
-def get_message_html(client_id):
-    """Generate HTML for chat messages."""
-    messages_html = ""
-    if client_id in chat_messages:
-        for msg in chat_messages[client_id]:
-            if msg.get('is_system', False):
-                messages_html += f"<p><i>{msg['message']}</i></p>\n"
-            else:
-                time_str = msg['time']
-                if msg['sender'] == 'You':
-                    messages_html += f"<p><u>{time_str} - </u><s>{msg['sender']}:</s> {msg['message']}</p>\n"
-                else:
-                    messages_html += f"<p><u>{time_str} - </u><b>{msg['sender']}:</b> {msg['message']}</p>\n"
-    return messages_html
-
-def update_search_message(client_id, start_time):
-    """Update the searching message with correct dots based on elapsed time."""
-    if client_id in pending_users and client_id in chat_messages:
-        # Calculate elapsed time
-        now = datetime.datetime.utcnow()
-        try:
-            start_datetime = datetime.datetime.strptime(start_time, "%H:%M")
-            start_datetime = start_datetime.replace(year=now.year, month=now.month, day=now.day)
-            if start_datetime > now:  # Handle day rollover
-                start_datetime = start_datetime - datetime.timedelta(days=1)
-            elapsed_seconds = (now - start_datetime).total_seconds()
-        except ValueError:
-            elapsed_seconds = 0
-        
-        # Update search message with dots
-        for i, msg in enumerate(chat_messages[client_id]):
-            if msg.get('is_system') and "Searching for a random" in msg.get('message', ''):
-                chat_messages[client_id][i]['message'] = get_searching_message(int(elapsed_seconds))
-                return True
-    return False
+def get_message_html(client_id, records):
+    """Generate HTML for chat messages, the client's records from store.get_log."""
+    return ''.join(message_fragments(record, message_view(record, client_id)).line for record in records)
 
-def render_input_form(token=None):
-    """Render the simple input form template when x parameter is present."""
-    if not token:
-        token = generate_submission_token()
-    
-    html = f'''<!DOCTYPE html>
+def animate_search(client_id, entry, now):
+    """Push the next "Searching for a random..." frame to a waiting client.
+
+    Called by search_wheel every SEARCH_ANIMATION_PERIOD seconds per client;
+    returns False once the client has stopped waiting.
+    """
+    if not store.is_pending(client_id):
+        return False
+    started_at, seq = entry
+    new_message = get_searching_message(int(now) - int(started_at))
+    store.update_message(client_id, seq, new_message)
+    # Transient: a client that falls behind only needs the latest frame
+    store.publish(client_id, {'type': 'search', 'text': new_message})
+    return True
+
+search_wheel = TimerWheel(SEARCH_ANIMATION_PERIOD, animate_search)
+
+INPUT_FORM_SHELL = PageShell('''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="utf-8">
@@ -354,25 +634,17 @@ def render_input_form(token=None):
         <input type="hidden" name="x" value="{token}">
     </form>
 </body>
-</html>'''
-    return html
+</html>''')
 
-def stream_chat_content(client_id, start_time, token):
-    """Stream chat content without loading delays."""
-    # Get gradient for this session
-    gradient = generate_random_gradient_css()
+def render_input_form(token=None):
+    """Render the simple input form template when x parameter is present."""
+    if not token:
+        token = generate_submission_token()
     
-    # Generate the entire HTML at once
-    html = f'''<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <meta name="referrer" content="no-referrer">
-    <title>Random Chat</title>
-    <link rel="icon" href="data:,">
-    <base target="_blank">
-    <style>
+    return INPUT_FORM_SHELL.render(token=token)
+
+# Shared by the chat and public room pages (str.format syntax, see PageShell)
+CHAT_PAGE_STYLE = '''    <style>
         html {{
             background: {gradient};
             width: 100%;
@@ -462,12 +734,23 @@ def stream_chat_content(client_id, start_time, token):
             box-sizing: border-box;
         }}
     </style>
-</head>
+'''
+
+CHAT_PAGE_SHELL = PageShell('''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <meta name="referrer" content="no-referrer">
+    <title>Random Chat</title>
+    <link rel="icon" href="data:,">
+    <base target="_blank">
+''' + CHAT_PAGE_STYLE + '''</head>
 <body>
     <h1>Random</h1>
     <h1>Chat</h1>
     <nav>
-        <a href="/rchat" target="_self">Find a new random</a>
+        <a href="{new_chat_url}" target="_self">Find a new random</a>
         <a href="/help">Help</a>
     </nav>
     <main>
@@ -484,77 +767,463 @@ def stream_chat_content(client_id, start_time, token):
                 window.sessionGradient = '{gradient}';
             </script>
             <section>
-{get_message_html(client_id)}            </section>
+{messages}            </section>
         </div>
     </main>
+    {events_script}
+''')
+
+EVENTS_SCRIPT_TAG = Markup('<script src="/static/rchat-events.js" '
+                           'data-events="/rchat/events?h={}&x={}&since={}"></script>')
+
+def render_chat_page(client_id, start_time, token, use_events=False, history=None):
+    """Render the chat page shell that opens every /rchat stream; see chat_page_parts."""
+    return b''.join(chat_page_parts(client_id, start_time, token, use_events, history))
+
+def chat_page_parts(client_id, start_time, token, use_events=False, history=None):
+    """Render the chat page as (head, messages, tail).
+
+    The head and the tail carry the session's h and x, the messages the
+    partner's text, so a compressed stream compresses each apart (see
+    encode_opening). ``history`` is the client's (log id, records) from
+    store.get_log, fetched here if not given. With ``use_events``
+    (``/rchat?e=1``) the page loads the client script that switches it
+    over to /rchat/events, resuming after the messages on the page.
+    """
+    log_id, records = history if history is not None else store.get_log(client_id)
+    events_script = ''
+    if use_events:
+        events_script = EVENTS_SCRIPT_TAG.format(client_id, token, format_cursor(history_cursor(log_id, records)))
+    return CHAT_PAGE_SHELL.render_apart(
+        'messages',
+        gradient=random.choice(GRADIENT_POOL),
+        client_id=client_id,
+        start_time=start_time,
+        token=token,
+        messages=Markup(get_message_html(client_id, records)),
+        new_chat_url='/rchat?e=1' if use_events else '/rchat',
+        events_script=events_script,
+    )
+
+# Stream updates are small event dicts, published through the store:
+#   {'type': 'message', 'from': 'You' or 'Random', 'time': 'HH:MM', 'text': ...}
+#   {'type': 'system', 'text': ...}, {'type': 'left', 'text': ...}, {'type': 'search', 'text': ...}
+#   {'type': 'reset'}: forget the messages shown so far, a replay of another chat follows
+# Events for records of the chat log also carry the record's 'log' id and
+# 'seq'; a client that reconnects sends back the last pair it got as its
+# cursor, "log.seq", and gets only what it missed (see replay_events).
+# Each transport renders them for its stream.
+#
+# Messages are rendered once per view (see message_fragments) and their
+# events carry the results under 'html' and 'json', so the partner's
+# stream, the sender's echo, replays and page loads all reuse them.
+
+# A record rendered for one view: its <p> line on the chat page, the
+# script that appends it on the HTML stream and its event as JSON
+MessageFragments = collections.namedtuple('MessageFragments', 'line script data')
+
+def message_script(line):
+    """The HTML stream's script appending ``line``, already encoded as a JavaScript string."""
+    return f'''
+            <script>
+                var section = document.querySelector("section");
+                var newMsg = document.createElement("p");
+                newMsg.innerHTML = {line};
+                section.appendChild(newMsg);
+                // Scroll to bottom
+                var d = document.querySelector("div");
+                d.scrollTo(0, d.scrollHeight);
+            </script>
 '''
-    
-    # Yield the entire HTML first
-    yield html
-    
-    # Now continue with an infinite stream of updates
-    update_counter = 0
-    search_check_counter = 0
-    
-    # Keep connection alive indefinitely
-    while True:
-        update_counter += 1
-        search_check_counter += 1
-        
-        # Check if partner left
-        if client_id in active_chats:
-            with chat_locks.get(client_id, threading.Lock()):
-                check_partner_left(client_id)
-        
-        # Update search animation if still searching (every 3 seconds)
-        if search_check_counter >= 3:
-            search_check_counter = 0
-            if client_id in pending_users:
-                # Update search message
-                if update_search_message(client_id, start_time):
-                    # If message was updated, send a script to update it in the DOM
-                    new_message = get_searching_message(int(time.time() - pending_users[client_id]))
-                    yield f'''
+
+def message_view(record, viewer, kind=None):
+    """How ``viewer`` sees ``record``: 'You', 'Random', or 'system' (or ``kind``) for notices."""
+    if record.is_system:
+        return kind or 'system'
+    return record.label_for(viewer)
+
+def view_event(record, view):
+    """The stream event of ``record`` for ``view``, without its fragments."""
+    if view == 'You' or view == 'Random':
+        event = {'type': 'message', 'from': view, 'time': record.time, 'text': record.text}
+    else:
+        event = {'type': view, 'text': record.text}
+    event['log'] = record.log
+    event['seq'] = record.seq
+    return event
+
+def escape_text(record):
+    """The record's text escaped for HTML, for HTML in a JavaScript string and for JSON."""
+    encode = _event_encoder.encode  # A str goes straight to the C escaper
+    html = str(escape(record.text))
+    return html, encode(html)[1:-1], encode(record.text)
+
+def render_fragments(record, view, text):
+    """Render ``record`` for one view from its ``text`` as escape_text returns it.
+
+    Builds the JSON of view_event by hand: the time ("HH:MM") and log id
+    (hex) are ours and need no escaping.
+    """
+    html, script_html, json_text = text
+    if view == 'You' or view == 'Random':
+        head = f"<u>{record.time} - </u>{'<s>You:</s>' if view == 'You' else '<b>Random:</b>'} "
+        line, script_line = head + html, head + script_html
+        data = f'{{"type":"message","from":"{view}","time":"{record.time}","text":{json_text},'
+    else:
+        line, script_line = f'<i>{html}</i>', f'<i>{script_html}</i>'
+        data = f'{{"type":"{view}","text":{json_text},'
+    data += f'"log":"{record.log}","seq":{record.seq}}}'
+    return MessageFragments(f'<p>{line}</p>\n', message_script(f'"{script_line}"'), data)
+
+def message_fragments(record, view):
+    """The fragments of ``record`` for ``view``, rendered the first time they are asked for.
+
+    They are cached on the record, with its escaped text under None, until
+    the store changes its text.
+    """
+    fragments = record.fragments
+    if fragments is None:
+        fragments = record.fragments = {None: escape_text(record)}
+    rendered = fragments.get(view)
+    if rendered is None:
+        rendered = fragments[view] = render_fragments(record, view, fragments[None])
+    return rendered
+
+def message_event(record, viewer, kind=None):
+    """The stream event for a ChatMessage, as ``viewer`` sees it.
+
+    ``kind`` 'left' makes the system notice that ends a chat a 'left' event.
+    """
+    view = message_view(record, viewer, kind)
+    event = view_event(record, view)
+    rendered = message_fragments(record, view)
+    event['html'] = rendered.script
+    event['json'] = rendered.data
+    return event
+
+def format_cursor(cursor):
+    """The "log.seq" form of a [log id, seq] cursor, or '' before any message."""
+    return f'{cursor[0]}.{cursor[1]}' if cursor[0] else ''
+
+def parse_cursor(text):
+    """Parse a "log.seq" cursor sent by a client; None if it is missing or malformed."""
+    log_id, _, seq = (text or '').rpartition('.')
+    if not log_id or not seq.isdigit():
+        return None
+    return [log_id, int(seq)]
+
+def history_cursor(log_id, records):
+    """The cursor just past ``records``, a client's view of log ``log_id``."""
+    return [log_id, records[-1].seq if records else 0]
+
+def replay_events(client_id, cursor):
+    """Return (new cursor, events) for what the client missed since ``cursor``.
+
+    A cursor into another log (the client has started a new chat since)
+    replays the whole current one after a 'reset' event.
+    """
+    log_id, records = store.get_log(client_id, after=cursor)
+    events = [message_event(record, client_id) for record in records]
+    if log_id != cursor[0]:
+        events.insert(0, {'type': 'reset'})
+    if records or log_id != cursor[0]:
+        cursor = history_cursor(log_id, records)
+    replayed_events.inc(len(records))
+    return cursor, events
+
+def skip_seen(events, cursor):
+    """Drop the events a stream already sent and move ``cursor`` past the rest.
+
+    A stream registers for updates before it reads the history it opens
+    with, so the first updates may repeat the end of that history.
+    """
+    fresh = []
+    for event in events:
+        seq = event.get('seq')
+        if seq is not None:
+            if event['log'] == cursor[0] and seq <= cursor[1]:
+                continue
+            cursor[0], cursor[1] = event['log'], seq
+        fresh.append(event)
+    return fresh
+
+def render_update_html(event):
+    """Render a stream event as the script the HTML stream sends."""
+    if 'html' in event:
+        # Rendered with its record, see message_fragments
+        return event['html']
+    kind = event['type']
+    if kind == 'search':
+        return f'''
             <script>
                 var messages = document.querySelectorAll("section p i");
                 for (var i = 0; i < messages.length; i++) {{
                     if (messages[i].textContent.includes("Searching for a random")) {{
-                        messages[i].textContent = "{new_message}";
+                        messages[i].textContent = "{event['text']}";
                         break;
                     }}
                 }}
             </script>
 '''
+    # Otherwise a 'reset'
+    return '''
+            <script>
+                document.querySelector("section").innerHTML = "";
+            </script>
+'''
+
+_event_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+def render_event_json(event):
+    # Events of records come with their JSON, see message_fragments
+    return event.get('json') or _event_encoder.encode(event)
+
+def render_sse(event):
+    # EventSource sends the last id back as Last-Event-ID when it reconnects
+    event_id = f"id: {event['log']}.{event['seq']}\n" if 'seq' in event else ''
+    return f'{event_id}data: {render_event_json(event)}\n\n'
+
+# How a stream renders events and keeps the connection alive
+Transport = collections.namedtuple('Transport', 'mimetype render keepalive keepalive_every')
+
+HTML_TRANSPORT = Transport('text/html', render_update_html, lambda tick: f"<!-- keepalive: {tick} -->\n", 1)
+EVENT_TRANSPORTS = {
+    # Server-sent events, for EventSource
+    'sse': Transport('text/event-stream', render_sse, lambda tick: ':\n', EVENTS_KEEPALIVE_INTERVAL),
+    # One JSON object per line, for fetch() and other clients
+    'ndjson': Transport('application/x-ndjson', lambda event: render_event_json(event) + '\n',
+                        lambda tick: '\n', EVENTS_KEEPALIVE_INTERVAL),
+}
+
+def connection_updates(client_id):
+    """Return the client's pending-update queue, or None if it has no stream."""
+    connection = active_connections.get(client_id)
+    return connection.get('queue') if connection else None
+
+def collect_stream_updates(updates, clock, transport=HTML_TRANSPORT, cursor=None):
+    """Gather everything due on a stream after it wakes up.
+
+    Drains and renders every queued update, so a burst of partner
+    messages goes out as a single chunk; with a ``cursor``, those the
+    stream already sent are skipped. ``clock`` ticks once a second; every
+    ``transport.keepalive_every`` ticks a keepalive goes out if nothing
+    else does. The search animation and a partner leaving are pushed to
+    the queue like any other update (see animate_search and
+    clear_client_session).
+    """
+    keepalive = None
+    now = time.monotonic()
+    if now >= clock['next_tick']:
+        clock['tick'] += 1
+        clock['next_tick'] += 1
+        if clock['next_tick'] <= now:
+            # Fell behind (e.g. a slow reader), don't replay missed ticks
+            clock['next_tick'] = now + 1
+        if clock['tick'] % transport.keepalive_every == 0:
+            keepalive = transport.keepalive(clock['tick'])
+    events = updates.drain(delivery_latency.observe)
+    if cursor is not None:
+        events = skip_seen(events, cursor)
+    traces = tracer.collect(events)
+    chunk = ''.join(transport.render(event) for event in events)
+    tracer.finish(traces)
+    # Send a comment to keep the connection alive
+    return chunk or keepalive or ''
+
+def register_connection(client_id, carry_over=False):
+    """Register a new stream for the client, replacing any older one.
+
+    With ``carry_over`` the updates the older stream has not sent yet move
+    to the new one; a page load doesn't need them, it renders the history.
+    An older stream in another worker is told to close, or it would keep
+    taking the client's updates there (see deliver_local_update).
+    """
+    updates = UpdateQueue()
+    now = time.time()
+    with session_locks(client_id):
+        older = active_connections.get(client_id)
+        if carry_over and older is not None:
+            for event in older['queue'].drain():
+                updates.put(event)
+        active_connections[client_id] = {'timestamp': now, 'queue': updates}
+    store.broadcast(client_id, {'type': 'takeover', 'since': now})
+    return updates
+
+def release_connection(client_id, updates):
+    """Forget the client's stream registration if it still belongs to ``updates``."""
+    with session_locks(client_id):
+        connection = active_connections.get(client_id)
+        if connection is not None and connection.get('queue') is updates:
+            del active_connections[client_id]
+
+def stream_compressor(accept_encoding):
+    """Return a StreamCompressor if the client accepts gzip or deflate, else None."""
+    encoding = negotiate(accept_encoding) if COMPRESS_STREAMS else None
+    return StreamCompressor(encoding) if encoding else None
+
+def compression_headers(compressor):
+    if not COMPRESS_STREAMS:
+        return {}
+    headers = {'Vary': 'Accept-Encoding'}
+    if compressor is not None:
+        headers['Content-Encoding'] = compressor.encoding
+    return headers
+
+def encode_chunk(compressor, chunk, reset=False):
+    """Compress a stream chunk if the stream is compressed; see StreamCompressor.compress."""
+    if compressor is None:
+        return chunk
+    raw, sent = compressor.raw_bytes, compressor.compressed_bytes
+    data = compressor.compress(chunk, reset)
+    compressed_raw_bytes.inc(compressor.raw_bytes - raw)
+    compressed_sent_bytes.inc(compressor.compressed_bytes - sent)
+    return data
+
+def encode_opening(compressor, parts):
+    """Encode the chunks a stream opens with as one chunk.
+
+    Compressed, every part is flushed with a reset, so no part is
+    compressed against another or against the updates that follow: the
+    partner's text on the page never shares a window with the h and x
+    around it (the BREACH attack).
+    """
+    if compressor is None:
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+    return b''.join(encode_chunk(compressor, part, reset=True) for part in parts)
+
+def open_stream(client_id, start_time, token, transport, use_events, cursor):
+    """Return the chunks a stream opens with and the cursor its updates go on from.
+
+    The HTML stream opens with the chat page, in the parts of
+    chat_page_parts. The event transports of /rchat/events only carry
+    updates for a page that is already shown; given the ``cursor`` of a
+    client that reconnects, they open with the events it missed.
+    """
+    if transport is HTML_TRANSPORT:
+        history = store.get_log(client_id)
+        return chat_page_parts(client_id, start_time, token, use_events, history), history_cursor(*history)
+    if cursor is None:
+        return [], None
+    cursor, events = replay_events(client_id, cursor)
+    return [''.join(transport.render(event) for event in events)], cursor
+
+def stream_chat_content(client_id, start_time, token, transport=HTML_TRANSPORT, use_events=False,
+                        compressor=None, cursor=None):
+    """Stream chat content without loading delays.
+
+    Opens as open_stream says, then sends updates as they come. With a
+    ``compressor`` every chunk is compressed and flushed on its own.
+    """
+    updates = connection_updates(client_id)
+    open_streams.inc()
+    try:
+        opening, cursor = open_stream(client_id, start_time, token, transport, use_events, cursor)
+        if opening:
+            # Yield the entire HTML first; nothing after it may be
+            # compressed against the token in it
+            yield encode_opening(compressor, opening)
         
-        # Send a comment to keep the connection alive
-        yield f"<!-- keepalive: {update_counter} -->\n"
-        
-        # Check for any queued updates (messages from partner, etc.)
-        if client_id in active_connections and 'queue' in active_connections[client_id]:
-            try:
-                # Non-blocking queue check
-                update = active_connections[client_id]['queue'].get_nowait()
-                yield update
-            except queue.Empty:
-                pass
+        # Now continue with an infinite stream of updates
+        clock = {'tick': 0, 'next_tick': time.monotonic() + 1}
         
-        # Slow down the loop to avoid excessive CPU usage
-        time.sleep(1)
+        # Keep the connection alive until the session is evicted or a newer
+        # page load of the same client takes over its registration
+        while updates is not None and connection_updates(client_id) is updates:
+            # Sleep until something is queued or the next tick is due
+            updates.wait(max(0.0, clock['next_tick'] - time.monotonic()))
+            
+            chunk = collect_stream_updates(updates, clock, transport, cursor)
+            if chunk:
+                yield encode_chunk(compressor, chunk)
+    finally:
+        open_streams.dec()
+        release_connection(client_id, updates)
 
-@app.route('/rchat/input')
-def rchat_input():
-    """Dedicated route for the iframe input form."""
-    # Get parameters
-    client_id = request.args.get('h', '')
-    start_time = request.args.get('t', '')
-    token = request.args.get('x', '')
-    
-    # Validate token
-    if client_id and client_id in client_tokens:
-        if client_tokens[client_id] != token:
-            return "Invalid session", 403
-    
-    html = f'''<!DOCTYPE html>
+async def off_loop(func, *args, **kwargs):
+    """Call ``func``, which uses the store, from a coroutine without blocking the event loop.
+
+    The in-process stores answer from memory and are called right away;
+    the broker and Redis stores make socket round-trips, so with them
+    ``func`` runs in a thread of the loop's default executor.
+    """
+    if isinstance(store, MemoryChatStore):
+        return func(*args, **kwargs)
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+async def astream_chat_content(client_id, start_time, token, transport=HTML_TRANSPORT, use_events=False,
+                               compressor=None, cursor=None):
+    """Asynchronous variant of stream_chat_content for the ASGI server.
+
+    Sends the same chunks, but waits on the event loop instead of blocking
+    a thread.
+    """
+    updates = connection_updates(client_id)
+    open_streams.inc()
+    try:
+        opening, cursor = await off_loop(open_stream, client_id, start_time, token, transport, use_events, cursor)
+        if opening:
+            yield encode_opening(compressor, opening)
+
+        clock = {'tick': 0, 'next_tick': time.monotonic() + 1}
+        while updates is not None and connection_updates(client_id) is updates:
+            await updates.wait_async(max(0.0, clock['next_tick'] - time.monotonic()))
+
+            chunk = collect_stream_updates(updates, clock, transport, cursor)
+            if chunk:
+                yield encode_chunk(compressor, chunk)
+    finally:
+        open_streams.dec()
+        release_connection(client_id, updates)
+
+def poll_wakeup(client_id, updates, cursor):
+    """Return the queued events a long poll hasn't sent."""
+    events = skip_seen(updates.drain(delivery_latency.observe), cursor)
+    # Rendering the poll's answer is left out of the traced time
+    tracer.finish(tracer.collect(events))
+    return events
+
+def render_poll(cursor, events):
+    return (f'{{"cursor":{_event_encoder.encode(format_cursor(cursor))},'
+            f'"events":[{",".join(render_event_json(event) for event in events)}]}}')
+
+def poll_chat_events(client_id, cursor):
+    """Answer a /rchat/poll: the events after ``cursor`` (a whole replay if None), as JSON.
+
+    Waits up to POLL_TIMEOUT seconds if there are none yet. Like a stream,
+    the poll takes over the client's registration while it waits.
+    """
+    updates = register_connection(client_id, carry_over=True)
+    try:
+        cursor, events = replay_events(client_id, cursor or [None, 0])
+        deadline = time.monotonic() + POLL_TIMEOUT
+        while not events and connection_updates(client_id) is updates:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Wake at least once a second to notice a newer stream taking over
+            updates.wait(min(1.0, remaining))
+            events = poll_wakeup(client_id, updates, cursor)
+    finally:
+        release_connection(client_id, updates)
+    return render_poll(cursor, events)
+
+async def apoll_chat_events(client_id, cursor):
+    """Asynchronous variant of poll_chat_events for the ASGI server."""
+    updates = await off_loop(register_connection, client_id, carry_over=True)
+    try:
+        cursor, events = await off_loop(replay_events, client_id, cursor or [None, 0])
+        deadline = time.monotonic() + POLL_TIMEOUT
+        while not events and connection_updates(client_id) is updates:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await updates.wait_async(min(1.0, remaining))
+            events = poll_wakeup(client_id, updates, cursor)
+    finally:
+        release_connection(client_id, updates)
+    return render_poll(cursor, events)
+
+CHAT_INPUT_SHELL = PageShell('''<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="utf-8">
@@ -615,12 +1284,69 @@ def rchat_input():
         }});
     </script>
 </body>
-</html>'''
-    return html
+</html>''')
+
+@app.route('/rchat/input')
+def rchat_input():
+    """Dedicated route for the iframe input form."""
+    # Get parameters
+    client_id = request.args.get('h', '')
+    start_time = request.args.get('t', '')
+    token = request.args.get('x', '')
+    
+    # Validate token
+    issued_token = store.get_token(client_id) if client_id else None
+    if issued_token is not None and issued_token != token:
+        return "Invalid session", 403
+    
+    return CHAT_INPUT_SHELL.render(client_id=client_id, start_time=start_time, token=token)
+
+def send_message(client_id, message, trace=None):
+    """Post a message from the client to its chat and echo it on its own stream.
+
+    ``trace`` is the message's trace if it was sampled (see tracing.py).
+    """
+    with session_locks(client_id):
+        tracer.stamp(trace, 'locked')
+        
+        # Check if partner left before processing message
+        check_partner_left(client_id)
+        
+        # Add message to chat
+        record = add_message(client_id, message, trace=trace)
+        
+        # Update last active time
+        store.touch(client_id, time.time())
+        
+        # Queue update for sender's own view (its stream may live in another worker)
+        store.publish(client_id, tracer.attach(message_event(record, client_id), trace, 'sender'))
+
+def over_limit(limits, client_ip, client_id):
+    """Seconds until a rate-limited request may be retried, or 0 if it may go ahead."""
+    ip_limit, client_limit = limits
+    wait = ip_limit.hit(client_ip) if LIMIT_BY_IP and client_ip else 0
+    if not wait and client_id:
+        wait = client_limit.hit(client_id)
+    return wait
+
+def chat_load_limit(client_id, token):
+    """over_limit for an /rchat load whose IP already passed: the client's own
+    bucket for a valid session, the shared ``session_limit`` for one that
+    would start a new session."""
+    if client_id and store.get_token(client_id) == token:
+        return over_limit(stream_limits, None, client_id)
+    return session_limit.hit('new')
+
+def retry_after(wait):
+    return {'Retry-After': str(max(1, math.ceil(wait)))}
 
 @app.route('/rchat/send', methods=['POST'])
 def rchat_send():
     """Handle message sending via AJAX without page reload."""
+    trace = tracer.start()
+    ip_wait = over_limit(send_limits, request.remote_addr, None)
+    if ip_wait:
+        return "Too many requests", 429, retry_after(ip_wait)
     data = request.get_json()
     
     client_id = data.get('h', '')
@@ -628,44 +1354,241 @@ def rchat_send():
     message = data.get('m', '')
     
     # Validate token
-    if client_id and client_id in client_tokens:
-        if client_tokens[client_id] != token:
-            return "Invalid session", 403
-    else:
+    if not client_id or store.get_token(client_id) != token:
         return "Invalid session", 403
     
+    client_wait = over_limit(send_limits, None, client_id)
+    if client_wait:
+        return "Too many requests", 429, retry_after(client_wait)
+    
     # Process message
     if message and len(message) <= MAX_MESSAGE_LENGTH:
-        with chat_locks.get(client_id, threading.Lock()):
-            # Check if partner left before processing message
-            check_partner_left(client_id)
-            
-            # Add message to chat
-            add_message(client_id, message)
-            
-            # Update last active time
-            if client_id in active_chats:
-                active_chats[client_id]['last_active'] = time.time()
-            
-            # Queue update for sender's own view
-            if client_id in active_connections and 'queue' in active_connections[client_id]:
-                time_str = get_utc_time()
-                escaped_message = escape(message)
-                update_html = f'''
-            <script>
-                var section = document.querySelector("section");
-                var newMsg = document.createElement("p");
-                newMsg.innerHTML = "<u>{time_str} - </u><s>You:</s> {escaped_message}";
-                section.appendChild(newMsg);
-                // Scroll to bottom
-                var d = document.querySelector("div");
-                d.scrollTo(0, d.scrollHeight);
-            </script>
-'''
-                active_connections[client_id]['queue'].put(update_html)
+        send_message(client_id, message, trace)
     
     return '', 204  # No content response
 
+# The public "All" room of /chat. Its page needs no script: the stream
+# leaves the message list open and every message is a <p> line appended
+# to it, rendered once for all readers (see room.py).
+
+ROOM_NAME_SHELL = PageShell('''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <meta name="referrer" content="no-referrer">
+    <title>All</title>
+    <link rel="icon" href="data:,">
+    <style>
+        html {{ background: {gradient}; height: 100%; font-family: sans-serif; }}
+        form {{ display: flex; max-width: 120mm; margin: 30mm auto; box-shadow: 0 2px 8px #000; }}
+        input {{ outline: none; border: 0; }}
+        input[name=n] {{ flex: 1; min-width: 0; font-size: 8mm; height: 10mm; }}
+        input:hover, input:focus {{ background: #ded; }}
+        input[type=submit] {{ font-size: 9mm; height: 11mm; border: 0; padding: 0; margin-top: -3px; background: #782; text-shadow: 2px 2px 4px #000; cursor: pointer; }}
+        input[type=submit]:hover {{ background: #9a4; }}
+    </style>
+</head>
+<body>
+    <form action="/chat" method="get">
+        <input name="n" placeholder="Name" maxlength="{max_length}" autofocus autocomplete="off" required>
+        <input type="submit" value="💬">
+    </form>
+</body>
+</html>''')
+
+ROOM_PAGE_SHELL = PageShell('''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <meta name="referrer" content="no-referrer">
+    <title>All</title>
+    <link rel="icon" href="data:,">
+    <base target="_blank">
+''' + CHAT_PAGE_STYLE + '''    <style>
+        .attack {{ color: #d00; }}
+    </style>
+</head>
+<body>
+    <h1>All</h1>
+    <h1>Chat</h1>
+    <nav>
+        <a href="/" target="_self">Leave</a>
+        <a href="/help">Help</a>
+    </nav>
+    <main>
+        <iframe src="/chat/input?h={member_id}"></iframe>
+        <div>
+            <section>
+''')
+
+ROOM_INPUT_SHELL = PageShell('''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="utf-8">
+    <meta name="referrer" content="no-referrer">
+    <title>t</title>
+    <link rel="icon" href="data:,">
+    <style>
+        html {{ overflow: hidden; margin: 0; font-family: sans-serif; }}
+        body {{ margin: 0; }}
+        form {{ display: flex; }}
+        input {{ outline: none; border: 0; }}
+        input[name=m] {{ flex: 1; font-size: 8mm; height: 10mm; }}
+        input:hover, input:focus {{ background: #ded; }}
+        input[type=submit] {{ font-size: 9mm; height: 11mm; border: 0; padding: 0; margin-top: -3px; background: #782; text-shadow: 2px 2px 4px #000; cursor: pointer; }}
+        input[type=submit]:hover {{ background: #9a4; }}
+    </style>
+</head>
+<body>
+    <form action="/chat/send" method="post" target="_self">
+        <input name="m" autofocus autocomplete="off" tabindex="1">
+        <input type="submit" value="💬">
+        <input type="hidden" name="h" value="{member_id}">
+    </form>
+</body>
+</html>''')
+
+ROOM_KEEPALIVE = b'<!-- -->\n'
+
+def room_name(name):
+    """Tidy up a name asked for on /chat; None if it can't be used."""
+    name = ' '.join(name.split())
+    return name if 0 < len(name) <= MAX_NAME_LENGTH else None
+
+def render_room_line(time_str, name, text, attack=False):
+    """Render a room message as the UTF-8 <p> line its readers are sent."""
+    css_class = ' class="attack"' if attack else ''
+    return f'<p{css_class}><u>[{time_str}]</u> <b>{escape(name)}:</b> {escape(text)}</p>\n'.encode('utf-8')
+
+def post_room_message(member_id, message):
+    """Post a message of a member to the room.
+
+    As on the original site, a repeated or flooded message is ghosted,
+    only shown to its sender, and while a flood lockdown is on nothing
+    gets through: the sender sees "Message sending failed. We are
+    currently under attack." in red instead.
+    """
+    ghosted = room_spam_filter.check(member_id, message)
+    time_str = get_utc_time()
+    if room_spam_filter.under_attack():
+        public_room.post(render_room_line(time_str, 'chat', "Message sending failed. We are currently under attack.",
+                                          attack=True), audience=member_id)
+        return
+    public_room.post(render_room_line(time_str, public_room.members.get(member_id, ''), message),
+                     audience=member_id if ghosted else None)
+
+def join_room(name):
+    """Add a reader to the room and return its member id, the secret its input form posts with."""
+    start_cleanup()
+    member_id = generate_client_id()
+    public_room.join(member_id, name)
+    return member_id
+
+def leave_room(member_id):
+    public_room.leave(member_id)
+    room_spam_filter.forget(member_id)
+
+def room_opening(member_id):
+    """Return the chunks a room stream opens with and the cursor it goes on from."""
+    cursor, history = public_room.read(0, member_id)
+    page = ROOM_PAGE_SHELL.render(gradient=random.choice(GRADIENT_POOL), member_id=member_id)
+    return page, b''.join(history), cursor
+
+def stream_room_content(name):
+    """Join the room as ``name`` and stream its page, then each message as it is posted."""
+    member_id = join_room(name)
+    open_streams.inc()
+    try:
+        # The page and the messages are sent apart, as they would be compressed apart
+        page, history, cursor = room_opening(member_id)
+        yield page
+        if history:
+            yield history
+        next_keepalive = time.monotonic() + ROOM_KEEPALIVE_INTERVAL
+        while member_id in public_room:
+            public_room.wait(cursor, max(0.0, next_keepalive - time.monotonic()))
+            cursor, lines = public_room.read(cursor, member_id)
+            if lines:
+                yield b''.join(lines)
+            elif time.monotonic() >= next_keepalive:
+                yield ROOM_KEEPALIVE
+            else:
+                continue
+            next_keepalive = time.monotonic() + ROOM_KEEPALIVE_INTERVAL
+    finally:
+        open_streams.dec()
+        leave_room(member_id)
+
+async def astream_room_content(name):
+    """Asynchronous variant of stream_room_content for the ASGI server.
+
+    Waits without a timer of its own: besides posts, the cleanup thread
+    wakes the room every CLEANUP_INTERVAL seconds for the keepalives.
+    """
+    member_id = join_room(name)
+    open_streams.inc()
+    try:
+        page, history, cursor = room_opening(member_id)
+        yield page
+        if history:
+            yield history
+        next_keepalive = time.monotonic() + ROOM_KEEPALIVE_INTERVAL
+        while member_id in public_room:
+            await public_room.wait_async(cursor)
+            cursor, lines = public_room.read(cursor, member_id)
+            if lines:
+                yield b''.join(lines)
+            elif time.monotonic() >= next_keepalive:
+                yield ROOM_KEEPALIVE
+            else:
+                continue
+            next_keepalive = time.monotonic() + ROOM_KEEPALIVE_INTERVAL
+    finally:
+        open_streams.dec()
+        leave_room(member_id)
+
+def render_room_name_form():
+    return ROOM_NAME_SHELL.render(gradient=random.choice(GRADIENT_POOL), max_length=MAX_NAME_LENGTH)
+
+def open_room_stream(name):
+    # Not compressed: every reader sends the same bytes, compressing them
+    # would mean encoding each message once per reader again
+    return Response(stream_room_content(name), mimetype='text/html', headers=STREAM_HEADERS)
+
+@app.route('/chat')
+def room():
+    """The public room: asks for a name, then streams the room under it."""
+    wait = over_limit(stream_limits, request.remote_addr, None)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
+    name = room_name(request.args.get('n', ''))
+    if name is None:
+        return render_room_name_form()
+    return admit_stream(open_room_stream, name)
+
+@app.route('/chat/input')
+def room_input():
+    return ROOM_INPUT_SHELL.render(member_id=request.args.get('h', ''))
+
+@app.route('/chat/send', methods=['POST'])
+def room_send():
+    """Post a message from the room's input form, then show the form again."""
+    member_id = request.form.get('h', '')
+    wait = over_limit(send_limits, request.remote_addr, None)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
+    if member_id not in public_room:
+        return "Invalid session", 403
+    wait = over_limit(send_limits, None, member_id)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
+    message = request.form.get('m', '')
+    if message and len(message) <= MAX_MESSAGE_LENGTH:
+        post_room_message(member_id, message)
+    return ROOM_INPUT_SHELL.render(member_id=member_id)
+
 @app.route('/')
 def home():
     return render_template('home.html')
@@ -683,18 +1606,180 @@ def contact():
     if request.method == 'POST':
         message = request.form.get('message', '').strip()
         if len(message) <= MAX_MESSAGE_LENGTH:
-            with open('feedback.txt', 'a', encoding='utf-8') as f:
-                f.write(f'Message: {escape(message)}\n---\n')
+            feedback_log.write(f'Message: {escape(message)}\n---\n')
         return render_template('thank_you.html')
     return render_template('contact.html')
 
+def deliver_local_update(client_id, update):
+    """Queue an update on the client's stream if it is served by this process.
+
+    An update of None means the session was evicted, maybe by another
+    worker: the stream is closed instead. So is a stream registered before
+    a 'takeover' from another worker, where the client opened a new one.
+    """
+    if update is None:
+        with session_locks(client_id):
+            return active_connections.pop(client_id, None) is not None
+    if update.get('type') == 'takeover':
+        with session_locks(client_id):
+            connection = active_connections.get(client_id)
+            if connection is not None and connection['timestamp'] < update['since']:
+                del active_connections[client_id]
+        return True
+    updates = connection_updates(client_id)
+    if updates is None:
+        return False
+    tracer.enqueued(update)
+    if not updates.put(update):
+        # The reader stalled; evicting takes other session locks, so the
+        # cleanup thread does it (see evict_stalled_streams)
+        with _stalled_lock:
+            _stalled[client_id] = updates
+    return True
+
+store.set_local_delivery(deliver_local_update)
+
+_stalled = {}  # {client_id: stalled UpdateQueue}, waiting for evict_stalled_streams
+_stalled_lock = threading.Lock()
+
+def evict_stalled_streams():
+    """End the sessions of clients whose stream stopped reading.
+
+    Their partners are told the chat ended and shown "The random left.",
+    as for idle sessions. A client that has reloaded the page since has a
+    new stream and is left alone.
+    """
+    with _stalled_lock:
+        stalled = list(_stalled.items())
+        _stalled.clear()
+    evicted = 0
+    for client_id, updates in stalled:
+        if connection_updates(client_id) is updates:
+            clear_client_session(client_id)
+            evicted += 1
+    stalled_evictions.inc(evicted)
+    return evicted
+
+# Headers shared by the WSGI and ASGI chat streams
+
+STREAM_HEADERS = {
+    # Disable caching to ensure fresh content
+    'Cache-Control': 'no-cache, no-store, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+}
+
+@app.before_request
+def start_request_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    rule = request.url_rule.rule if request.url_rule else None
+    if rule in TIMED_ROUTES:
+        request_latency.observe(time.perf_counter() - g.started, rule)
+    return response
+
+STORE_STATS_HELP = {
+    'active_chats': 'Clients in a chat with a partner.',
+    'pending_users': 'Clients waiting for a partner.',
+    'client_tokens': 'Issued submission tokens.',
+    'sessions': 'Sessions not yet expired.',
+    'journal_bytes': 'Bytes journaled since the last snapshot (file: store).',
+}
+
+def metrics_text():
+    """Render the Prometheus exposition text for /metrics.
+
+    Only reads sizes and copies the metric counters, so a scrape never
+    takes the session locks.
+    """
+    connections = list(active_connections.values())
+    stats = store.stats()
+    return render(
+        *(gauge(f'rchat_{name}', STORE_STATS_HELP[name], value) for name, value in sorted(stats.items())),
+        gauge('rchat_active_connections', 'Streams registered in this process.', len(connections)),
+        gauge('rchat_queued_updates', 'Updates waiting in stream queues.',
+              sum(connection['queue'].qsize() for connection in connections)),
+        open_streams.render(),
+        stalled_evictions.render(),
+        compressed_raw_bytes.render(),
+        compressed_sent_bytes.render(),
+        replayed_events.render(),
+        gauge('rchat_room_members', 'Readers of the public room in this process.', len(public_room)),
+        counter('rchat_room_messages_total', 'Messages posted to the public room.', public_room.seq),
+        gauge('rchat_threads', 'Live threads in this process.', threading.active_count()),
+        gauge('rchat_feedback_queue', 'Feedback messages waiting to be written.', feedback_log.qsize()),
+        counter('rchat_ghosted_messages_total', 'Messages shown only to their sender.', spam_filter.ghosted),
+        counter('rchat_lockdowns_total', 'Flood lockdowns started.', spam_filter.lockdowns),
+        gauge('rchat_under_attack', '1 while a flood lockdown is in effect.', int(spam_filter.under_attack())),
+        counter('rchat_room_ghosted_messages_total', 'Room messages shown only to their sender.',
+                room_spam_filter.ghosted),
+        counter('rchat_room_lockdowns_total', 'Flood lockdowns of the public room started.',
+                room_spam_filter.lockdowns),
+        gauge('rchat_room_under_attack', '1 while the public room is locked down.',
+              int(room_spam_filter.under_attack())),
+        counter('rchat_stream_requests_limited_total', '/rchat requests refused with a 429.',
+                sum(limit.rejected for limit in stream_limits)),
+        counter('rchat_send_requests_limited_total', '/rchat/send requests refused with a 429.',
+                sum(limit.rejected for limit in send_limits)),
+        counter('rchat_poll_requests_limited_total', '/rchat/poll requests refused with a 429.',
+                sum(limit.rejected for limit in poll_limits)),
+        counter('rchat_new_sessions_limited_total', '/rchat loads refused a new session with a 429.',
+                session_limit.rejected),
+        counter('rchat_streams_shed_total', 'Streams refused with a 503 at MAX_STREAMS.', stream_gate.rejected),
+        gauge('rchat_rate_limit_keys', 'IPs and clients tracked by the rate limiters.',
+              sum(len(limit) for limit in stream_limits + send_limits + poll_limits)),
+        match_wait.render(),
+        delivery_latency.render(),
+        request_latency.render(),
+        tracer.stages.render(),
+    )
+
+@app.route('/metrics')
+def metrics():
+    if not operator_only():
+        return "Not found", 404
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+def operator_only():
+    """True if the request may read /metrics and /metrics/traces.
+
+    With METRICS_TOKEN set it must come as ``Authorization: Bearer
+    <token>``. Without, only requests from this host get through, and none
+    behind Tor or a proxy (RATE_LIMIT_BY_IP=0), where every request does.
+    """
+    if METRICS_TOKEN:
+        given = request.headers.get('Authorization', '').encode('utf-8')
+        return secrets.compare_digest(given, f'Bearer {METRICS_TOKEN}'.encode('utf-8'))
+    return LIMIT_BY_IP and request.remote_addr in ('127.0.0.1', '::1')
+
+@app.route('/metrics/traces')
+def message_traces():
+    """The last traced messages of this process as JSON, newest last; ``?n=`` limits how many."""
+    if not operator_only():
+        return "Not found", 404
+    limit = request.args.get('n', '')
+    traces = tracer.recent(int(limit) if limit.isdigit() else None)
+    return Response(_event_encoder.encode({'sample_rate': tracer.sample_rate, 'traces': traces}),
+                    mimetype='application/json')
+
+def is_new_session_token(x_param):
+    """Return True if x is a fresh token that should get the plain input form."""
+    return bool(x_param) and not store.is_token_issued(x_param)
+
 @app.route('/rchat')
 def rchat():
+    # Refuse addresses over their limit before any session work
+    wait = over_limit(stream_limits, request.remote_addr, None)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
+    
     # Get the 'x' parameter
     x_param = request.args.get('x', '')
     
     # Check if 'x' parameter exists and is a valid new session token
-    if x_param and x_param not in client_tokens.values():
+    if is_new_session_token(x_param):
         # Clear any existing session and return simple input form
         return render_input_form(x_param)
     
@@ -704,57 +1789,159 @@ def rchat():
     message = request.args.get('m', '')
     start_time = request.args.get('t', '')
     token = x_param  # Use x parameter as token
+    use_events = request.args.get('e') == '1'
+    
+    wait = chat_load_limit(client_id, token)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
     
+    return admit_stream(open_chat_stream, client_id, message, start_time, token, use_events)
+
+def open_chat_stream(client_id, message, start_time, token, use_events=False):
+    """Start or resume the client's session and return its HTML stream."""
     # Initialize or update chat session
     client_id, start_time, has_partner, token = initialize_chat_session(client_id, message, start_time, token)
     
     # Create response that streams updates
+    compressor = stream_compressor(request.headers.get('Accept-Encoding'))
     return Response(
-        stream_chat_content(client_id, start_time, token),
+        stream_chat_content(client_id, start_time, token, use_events=use_events, compressor=compressor),
         mimetype='text/html',
         headers={
-            # Disable caching to ensure fresh content
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'Pragma': 'no-cache',
-            'Expires': '0',
+            **STREAM_HEADERS,
+            **compression_headers(compressor),
             # Enable chunked transfer encoding
             'Transfer-Encoding': 'chunked'
         }
     )
 
-# Cleanup function to remove inactive chats
-def cleanup_inactive_chats():
-    """Remove inactive chats (no activity for 10 minutes)."""
-    now = time.time()
-    for client_id in list(active_chats.keys()):
-        if now - active_chats[client_id].get('last_active', 0) > 600:  # 10 minutes
-            partner_id = active_chats[client_id].get('partner_id')
-            if partner_id and partner_id in active_chats:
-                add_system_message(partner_id, "The random left.")
-                active_chats.pop(partner_id, None)
-            active_chats.pop(client_id, None)
-            client_tokens.pop(client_id, None)
-    
-    # Also clean up old connections
-    for client_id in list(active_connections.keys()):
-        if now - active_connections[client_id].get('timestamp', 0) > 1800:  # 30 minutes
-            active_connections.pop(client_id, None)
-    
-    # Clean up orphaned tokens
-    for client_id in list(client_tokens.keys()):
-        if client_id not in active_chats and client_id not in pending_users:
-            client_tokens.pop(client_id, None)
+def open_event_stream(client_id, transport, cursor):
+    """Take over the client's stream registration and return its event stream."""
+    register_connection(client_id, carry_over=True)
+    compressor = stream_compressor(request.headers.get('Accept-Encoding'))
+    return Response(stream_chat_content(client_id, '', '', transport, compressor=compressor, cursor=cursor),
+                    mimetype=transport.mimetype, headers={**STREAM_HEADERS, **compression_headers(compressor)})
+
+def open_poll(client_id, cursor):
+    return Response(poll_chat_events(client_id, cursor), mimetype='application/json', headers=STREAM_HEADERS)
+
+def admit_stream(open_stream, *args):
+    """Return ``open_stream(*args)``, or a 503 if this process has MAX_STREAMS open.
+
+    Shedding load this way turns new streams away instead of queueing them
+    on threads; the slot is freed when the server closes the response.
+    """
+    if not stream_gate.enter():
+        return "Server busy, try again soon", 503, retry_after(5)
+    try:
+        response = open_stream(*args)
+    except BaseException:
+        stream_gate.leave()
+        raise
+    response.call_on_close(stream_gate.leave)
+    return response
+
+def event_stream_error(client_id, token, fmt=None):
+    """Return (message, status) if /rchat/events (or, without ``fmt``, /rchat/poll) can't be opened, else None."""
+    if fmt is not None and fmt not in EVENT_TRANSPORTS:
+        return "Unknown format", 400
+    if not client_id or store.get_token(client_id) != token:
+        return "Invalid session", 403
+    return None
+
+@app.route('/rchat/events')
+def rchat_events():
+    """Compact stream of chat events for the client script of /rchat?e=1.
+
+    Sends server-sent events, or newline-delimited JSON with
+    ``format=ndjson``. Opening it takes over the session's stream, so the
+    HTML stream the page came with ends; updates still queued there move
+    over. A client that reconnects passes its cursor as Last-Event-ID or
+    ``since`` and first gets the events it missed.
+    """
+    client_id = request.args.get('h', '')
+    wait = over_limit(stream_limits, request.remote_addr, None)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
+    fmt = request.args.get('format', 'sse')
+    error = event_stream_error(client_id, request.args.get('x', ''), fmt)
+    if error:
+        return error
+    wait = over_limit(stream_limits, None, client_id)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
+    cursor = parse_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    return admit_stream(open_event_stream, client_id, EVENT_TRANSPORTS[fmt], cursor)
+
+@app.route('/rchat/poll')
+def rchat_poll():
+    """Long-poll fallback for clients that can't keep a stream open.
+
+    Answers ``{"cursor": ..., "events": [...]}`` with the events after
+    ``since``, waiting up to POLL_TIMEOUT seconds for one; the next poll
+    passes the returned cursor. Without ``since`` it replays the whole chat.
+    """
+    client_id = request.args.get('h', '')
+    wait = over_limit(poll_limits, request.remote_addr, None)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
+    error = event_stream_error(client_id, request.args.get('x', ''))
+    if error:
+        return error
+    wait = over_limit(poll_limits, None, client_id)
+    if wait:
+        return "Too many requests", 429, retry_after(wait)
+    return admit_stream(open_poll, client_id, parse_cursor(request.args.get('since')))
+
+# Cleanup function to remove inactive sessions
+def cleanup_inactive_chats(now=None):
+    """Evict sessions with no activity for SESSION_TIMEOUT seconds.
+
+    The store hands out idle clients oldest first from its expiry index,
+    so a run costs O(expired) no matter how many sessions are open. Their
+    partners are told the chat ended and shown "The random left."
+    """
+    before = (time.time() if now is None else now) - SESSION_TIMEOUT
+    evicted = 0
+    while True:
+        expired = store.expire_sessions(before, CLEANUP_BATCH)
+        for client_id in expired:
+            clear_client_session(client_id)
+        evicted += len(expired)
+        if len(expired) < CLEANUP_BATCH:
+            return evicted
 
 # Run cleanup function periodically
 def run_cleanup():
     while True:
-        time.sleep(60)  # Run every minute
-        cleanup_inactive_chats()
+        time.sleep(CLEANUP_INTERVAL)
+        try:
+            evict_stalled_streams()
+            cleanup_inactive_chats()
+            # Lets idle /chat streams on an event loop send their keepalives
+            public_room.wake()
+        except Exception:
+            app.logger.exception("Session cleanup failed")
+
+_cleanup = {'pid': None}  # Process the cleanup thread runs in
+_cleanup_lock = threading.Lock()
+
+def start_cleanup():
+    """Start the cleanup thread for this process unless it is running.
+
+    Called for every session, so expiry runs under any server, including
+    workers forked after the app was imported.
+    """
+    if _cleanup['pid'] == os.getpid():
+        return
+    with _cleanup_lock:
+        if _cleanup['pid'] != os.getpid():
+            threading.Thread(target=run_cleanup, daemon=True).start()
+            _cleanup['pid'] = os.getpid()
 
 if __name__ == '__main__':
     # Start cleanup thread
-    cleanup_thread = threading.Thread(target=run_cleanup, daemon=True)
-    cleanup_thread.start()
+    start_cleanup()
     
     # Run the Flask app
     # Note: Using threaded=True is essential for streaming responses
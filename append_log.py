@@ -0,0 +1,135 @@
+"""Append-only text log written in batches by a background thread.
+
+Used for /contact/ feedback: a request only queues its record, and one
+writer thread appends whole batches, so a flood of posts costs one write
+and one fsync per batch instead of an open/write/close per request.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+
+class AppendLog:
+    """Group-commit writer for an append-only text file.
+
+    Records wait in a queue of at most ``max_queue`` entries. The writer
+    thread appends them once ``batch_bytes`` have gathered or
+    ``flush_interval`` seconds after the first one, then fsyncs. When the
+    file would grow past ``max_bytes`` it is rotated to ``path.1`` ...
+    ``path.<backups>``. If the queue is full, ``write`` appends the record
+    itself instead of dropping it, which also slows a flood down.
+    """
+
+    def __init__(self, path, max_queue=10000, batch_bytes=64 * 1024, flush_interval=0.2,
+                 max_bytes=10 * 1024 * 1024, backups=5):
+        self.path = path
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sync_writes = 0  # Records written by callers because the queue was full
+        self._queue = queue.Queue(max_queue)
+        self._file = None
+        self._file_lock = threading.Lock()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._closed = False
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def write(self, record):
+        """Queue a record (a str) for appending; never blocks on the queue."""
+        if self._closed:
+            self._append([record])
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.sync_writes += 1
+            self._append([record])
+
+    def flush(self):
+        """Wait until every record queued so far is on disk."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        """Write out what is queued and stop the writer thread."""
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        with self._file_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                self._queue.task_done()
+                return
+            batch, size = [first], len(first)
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while size < self.batch_bytes:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+                size += len(record)
+            try:
+                self._append(batch)
+            except OSError:
+                # Keep the thread alive; the next batch retries the file
+                logging.getLogger(__name__).exception("Could not append to %s", self.path)
+            finally:
+                for _ in range(len(batch) + stop):
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _append(self, records):
+        data = ''.join(records).encode('utf-8')
+        with self._file_lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            if self.max_bytes and self._file.tell() + len(data) > self.max_bytes and self._file.tell():
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'ab')
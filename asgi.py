@@ -0,0 +1,286 @@
+"""ASGI entry point for serving the random chat on an event loop.
+
+With ``python app.py`` every open /rchat tab holds a Werkzeug thread for as
+long as the stream stays open. Under an ASGI server each stream is instead a
+coroutine parked on its update queue, so one process can hold tens of
+thousands of idle chats:
+
+    pip install uvicorn a2wsgi
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Only the /rchat, /rchat/events and /chat streams and the /rchat/poll long
+poll run natively on the event loop. Every other route is the regular Flask
+app, run in a thread pool through a2wsgi's WSGI adapter. With the broker or
+Redis store, the store calls these routes make when a stream opens (session
+setup, the page's history, replays) go to a thread too (see
+``chat.off_loop``), so a round-trip doesn't hold up every other stream.
+"""
+import asyncio
+import time
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+import app as chat
+
+flask_application = WSGIMiddleware(chat.app)
+
+
+def _query_param(query, name):
+    values = query.get(name)
+    return values[0] if values else ''
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _encode(chunk):
+    return chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+
+
+async def _send_html(send, status, body, headers=None):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/html; charset=utf-8')] + [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in (headers or {}).items()
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': _encode(body)})
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def _stream(send, chunks, mimetype, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', f'{mimetype}; charset=utf-8'.encode('latin-1'))] + [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in {**chat.STREAM_HEADERS, **headers}.items()
+        ],
+    })
+    async for chunk in chunks:
+        await send({
+            'type': 'http.response.body',
+            'body': _encode(chunk),
+            'more_body': True,
+        })
+    # The stream ended on the server's side (evicted, or taken over by a newer one)
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _serve_stream(receive, send, chunks, mimetype='text/html', headers=None):
+    """Send ``chunks`` until they run out or the client disconnects."""
+    streamer = asyncio.ensure_future(_stream(send, chunks, mimetype, headers or {}))
+    watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({streamer, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (streamer, watcher):
+            task.cancel()
+        await asyncio.gather(streamer, watcher, return_exceptions=True)
+        await chunks.aclose()
+
+
+async def rchat(scope, receive, send):
+    """Event-loop version of the /rchat route."""
+    started = time.perf_counter()
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    x_param = _query_param(query, 'x')
+    client = scope.get('client')
+    client_ip = client[0] if client else ''
+
+    wait = chat.over_limit(chat.stream_limits, client_ip, None)
+    if wait:
+        await _send_html(send, 429, 'Too many requests', chat.retry_after(wait))
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat')
+        return
+
+    if await chat.off_loop(chat.is_new_session_token, x_param):
+        await _send_html(send, 200, chat.render_input_form(x_param))
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat')
+        return
+
+    wait = await chat.off_loop(chat.chat_load_limit, _query_param(query, 'h'), x_param)
+    if wait:
+        await _send_html(send, 429, 'Too many requests', chat.retry_after(wait))
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat')
+        return
+
+    if not chat.stream_gate.enter():
+        await _send_html(send, 503, 'Server busy, try again soon', chat.retry_after(5))
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat')
+        return
+    try:
+        client_id, start_time, has_partner, token = await chat.off_loop(
+            chat.initialize_chat_session,
+            _query_param(query, 'h'),
+            _query_param(query, 'm'),
+            _query_param(query, 't'),
+            x_param,
+            client_ip=client_ip,
+        )
+
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat')
+        compressor = chat.stream_compressor(_header(scope, b'accept-encoding'))
+        await _serve_stream(receive, send, chat.astream_chat_content(
+            client_id, start_time, token, use_events=_query_param(query, 'e') == '1', compressor=compressor),
+            headers=chat.compression_headers(compressor))
+    finally:
+        chat.stream_gate.leave()
+
+
+async def rchat_events(scope, receive, send):
+    """Event-loop version of the /rchat/events route."""
+    started = time.perf_counter()
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    client_id = _query_param(query, 'h')
+    client = scope.get('client')
+
+    wait = chat.over_limit(chat.stream_limits, client[0] if client else '', None)
+    if wait:
+        await _send_html(send, 429, 'Too many requests', chat.retry_after(wait))
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat/events')
+        return
+    fmt = _query_param(query, 'format') or 'sse'
+    error = await chat.off_loop(chat.event_stream_error, client_id, _query_param(query, 'x'), fmt)
+    if error:
+        await _send_html(send, error[1], error[0])
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat/events')
+        return
+    wait = chat.over_limit(chat.stream_limits, None, client_id)
+    if wait:
+        await _send_html(send, 429, 'Too many requests', chat.retry_after(wait))
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat/events')
+        return
+
+    if not chat.stream_gate.enter():
+        await _send_html(send, 503, 'Server busy, try again soon', chat.retry_after(5))
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat/events')
+        return
+    try:
+        await chat.off_loop(chat.register_connection, client_id, carry_over=True)
+        chat.request_latency.observe(time.perf_counter() - started, '/rchat/events')
+        transport = chat.EVENT_TRANSPORTS[fmt]
+        cursor = chat.parse_cursor(_header(scope, b'last-event-id') or _query_param(query, 'since'))
+        compressor = chat.stream_compressor(_header(scope, b'accept-encoding'))
+        chunks = chat.astream_chat_content(client_id, '', '', transport, compressor=compressor, cursor=cursor)
+        await _serve_stream(receive, send, chunks, transport.mimetype, chat.compression_headers(compressor))
+    finally:
+        chat.stream_gate.leave()
+
+
+async def rchat_poll(scope, receive, send):
+    """Event-loop version of the /rchat/poll route."""
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    client_id = _query_param(query, 'h')
+    client = scope.get('client')
+
+    wait = chat.over_limit(chat.poll_limits, client[0] if client else '', None)
+    if wait:
+        await _send_html(send, 429, 'Too many requests', chat.retry_after(wait))
+        return
+    error = await chat.off_loop(chat.event_stream_error, client_id, _query_param(query, 'x'))
+    if error:
+        await _send_html(send, error[1], error[0])
+        return
+    wait = chat.over_limit(chat.poll_limits, None, client_id)
+    if wait:
+        await _send_html(send, 429, 'Too many requests', chat.retry_after(wait))
+        return
+
+    if not chat.stream_gate.enter():
+        await _send_html(send, 503, 'Server busy, try again soon', chat.retry_after(5))
+        return
+    try:
+        poll = asyncio.ensure_future(chat.apoll_chat_events(client_id, chat.parse_cursor(_query_param(query, 'since'))))
+        watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            await asyncio.wait({poll, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            if not poll.done():
+                poll.cancel()
+            await asyncio.gather(poll, watcher, return_exceptions=True)
+        if poll.cancelled():
+            return
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'application/json')] + [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in chat.STREAM_HEADERS.items()
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': _encode(poll.result())})
+    finally:
+        chat.stream_gate.leave()
+
+
+async def room(scope, receive, send):
+    """Event-loop version of the /chat route."""
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    client = scope.get('client')
+
+    wait = chat.over_limit(chat.stream_limits, client[0] if client else '', None)
+    if wait:
+        await _send_html(send, 429, 'Too many requests', chat.retry_after(wait))
+        return
+    name = chat.room_name(_query_param(query, 'n'))
+    if name is None:
+        await _send_html(send, 200, chat.render_room_name_form())
+        return
+
+    if not chat.stream_gate.enter():
+        await _send_html(send, 503, 'Server busy, try again soon', chat.retry_after(5))
+        return
+    try:
+        await _serve_stream(receive, send, chat.astream_room_content(name))
+    finally:
+        chat.stream_gate.leave()
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            chat.start_cleanup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+# The routes served on the event loop; every other path goes to Flask
+STREAM_ROUTES = {
+    '/rchat': rchat,
+    '/rchat/events': rchat_events,
+    '/rchat/poll': rchat_poll,
+    '/chat': room,
+}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+        return
+    handler = STREAM_ROUTES.get(scope['path']) if scope['type'] == 'http' else None
+    if handler is not None:
+        if scope['method'] == 'GET':
+            await handler(scope, receive, send)
+        else:
+            # A HEAD would open a session and a stream that never ends, with no body to send it on
+            await _send_html(send, 405, '', {'Allow': 'GET'})
+        return
+    await flask_application(scope, receive, send)
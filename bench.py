@@ -0,0 +1,1023 @@
+"""Micro-benchmarks for the chat server internals.
+
+Each benchmark runs in-process, without a web server, except ``workers``,
+which starts the servers it compares:
+
+    python bench.py pairing --joins 200000 --threads 8
+    python bench.py workers --workers 8 --duration 20
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from append_log import AppendLog
+from chat_store import ChatMessage, JournaledChatStore, MemoryChatStore
+from compression import StreamCompressor
+from limits import RateLimiter
+from matchmaker import Matchmaker
+from spam import SpamFilter
+
+
+def _report(name, count, seconds, unit='ops'):
+    print(f"{name:<40} {count:>9} {unit} in {seconds:7.3f}s  = {count / seconds:>12,.0f} {unit}/s")
+
+
+def bench_pairing(args):
+    """Pairing throughput of the matchmaker and the in-memory store."""
+    # Single thread, straight through the matchmaker
+    matchmaker = Matchmaker()
+    now = time.time()
+    start = time.perf_counter()
+    for i in range(args.joins):
+        matchmaker.join(f'c{i}', now)
+    _report('Matchmaker.join, 1 thread', args.joins, time.perf_counter() - start, 'joins')
+
+    # Expiry: joins arrive so far apart that the previous user always timed out
+    matchmaker = Matchmaker(max_wait=1)
+    start = time.perf_counter()
+    for i in range(args.joins):
+        matchmaker.join(f'e{i}', now + 2 * i)
+    _report('Matchmaker.join with expiry', args.joins, time.perf_counter() - start, 'joins')
+
+    # Concurrent joins through the store; check nobody is paired twice
+    store = MemoryChatStore()
+    partners = {}
+    partners_lock = threading.Lock()
+    per_thread = args.joins // args.threads
+
+    def worker(n):
+        paired = []
+        for i in range(per_thread):
+            client_id = f't{n}-{i}'
+            partner_id = store.find_partner(client_id, now)
+            if partner_id is not None:
+                paired.append((client_id, partner_id))
+        with partners_lock:
+            for client_id, partner_id in paired:
+                for cid in (client_id, partner_id):
+                    partners[cid] = partners.get(cid, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    _report(f'MemoryChatStore.find_partner, {args.threads} threads', per_thread * args.threads, elapsed, 'joins')
+    double = sum(1 for count in partners.values() if count > 1)
+    print(f"  paired clients: {len(partners)}, still waiting: {len(store.pending_users)}, paired twice: {double}")
+
+
+def _measure(build):
+    tracemalloc.start()
+    keep = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del keep
+    return size
+
+
+def bench_history(args):
+    """Memory held by chat history: per-client dict lists vs. shared ring logs."""
+    chats, per_chat = args.chats, args.messages
+    texts = [f'message number {i} with some typical chat text' for i in range(per_chat)]
+
+    def legacy():
+        # The previous layout: one list per client, one dict per message per side
+        chat_messages = {}
+        for n in range(chats):
+            a, b = f'a{n}', f'b{n}'
+            chat_messages[a], chat_messages[b] = [], []
+            for i, text in enumerate(texts):
+                sender, partner = (a, b) if i % 2 else (b, a)
+                chat_messages[sender].append({'time': '12:34', 'sender': 'You', 'message': text, 'is_system': False})
+                chat_messages[partner].append({'time': '12:34', 'sender': 'Random', 'message': text, 'is_system': False})
+        return chat_messages
+
+    def shared(limit):
+        def build():
+            store = MemoryChatStore(max_history=limit)
+            for n in range(chats):
+                a, b = f'a{n}', f'b{n}'
+                store.find_partner(a, 0)
+                store.find_partner(b, 0)
+                for i, text in enumerate(texts):
+                    store.append_message(a, ChatMessage('12:34', text, sender=a if i % 2 else b))
+            return store
+        return build
+
+    # Message texts are shared by both layouts, so they are not counted
+    baseline = _measure(legacy)
+    print(f"{'per-client dict lists':<40} {baseline / chats:>10,.0f} bytes/chat")
+    for limit in (per_chat, per_chat // 4):
+        size = _measure(shared(limit))
+        print(f"{f'shared ChatLog, limit {limit}':<40} {size / chats:>10,.0f} bytes/chat  ({baseline / size:.1f}x smaller)")
+
+
+def _rate(name, func, count):
+    func()
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    _report(name, count, time.perf_counter() - start, 'req')
+
+
+def bench_pages(args):
+    """Rendering cost of the /rchat page shells."""
+    import app
+
+    client = app.app.test_client()
+    with app.app.test_request_context('/rchat'):
+        client_id, start_time, _, token = app.initialize_chat_session('', '', '', '')
+    count = args.requests
+    _rate('render_chat_page', lambda: app.render_chat_page(client_id, start_time, token), count)
+    _rate('render_input_form', lambda: app.render_input_form(token), count)
+    _rate('GET /rchat/input (test client)',
+          lambda: client.get(f'/rchat/input?h={client_id}&t={start_time}&x={token}'), count // 4)
+
+
+def bench_soak(args):
+    """Session churn on a simulated clock: state must stay flat as clients come and go."""
+    import app
+
+    rng = random.Random(1)
+    store = app.store
+    due = []  # Heap of (next message at, client_id, leaves at)
+    now = 0.0
+    tracemalloc.start()
+    cleanup_time, cleanup_runs, evicted = 0.0, 0, 0
+    print(f"{'hour':>4} {'sessions':>9} {'tokens':>7} {'logs':>6} {'streams':>8}"
+          f" {'memory':>9} {'cleanup/run':>12}")
+    for second in range(args.hours * 3600):
+        now = float(second)
+        for n in range(args.arrivals):
+            # A new page load: token, lock and stream registration, then pairing
+            client_id = f's{second}-{n}'
+            store.set_token(client_id, app.generate_submission_token())
+            app.register_connection(client_id)
+            store.touch(client_id, now)
+            store.find_partner(client_id, now)
+            heapq.heappush(due, (now + rng.uniform(5, 60), client_id, now + rng.uniform(60, 900)))
+        while due and due[0][0] <= now:
+            _, client_id, leaves_at = heapq.heappop(due)
+            store.append_message(client_id, ChatMessage('12:34', 'hello there', sender=client_id))
+            store.touch(client_id, now)
+            if now < leaves_at:
+                heapq.heappush(due, (now + rng.uniform(5, 60), client_id, leaves_at))
+        if second % app.CLEANUP_INTERVAL == 0:
+            start = time.perf_counter()
+            evicted += app.cleanup_inactive_chats(now)
+            cleanup_time += time.perf_counter() - start
+            cleanup_runs += 1
+        if (second + 1) % 3600 == 0:
+            size, _ = tracemalloc.get_traced_memory()
+            print(f"{(second + 1) // 3600:>4} {len(store.last_seen):>9} {len(store.client_tokens):>7}"
+                  f" {len(store.chat_messages):>6} {len(app.active_connections):>8}"
+                  f" {size / 1e6:>7.1f}MB {cleanup_time / cleanup_runs * 1e3:>10.3f}ms")
+            cleanup_time, cleanup_runs = 0.0, 0
+    tracemalloc.stop()
+    print(f"  clients: {args.hours * 3600 * args.arrivals}, evicted: {evicted}")
+
+
+def _session_run(app, threads, per_thread, messages):
+    """Run new sessions, messages and evictions from several threads at once."""
+    app.store = MemoryChatStore(max_history=10 ** 9)
+    app.store.set_local_delivery(app.deliver_local_update)
+    app.active_connections.clear()
+    clients, kept_logs = [], []  # Logs of evicted clients, to count their messages
+    sent = [0] * threads
+
+    def worker(n):
+        for i in range(per_thread):
+            client_id, _, _, _ = app.initialize_chat_session('', '', '', '', client_ip='127.0.0.1')
+            clients.append(client_id)
+            for m in range(messages):
+                app.send_message(client_id, f'message {m}')
+                sent[n] += 1
+            if i % 10 == 9:
+                # Leave mid-chat: the partner's next send runs check_partner_left
+                kept_logs.append(app.store.chat_messages.get(client_id))
+                app.clear_client_session(client_id)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    store = app.store
+    logs = {id(log): log for log in kept_logs + list(store.chat_messages.values()) if log is not None}
+    records = {id(record): record for log in logs.values() for record in log.records
+               if not record.is_system}
+    misordered = sum(1 for log in logs.values() if log.records and
+                     [r.seq for r in log.records] != list(range(log.records[0].seq, log.records[-1].seq + 1)))
+    double = sum(1 for client_id, chat in list(store.active_chats.items())
+                 if store.is_active(chat['partner_id']) and store.get_partner(chat['partner_id']) != client_id)
+    return elapsed, sum(sent), len(records), misordered, double
+
+
+class _TimedLock:
+    """A reentrant lock that counts its acquisitions, and how many had to wait and for how long.
+
+    The counts are only changed while the lock is held, so they need no
+    lock of their own.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.acquired = self.contended = 0
+        self.waited = 0.0
+
+    def __enter__(self):
+        if not self._lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self._lock.acquire()
+            self.waited += time.perf_counter() - start
+            self.contended += 1
+        self.acquired += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+
+class _TimedSessionLocks:
+    """app.SessionLocks made of _TimedLocks; one stripe is the old global chat lock."""
+
+    def __init__(self, stripes):
+        self.locks = [_TimedLock() for _ in range(stripes)]
+
+    def __call__(self, client_id):
+        return self.locks[hash(client_id) % len(self.locks)]
+
+
+def bench_sessions(args):
+    """Contention on the session locks: pairing, sends and evictions from many threads.
+
+    Besides throughput, reports how often taking a client's lock found it
+    held by another thread and the time spent waiting for it. Under the
+    GIL the threads take turns anyway, so throughput hardly depends on the
+    stripes; the lock wait shows what striping removes.
+    """
+    import app
+
+    per_thread = args.chats // args.threads
+    default_locks = app.session_locks
+    try:
+        for stripes in (1, app.SESSION_LOCK_STRIPES):
+            for threads in sorted({1, args.threads}):
+                app.session_locks = locks = _TimedSessionLocks(stripes)
+                elapsed, sent, stored, misordered, double = _session_run(
+                    app, threads, per_thread * args.threads // threads, args.messages // 20)
+                _report(f'{stripes} lock stripe(s), {threads} thread(s)', sent, elapsed, 'msgs')
+                acquired = sum(lock.acquired for lock in locks.locks)
+                contended = sum(lock.contended for lock in locks.locks)
+                waited = sum(lock.waited for lock in locks.locks)
+                print(f"  lock taken {acquired} times, {100 * contended / acquired:.1f}% had to wait,"
+                      f" {waited:.3f}s waiting in all ({100 * waited / (elapsed * threads):.0f}% of thread time)")
+                print(f"  messages lost: {sent - stored}, logs out of order: {misordered},"
+                      f" clients paired twice: {double}")
+    finally:
+        app.session_locks = default_locks
+
+
+class _OpenPerPost:
+    """The old /contact/ writer: open, append and close the file on every post."""
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+
+    def write(self, record):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(record)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _bench_feedback_writer(tmp, name, make, worker, count, threads):
+    path = os.path.join(tmp, 'feedback.txt')
+    for old in os.listdir(tmp):
+        os.remove(os.path.join(tmp, old))
+    log = make(path)
+    workers = [threading.Thread(target=worker, args=(log,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    accepted = time.perf_counter() - start
+    log.flush()
+    durable = time.perf_counter() - start
+    log.close()
+    # What the posting threads wait for, then until the last record is on disk
+    # (fsynced for AppendLog and the fsync writer, in the page cache otherwise)
+    _report(name, count * threads, accepted, 'posts')
+    with open(path, encoding='utf-8') as f:
+        written = f.read().count('\n---\n')
+    print(f"  all on disk after {durable:.3f}s = {count * threads / durable:,.0f} posts/s;"
+          f" records on disk: {written}, written synchronously: {getattr(log, 'sync_writes', 0)}")
+
+
+def bench_contact(args):
+    """/contact/ POST throughput with the old per-post file writes vs. AppendLog."""
+    import app
+
+    per_thread = args.requests // 4 // args.threads
+    writers = [
+        ('open/write/close per post', _OpenPerPost),
+        ('open/write/fsync/close per post', lambda path: _OpenPerPost(path, fsync=True)),
+        ('AppendLog', AppendLog),
+        ('AppendLog, flushed within 5 ms', lambda path: AppendLog(path, flush_interval=0.005)),
+        ('AppendLog, queue of 16 (sync fallback)', lambda path: AppendLog(path, max_queue=16)),
+    ]
+
+    def through_route(log):
+        app.feedback_log = log
+        client = app.app.test_client()
+        for i in range(per_thread):
+            client.post('/contact/', data={'message': f'feedback number {i}'})
+
+    def direct(log):
+        for i in range(per_thread * 4):
+            log.write(f'Message: feedback number {i}\n---\n')
+
+    default_log = app.feedback_log
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for label, worker, count in (('POST /contact/', through_route, per_thread),
+                                         ('writer only', direct, per_thread * 4)):
+                for name, make in writers:
+                    _bench_feedback_writer(tmp, f'{label}, {name}', make, worker, count, args.threads)
+    finally:
+        app.feedback_log = default_log
+
+
+def bench_spam(args):
+    """SpamFilter cost per message, and its memory after many distinct clients."""
+    count = args.joins
+    texts = [f'message number {i} with some typical chat text' for i in range(count)]
+    for clients in (1000, count):
+        def run():
+            spam = SpamFilter(max_clients=10000)
+            for i in range(count):
+                spam.check(f'c{i % clients}', texts[i], i * 0.001)
+            return spam
+        start = time.perf_counter()
+        spam = run()
+        elapsed = time.perf_counter() - start
+        _report(f'SpamFilter.check, {clients} clients', count, elapsed, 'msgs')
+        print(f"  ghosted: {spam.ghosted}, clients kept: {len(spam._last)}, memory: {_measure(run) / 1e6:.1f}MB")
+
+    # A flood: many clients sending one text among normal chatter
+    spam = SpamFilter()
+    flood = 'Join the VIP chat, pay 8 dollars to this btc address'
+    hidden = sum(spam.check(f'f{i}', flood if i % 2 else texts[i], i * 0.01) for i in range(2000))
+    print(f"  flood: {hidden} of 1000 copies ghosted, lockdowns: {spam.lockdowns}")
+
+    # The same text from a handful of chatty senders is not a flood
+    spam = SpamFilter()
+    hidden = sum(spam.check(f'f{i % 10}', flood if i % 20 < 10 else texts[i], i * 0.01) for i in range(2000))
+    print(f"  10 senders repeating it: {hidden} of 1000 copies ghosted, lockdowns: {spam.lockdowns}")
+
+
+def bench_chatters(args):
+    """SlidingUniqueCounter ("chatters in the last hour"): add rate, count cost, memory and error."""
+    import app
+
+    # An hour of 1M requests from 150k addresses, the busiest case it is meant for
+    requests, distinct = 1000000, 150000
+    rng = random.Random(1)
+    keys = [f'10.{i >> 16}.{(i >> 8) & 255}.{i & 255}' for i in range(distinct)]
+    arrivals = [keys[i] if i < distinct else rng.choice(keys) for i in range(requests)]
+    counter = app.SlidingUniqueCounter()
+    start = time.perf_counter()
+    for i, key in enumerate(arrivals):
+        counter.add(key, i * 3600 / requests)
+    _report('add, 1M requests/hour', requests, time.perf_counter() - start, 'adds')
+    print(f"  needed: {requests / 3600:,.0f} adds/s")
+    estimate = counter.count(3599)
+    print(f"  {distinct} distinct: estimate {estimate}, error {100 * (estimate - distinct) / distinct:+.2f}%")
+    _rate('count, fresh merge', lambda: (setattr(counter, '_merged', None), counter.count(3599)), 20)
+    _rate('count, merged', lambda: counter.count(3599), 200)
+    print(f"  memory: {sum(len(registers) for _, registers in counter._buckets) / 1024:.0f} KiB")
+
+    # Error over independent key sets: its bias and spread (1.6% is the
+    # standard error HyperLogLog promises at this precision)
+    for distinct in (1000, 10000, 50000):
+        errors = []
+        for run in range(20):
+            counter = app.SlidingUniqueCounter()
+            for i in range(distinct):
+                counter.add(f'run{run}-{i}', i * 3600 / distinct)
+            errors.append(100 * (counter.count(3599) - distinct) / distinct)
+        mean = sum(errors) / len(errors)
+        spread = (sum((error - mean) ** 2 for error in errors) / len(errors)) ** 0.5
+        print(f"  {distinct:>6} distinct, 20 runs: mean error {mean:+.2f}%, standard deviation {spread:.2f}%,"
+              f" worst {max(errors, key=abs):+.2f}%")
+
+
+def bench_limits(args):
+    """RateLimiter cost and table size, and how cheap a refused request is."""
+    import app
+
+    count = args.joins
+    for keys in (1000, count):
+        def run():
+            limiter = RateLimiter(2, 10)
+            for i in range(count):
+                limiter.hit(f'c{i % keys}', i * 0.0001)
+            return limiter
+        start = time.perf_counter()
+        limiter = run()
+        elapsed = time.perf_counter() - start
+        _report(f'RateLimiter.hit, {keys} keys', count, elapsed, 'hits')
+        print(f"  refused: {limiter.rejected}, keys kept: {len(limiter)}, memory: {_measure(run) / 1e6:.1f}MB")
+
+    # Exhaust this client's limits, then time the 429s
+    default_limits = app.stream_limits, app.send_limits
+    try:
+        app.stream_limits = (RateLimiter(0.001, 1), RateLimiter(0.001, 1))
+        app.send_limits = (RateLimiter(0.001, 1), RateLimiter(0.001, 1))
+        client = app.app.test_client()
+        with app.app.test_request_context('/rchat'):
+            client_id, start_time, _, token = app.initialize_chat_session('', '', '', '')
+        client.get(f'/rchat?x={app.generate_submission_token()}')
+        requests = args.requests // 4
+        _rate('GET /rchat, over the limit (429)', lambda: client.get('/rchat'), requests)
+        _rate('POST /rchat/send, over the limit (429)',
+              lambda: client.post('/rchat/send', json={'h': client_id, 'x': token, 'm': 'hi'}), requests)
+        print(f"  refused: {sum(limit.rejected for limit in app.stream_limits + app.send_limits)}")
+    finally:
+        app.stream_limits, app.send_limits = default_limits
+
+
+def bench_queues(args):
+    """UpdateQueue put cost, and the memory a reader that stopped reading can hold."""
+    import app
+
+    count = args.joins
+    update = {'type': 'message', 'from': 'Random', 'time': '12:00', 'text': 'x' * 400}
+    updates = app.UpdateQueue()
+    start = time.perf_counter()
+    for i in range(count):
+        updates.put(update)
+        if i % 16 == 15:
+            updates.drain()
+    _report('UpdateQueue.put, drained every 16', count, time.perf_counter() - start, 'puts')
+
+    for label, make in (('unbounded', lambda: app.UpdateQueue(max_items=float('inf'), max_age=float('inf'))),
+                        ('bounded', app.UpdateQueue)):
+        def run():
+            stalled = make()
+            for i in range(count):
+                if not stalled.put({**update, 'text': f'{i}{update["text"]}'}):
+                    break
+            return stalled
+        stalled = run()
+        print(f"  {label}: {stalled.qsize()} updates held after {count} puts, stalled: {stalled.stalled}, "
+              f"memory: {_measure(run) / 1e6:.1f}MB")
+
+
+def _chunked(chunk):
+    # Size of a chunk with HTTP/1.1 chunked framing
+    size = len(chunk.encode('utf-8'))
+    return len(f'{size:x}\r\n\r\n') + size
+
+
+def bench_transport(args):
+    """Bytes on the wire per message and per idle minute, HTML stream vs. /rchat/events."""
+    import app
+
+    events = [
+        ('message', {'type': 'message', 'from': 'Random', 'time': '12:34', 'text': 'hey, how are you doing?'}),
+        ('system', {'type': 'system', 'text': 'A random was found, say hi!'}),
+        ('partner left', {'type': 'left'}),
+        ('search progress', {'type': 'search', 'text': app.get_searching_message(9)}),
+    ]
+    transports = [('html', app.HTML_TRANSPORT)] + sorted(app.EVENT_TRANSPORTS.items())
+    print(f"  {'bytes per event':<22}" + ''.join(f'{name:>10}' for name, _ in transports))
+    for label, event in events:
+        print(f"  {label:<22}" + ''.join(f'{_chunked(transport.render(event)):>10}' for _, transport in transports))
+
+    # One keepalive chunk per keepalive_every ticks of one second; each is also a write (a Tor cell)
+    print(f"  {'idle minute, bytes':<22}" + ''.join(
+        f'{sum(_chunked(t.keepalive(tick)) for tick in range(1, 61) if tick % t.keepalive_every == 0):>10}'
+        for _, t in transports))
+    print(f"  {'idle minute, writes':<22}" + ''.join(f'{60 // t.keepalive_every:>10}' for _, t in transports))
+
+
+def bench_compression(args):
+    """Bandwidth saved vs. CPU and memory per compressed chat stream."""
+    import app
+
+    with app.app.test_request_context('/rchat'):
+        client_id, start_time, _, token = app.initialize_chat_session('', '', '', '')
+    page = app.render_chat_page(client_id, start_time, token)
+    rng = random.Random(1)
+    words = 'hi hello how are you doing fine thanks where from lol ok cool what is your name m f music'.split()
+    # A chat: every third second a message, a keepalive otherwise
+    seconds = args.messages * 3
+    events = [{'type': 'message', 'from': rng.choice(['You', 'Random']), 'time': f'12:{i % 60:02d}',
+               'text': ' '.join(rng.choice(words) for _ in range(rng.randint(2, 12)))} if i % 3 == 0 else None
+              for i in range(seconds)]
+    settings = [('default', {}), ('level 1', {'level': 1}), ('zlib defaults', {'window_bits': 15, 'mem_level': 8})]
+    for name, transport in [('html', app.HTML_TRANSPORT), ('sse', app.EVENT_TRANSPORTS['sse'])]:
+        for label, kwargs in settings:
+            compressor = StreamCompressor('gzip', **kwargs)
+            start = time.perf_counter()
+            if transport is app.HTML_TRANSPORT:
+                compressor.compress(page, reset=True)
+            for tick, event in enumerate(events, 1):
+                if event is not None:
+                    compressor.compress(transport.render(event))
+                elif tick % transport.keepalive_every == 0:
+                    compressor.compress(transport.keepalive(tick))
+            elapsed = time.perf_counter() - start
+            def streams():
+                compressors = [StreamCompressor('gzip', **kwargs) for _ in range(100)]
+                for each in compressors:
+                    each.compress(page)
+                return compressors
+            memory = _measure(streams) / 100
+            print(f"{name}, {label:<14} {compressor.raw_bytes:>8} -> {compressor.compressed_bytes:>7} bytes "
+                  f"({compressor.compressed_bytes / compressor.raw_bytes:6.1%}), "
+                  f"CPU {elapsed / seconds * 1e6:5.1f}us per stream-second, {memory / 1024:4.0f} KiB per stream")
+
+
+def bench_broadcast(args):
+    """Fan-out of public room messages: one shared ring log vs. a copy per subscriber."""
+    import asyncio
+
+    import app
+    from room import Room
+
+    count = args.messages
+    texts = [f'message number {i} with some typical chat text' for i in range(count)]
+    print(f"{'subscribers':>11} {'room, per message':>18} {'renders':>8} {'copies, per message':>20} {'renders':>8}")
+    for subscribers in (1, 100, 1000, 5000):
+        room = Room(count)
+        cursors = [0] * subscribers
+        start = time.perf_counter()
+        for text in texts:
+            room.post(app.render_room_line('12:34', 'name', text))
+            for n in range(subscribers):
+                cursors[n], _ = room.read(cursors[n], n)
+        shared = (time.perf_counter() - start) / count
+
+        # The 1:1 way: every subscriber gets the event on its queue and renders it itself
+        queues = [app.UpdateQueue() for _ in range(subscribers)]
+        start = time.perf_counter()
+        for text in texts:
+            event = {'type': 'message', 'from': 'Random', 'time': '12:34', 'text': text}
+            for updates in queues:
+                updates.put(event)
+            for updates in queues:
+                [app.render_update_html(each).encode('utf-8') for each in updates.drain()]
+        copies = (time.perf_counter() - start) / count
+        print(f"{subscribers:>11} {shared * 1e6:>15,.0f}us {1:>8} {copies * 1e6:>17,.0f}us {subscribers:>8}")
+
+    # Wakeup latency on one event loop, as under asgi.py: post to every subscriber's next read
+    subscribers = 5000
+    room = Room(count)
+
+    async def main():
+        done = asyncio.Event()
+        remaining = [subscribers]
+
+        async def subscriber(n):
+            cursor = 0
+            while cursor < count:
+                await room.wait_async(cursor)
+                cursor, _ = room.read(cursor, n)
+                if cursor == room.seq:
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        done.set()
+
+        tasks = [asyncio.ensure_future(subscriber(n)) for n in range(subscribers)]
+        await asyncio.sleep(0.1)
+        latencies = []
+        for text in texts:
+            remaining[0] = subscribers
+            done.clear()
+            start = time.perf_counter()
+            await asyncio.get_running_loop().run_in_executor(None, room.post, app.render_room_line('12:34', 'n', text))
+            await done.wait()
+            latencies.append(time.perf_counter() - start)
+        await asyncio.gather(*tasks)
+        return sorted(latencies)
+
+    latencies = asyncio.run(main())
+    print(f"post from a thread to all {subscribers} coroutines read: "
+          f"p50 {latencies[len(latencies) // 2] * 1e3:.1f}ms, max {latencies[-1] * 1e3:.1f}ms")
+
+
+def bench_resume(args):
+    """Reconnecting with a cursor vs. re-rendering the page, in a full chat."""
+    import app
+
+    with app.app.test_request_context('/rchat'):
+        client_id, start_time, _, token = app.initialize_chat_session('', '', '', '')
+        partner_id, _, _, _ = app.initialize_chat_session('', '', '', '')
+    for i in range(app.MAX_HISTORY):
+        app.add_message(client_id if i % 2 else partner_id, f'message number {i} with some typical chat text')
+    log_id, records = app.store.get_log(client_id)
+    sse = app.EVENT_TRANSPORTS['sse']
+    count = args.requests // 10
+
+    page = app.render_chat_page(client_id, start_time, token)
+    _rate('page reload (store.get_log + page)', lambda: app.render_chat_page(client_id, start_time, token), count)
+    print(f"  {len(page):>8} bytes")
+    for missed in (0, 5, 50):
+        cursor = app.history_cursor(log_id, records[:len(records) - missed])
+        resume = lambda: ''.join(sse.render(event) for event in app.replay_events(client_id, list(cursor))[1])
+        _rate(f'resume, {missed} missed (replay + SSE)', resume, count)
+        print(f"  {len(resume().encode('utf-8')):>8} bytes")
+
+
+def bench_tracing(args):
+    """Cost of message tracing (tracing.py) per message, off and sampling every message."""
+    import app
+    from tracing import MessageTracer
+
+    with app.app.test_request_context('/rchat'):
+        client_id, _, _, _ = app.initialize_chat_session('', '', '', '')
+        partner_id, _, _, _ = app.initialize_chat_session('', '', '', '')
+    streams = [(viewer, app.register_connection(viewer)) for viewer in (client_id, partner_id)]
+    clock = {'tick': 0, 'next_tick': time.monotonic() + 3600}  # No keepalive ticks
+    default_tracer, default_filter = app.tracer, app.spam_filter
+    # Nothing gets ghosted, so every message reaches both streams
+    app.spam_filter = SpamFilter(flood_threshold=10 ** 9, lockdown_threshold=10 ** 9)
+    try:
+        for name, sample_rate in (('off', 0.0), ('all', 1.0)):
+            app.tracer = MessageTracer(sample_rate)
+            count = args.messages * 50
+
+            def deliver(number=iter(range(10 ** 9))):
+                app.send_message(client_id, f'message number {next(number)}', app.tracer.start())
+                for viewer, updates in streams:
+                    app.collect_stream_updates(updates, clock)
+            _rate(f'send + 2 streams, tracing {name}', deliver, count)
+    finally:
+        app.tracer, app.spam_filter = default_tracer, default_filter
+        for viewer, updates in streams:
+            app.release_connection(viewer, updates)
+
+
+def bench_fragments(args):
+    """CPU per message to render it for both streams and for page loads of the history."""
+    import app
+
+    with app.app.test_request_context('/rchat'):
+        client_id, _, _, _ = app.initialize_chat_session('', '', '', '')
+        partner_id, _, _, _ = app.initialize_chat_session('', '', '', '')
+    clock = {'tick': 0, 'next_tick': time.monotonic() + 3600}  # No keepalive ticks
+    default_filter = app.spam_filter
+    app.spam_filter = SpamFilter(flood_threshold=10 ** 9, lockdown_threshold=10 ** 9)
+    try:
+        for name, transport in (('HTML', app.HTML_TRANSPORT), ('SSE', app.EVENT_TRANSPORTS['sse'])):
+            streams = [(viewer, app.register_connection(viewer)) for viewer in (client_id, partner_id)]
+
+            def deliver(number=iter(range(10 ** 9))):
+                app.send_message(client_id, f'message <number> {next(number)} & "some" typical chat text')
+                for viewer, updates in streams:
+                    app.collect_stream_updates(updates, clock, transport)
+            _rate(f'send + 2 {name} streams', deliver, args.messages * 50)
+            for viewer, updates in streams:
+                app.release_connection(viewer, updates)
+    finally:
+        app.spam_filter = default_filter
+    # Page reloads, with the fragments the streams rendered and from scratch
+    count = args.requests // 10
+    records = app.store.get_log(partner_id)[1]
+    for name, cold in (('cached', False), ('rendered again', True)):
+        elapsed = 0.0
+        for _ in range(count):
+            if cold:
+                for record in records:
+                    record.fragments = None
+            start = time.perf_counter()
+            app.get_message_html(partner_id, records)
+            elapsed += time.perf_counter() - start
+        _report(f'history of {len(records)} messages, {name}', count, elapsed, 'pages')
+        print(f"  {elapsed / count / len(records) * 1e6:.2f} us per message")
+
+
+def _directory_bytes(path):
+    total = 0
+    for name in os.listdir(path):
+        try:
+            total += os.path.getsize(os.path.join(path, name))
+        except FileNotFoundError:
+            pass  # Deleted by a compaction meanwhile
+    return total
+
+
+def bench_recovery(args):
+    """Restart time of the journaled store, from the journal alone vs. from a snapshot."""
+    sessions = args.joins
+    with tempfile.TemporaryDirectory() as tmp:
+        store = JournaledChatStore(tmp, max_journal_bytes=1 << 40)
+        now = time.time()
+        start = time.perf_counter()
+        # Sessions come and go: twice as many have lived as are left at the end
+        for i in range(sessions * 2):
+            client_id = f'client-{i}'
+            store.set_token(client_id, f'token-{i}')
+            store.find_partner(client_id, now)
+            for n in range(4):
+                store.append_message(client_id, ChatMessage('12:00', f'message number {n}', sender=client_id))
+            if i % 4 == 1:
+                # Every other pair has left again
+                store.remove_client(client_id)
+                store.remove_client(f'client-{i - 1}')
+        store.journal.flush()
+        _report('journaled changes', sessions * 2, time.perf_counter() - start, 'sessions')
+        live = len(store.client_tokens)
+        print(f"  {live} sessions live, journal {_directory_bytes(tmp) / 1e6:.1f} MB")
+
+        restored = JournaledChatStore(tmp, max_journal_bytes=1 << 40)
+        print(f"{'recovery from the journal alone':<40} {restored.recovery_seconds:7.3f}s")
+        restored.journal.close()
+        start = time.perf_counter()
+        store.journal.compact()
+        print(f"{'writing a snapshot':<40} {time.perf_counter() - start:7.3f}s")
+        store.journal.close()
+        print(f"  snapshot {_directory_bytes(tmp) / 1e6:.1f} MB")
+        restored = JournaledChatStore(tmp, max_journal_bytes=1 << 40)
+        print(f"{'recovery from the snapshot':<40} {restored.recovery_seconds:7.3f}s")
+        assert len(restored.client_tokens) == live
+        restored.journal.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Churn over a small state against a small bound: compactions keep
+        # the files at about one snapshot plus max_journal_bytes, twice that
+        # at the peak while a snapshot is written
+        bound = 1024 * 1024
+        store = JournaledChatStore(tmp, max_history=20, max_journal_bytes=bound)
+        largest = 0
+        for i in range(sessions):
+            client_id = f'client-{i % 1000}'
+            store.set_token(client_id, f'token-{i}')
+            store.append_message(client_id, ChatMessage('12:00', f'message number {i}', sender=client_id))
+            if i % 1000 == 0:
+                largest = max(largest, _directory_bytes(tmp))
+        store.journal.flush()
+        print(f"churn of {sessions} messages over 1000 sessions, bound {bound / 1e6:.1f} MB:"
+              f" {store.journal.compactions} snapshots, at most {largest / 1e6:.1f} MB on disk")
+        store.journal.close()
+
+
+def bench_redis(args):
+    """RedisChatStore against fakeredis (or ``--redis-url``): correctness checks, then its cost per chat."""
+    from chat_store import RedisChatStore
+
+    if args.redis_url:
+        import redis
+        server = lambda: redis.Redis.from_url(args.redis_url, decode_responses=True)
+    else:
+        try:
+            import fakeredis
+        except ImportError:
+            print("needs fakeredis (pip install fakeredis) or --redis-url; skipped")
+            return
+        shared = fakeredis.FakeServer()
+        server = lambda: fakeredis.FakeRedis(server=shared, decode_responses=True)
+    prefix = f'bench-{os.getpid()}:'  # Keeps clear of real keys on a real server
+    store = RedisChatStore(server(), prefix=prefix)
+    other = RedisChatStore(server(), prefix=prefix)  # A second worker
+    store.worker, other.worker = 'worker-1', 'worker-2'
+    now = time.time()
+
+    def check(name, condition):
+        print(f"  {'ok' if condition else 'FAILED'}: {name}")
+        if not condition:
+            raise SystemExit(1)
+
+    store.set_token('a', 'token-a')
+    check('token round-trip', store.get_token('a') == 'token-a' and other.token_owner('token-a') == 'a')
+    store.set_token('a', 'token-a2')
+    check('a new token replaces the old one', other.token_owner('token-a') is None and other.is_token_issued('token-a2'))
+
+    store.set_token('b', 'token-b')
+    first = store.find_partner('a', now)
+    second = other.find_partner('b', now + 1)
+    check('pairing', first is None and second == 'a' and store.get_partner('a') == 'b' and other.get_partner('b') == 'a')
+
+    store.append_message('a', ChatMessage('12:00', 'hello', sender='a'))
+    other.append_message('b', ChatMessage('12:00', 'hi there', sender='b'))
+    other.append_message('b', ChatMessage('12:01', 'only b sees this', audience='b'))
+    log_a, records_a = store.get_log('a')
+    log_b, records_b = other.get_log('b')
+    check('both sides share one log', log_a == log_b and [r.text for r in records_a] == ['hello', 'hi there']
+          and [r.text for r in records_b] == ['hello', 'hi there', 'only b sees this'])
+    _, after = other.get_log('b', (log_b, records_b[0].seq))
+    _, stale = other.get_log('b', ('another-log', records_b[0].seq))
+    check('cursor: only the newer records, all of them for another log',
+          [r.text for r in after] == ['hi there', 'only b sees this'] and len(stale) == 3)
+
+    keys = [store._key('token', 'a'), store._key('owner', 'token-a2'), store._key('chat', 'a'),
+            store._key('log', 'a'), store._key('messages', log_a), store._key('seq', log_a)]
+    client = server()
+    for key in keys:
+        client.expire(key, 5)
+    store.touch('a', now + 2)
+    ttls = [client.ttl(key) for key in keys]
+    check('touch refreshes every key of the session', all(ttl > 5 for ttl in ttls))
+    check('idle sessions are handed out once, to one worker',
+          sorted(store.expire_sessions(now + 10)) == ['a', 'b'] and other.expire_sessions(now + 10) == [])
+
+    received = []
+    other.set_local_delivery(lambda client_id, update: received.append((client_id, update)) or True)
+    own = []  # Every delivery tried in the first worker; it has no stream for 'b'
+    store.set_local_delivery(lambda client_id, update: own.append(client_id) and False)
+    published = 0
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        store.publish('b', {'type': 'system', 'text': 'over pub/sub'})
+        published += 1
+        time.sleep(0.1)
+    check('pub/sub delivery to the other worker', received and received[0] == ('b', {'type': 'system',
+                                                                                    'text': 'over pub/sub'}))
+    time.sleep(1.5)  # Long enough for an echo to come back
+    check('a worker skips its own broadcasts', len(own) == published)
+
+    # Cost per chat: two sessions, a pairing, a few messages and their page loads
+    count = args.chats // 4
+    start = time.perf_counter()
+    for i in range(count):
+        a, b = f'x{i}', f'y{i}'
+        store.set_token(a, f'ta{i}')
+        store.set_token(b, f'tb{i}')
+        store.find_partner(a, now)
+        store.find_partner(b, now)
+        for n in range(5):
+            store.append_message(a if n % 2 else b, ChatMessage('12:00', f'message {n}', sender=a if n % 2 else b))
+        store.get_log(a)
+        store.touch(a, now)
+        store.remove_client(a)
+        store.remove_client(b)
+    _report('RedisChatStore, whole chats', count, time.perf_counter() - start, 'chats')
+    client.delete(*client.keys(prefix + '*'))
+
+
+async def _chat_session(host, port, messages, give_up):
+    """One short chat over HTTP: open a stream, wait for a partner, send and leave.
+
+    Returns the number of requests it completed, 0 if it got no partner
+    before ``give_up`` (a perf_counter time).
+    """
+    from loadtest import CREDENTIALS, FOUND
+
+    reader, writer = await asyncio.open_connection(host, port)
+    sender = None
+    try:
+        writer.write(f'GET /rchat HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+        page, credentials = '', None
+        # Search frames keep coming while it waits, so the wait is bounded as a whole
+        while credentials is None or FOUND not in page:
+            data = await asyncio.wait_for(reader.read(65536), give_up - time.perf_counter())
+            if not data:
+                return 0
+            page += data.decode('utf-8', 'replace')
+            credentials = credentials or CREDENTIALS.search(page)
+        client_id, _, token = credentials.groups()
+        for number in range(messages):
+            if sender is None:
+                sender_reader, sender = await asyncio.open_connection(host, port)
+            body = json.dumps({'h': client_id, 'x': token, 'm': f'message number {number}'}).encode()
+            sender.write((f'POST /rchat/send HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                          f'Content-Length: {len(body)}\r\n\r\n').encode() + body)
+            head = (await sender_reader.readuntil(b'\r\n\r\n')).decode('latin-1').lower()
+            length = re.search(r'content-length: *(\d+)', head)
+            await sender_reader.readexactly(int(length[1]) if length else 0)
+            if 'connection: close' in head:
+                sender.close()
+                sender = None
+        return 1 + messages
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return 0
+    finally:
+        writer.close()
+        if sender is not None:
+            sender.close()
+
+
+def _chat_churn(host, port, duration, concurrency, messages):
+    """Run ``concurrency`` chatters back to back for ``duration`` seconds; returns (chats, requests)."""
+    async def chatter(deadline, totals):
+        while time.perf_counter() < deadline:
+            # The last chatters to start may find nobody left to pair with
+            requests = await _chat_session(host, port, messages, deadline + 1)
+            totals[0] += requests > 0
+            totals[1] += requests
+
+    async def run():
+        totals = [0, 0]
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(chatter(deadline, totals) for _ in range(concurrency)))
+        return totals
+    return asyncio.run(run())
+
+
+def bench_workers(args):
+    """Chat throughput of one process vs. workers.py with 1..N workers, over HTTP."""
+    from loadtest import SERVERS, _free_port, _wait_for_port
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    counts = sorted({1, args.workers} | {2 ** power for power in range(1, args.workers.bit_length())})
+    servers = [('app.py, one process', SERVERS['wsgi'])]
+    for count in counts:
+        servers.append((f'workers.py, {count} worker(s)', lambda port, count=count: [
+            sys.executable, os.path.join(here, 'workers.py'), '--workers', str(count),
+            '--host', '127.0.0.1', '--port', str(port)]))
+    # Every chatter comes from 127.0.0.1 and every chat is two new sessions;
+    # per-IP and new-session limits would only measure themselves
+    env = {**os.environ, 'RATE_LIMIT_BY_IP': '0', 'NEW_SESSION_RATE': '100000'}
+    env.pop('CHAT_STORE_URL', None)
+    print(f"{args.threads} load processes x 16 chatters, 5 messages per chat, {os.cpu_count()} CPU(s)")
+    for name, command in servers:
+        port = _free_port()
+        server = subprocess.Popen(command(port), cwd=here, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_for_port('127.0.0.1', port)
+            with multiprocessing.Pool(args.threads) as pool:
+                start = time.perf_counter()
+                results = pool.starmap(_chat_churn, [('127.0.0.1', port, args.duration, 16, 5)] * args.threads)
+                elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+        chats = sum(chats for chats, _ in results)
+        _report(name, sum(requests for _, requests in results), elapsed, 'requests')
+        print(f"  {chats / elapsed:,.0f} chats/s")
+
+
+BENCHMARKS = {
+    'broadcast': bench_broadcast,
+    'chatters': bench_chatters,
+    'contact': bench_contact,
+    'fragments': bench_fragments,
+    'compression': bench_compression,
+    'history': bench_history,
+    'limits': bench_limits,
+    'pages': bench_pages,
+    'pairing': bench_pairing,
+    'queues': bench_queues,
+    'recovery': bench_recovery,
+    'redis': bench_redis,
+    'resume': bench_resume,
+    'sessions': bench_sessions,
+    'soak': bench_soak,
+    'transport': bench_transport,
+    'spam': bench_spam,
+    'tracing': bench_tracing,
+    'workers': bench_workers,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS) + ['all'])
+    parser.add_argument('--joins', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--hours', type=int, default=6, help='simulated hours of churn (soak)')
+    parser.add_argument('--arrivals', type=int, default=2, help='new clients per simulated second (soak)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='most worker processes (workers)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per server (workers)')
+    parser.add_argument('--redis-url', help='a Redis server to check instead of fakeredis (redis)')
+    args = parser.parse_args()
+    names = sorted(BENCHMARKS) if args.benchmark == 'all' else [args.benchmark]
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""Local broker that lets several worker processes on one host share a chat.
+
+workers.py runs it in the master process: the broker holds the chat state
+in a MemoryChatStore (or a JournaledChatStore) and the workers reach it
+over a Unix socket through BrokerChatStore, so pairing stays atomic and a
+message finds its partner's stream whichever worker serves it. No outside
+service is needed, unlike the Redis backend:
+
+    python workers.py --workers 4
+
+Each message is a 4-byte length and a JSON array. A worker's call is
+``[name, args...]``, answered with ``["ok", result]`` or ``["error",
+text]``. ``["publish", worker, client_id, update]`` is not answered: the
+broker forwards ``[client_id, update]`` to every other worker that sent
+``["subscribe", worker]`` on a connection of its own.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
+
+from chat_store import ChatMessage, ChatStore
+
+_HEADER = struct.Struct('!I')
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+# Store methods whose arguments and results travel as plain JSON
+PLAIN_CALLS = frozenset({
+    'get_token', 'set_token', 'drop_token', 'token_owner',
+    'is_pending', 'pending_since', 'remove_pending', 'is_active', 'get_partner', 'end_chat',
+    'touch', 'expire_sessions', 'stats', 'update_message', 'clear_messages', 'remove_client',
+})
+
+
+class BrokerError(Exception):
+    """A call the broker could not carry out."""
+
+
+def send_message(sock, message):
+    data = _encoder.encode(message).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def receive_message(file):
+    """Read the next message from a socket's file, or None at the end of the stream."""
+    header = file.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    data = file.read(_HEADER.unpack(header)[0])
+    return json.loads(data)
+
+
+def _fields(record):
+    return [record.seq, record.time, record.sender, record.audience, record.text]
+
+
+def _record(fields):
+    seq, time, sender, audience, text = fields
+    return ChatMessage(time, text, sender, audience, seq)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.serve_connection(self.request)
+
+
+class Broker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves ``store`` to the workers connecting to the Unix socket at ``path``.
+
+    Every connection gets a thread of its own; the store's own locks keep
+    the calls from different workers apart.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, store):
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)  # Left behind by a broker that did not shut down
+        super().__init__(path, _BrokerHandler)
+        self.path = path
+        self.store = store
+        self._subscribers = {}  # {worker: queue of updates to send it}
+        self._subscribers_lock = threading.Lock()
+        self._match = threading.local()  # Wait of the partner matched by this thread's last call
+        store.set_match_observer(self._observe_match)
+
+    def _observe_match(self, waited):
+        self._match.waited = waited
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def serve_connection(self, sock):
+        reader = sock.makefile('rb')
+        while True:
+            request = receive_message(reader)
+            if request is None:
+                return
+            name, *args = request
+            if name == 'publish':
+                self._forward(*args)
+                continue
+            if name == 'subscribe':
+                self._subscribe(args[0], sock)
+                return
+            try:
+                reply = ['ok', self._call(name, args)]
+            except Exception as error:
+                logging.getLogger(__name__).exception("Broker call %s failed", name)
+                reply = ['error', f'{type(error).__name__}: {error}']
+            send_message(sock, reply)
+
+    def _call(self, name, args):
+        if name == 'find_partner':
+            self._match.waited = None
+            partner_id = self.store.find_partner(*args)
+            return [partner_id, self._match.waited]
+        if name == 'append_message':
+            client_id, fields = args
+            record = _record(fields)
+            self.store.append_message(client_id, record)
+            return [record.log, record.seq]
+        if name == 'get_log':
+            log_id, records = self.store.get_log(*args)
+            return [log_id, [_fields(record) for record in records]]
+        if name not in PLAIN_CALLS:
+            raise BrokerError(f"Unknown call {name!r}")
+        return getattr(self.store, name)(*args)
+
+    def _subscribe(self, worker, sock):
+        # This thread sends the worker its updates; the threads serving
+        # calls only queue them, so a worker slow to read them never holds
+        # up the calls of another
+        updates = queue.SimpleQueue()
+        with self._subscribers_lock:
+            self._subscribers[worker] = updates
+        try:
+            while True:
+                send_message(sock, updates.get())
+        except OSError:
+            pass  # The worker is gone
+        finally:
+            with self._subscribers_lock:
+                if self._subscribers.get(worker) is updates:
+                    del self._subscribers[worker]
+
+    def _forward(self, sender, client_id, update):
+        with self._subscribers_lock:
+            subscribers = [updates for worker, updates in self._subscribers.items() if worker != sender]
+        for updates in subscribers:
+            updates.put([client_id, update])
+
+
+class BrokerChatStore(ChatStore):
+    """Backend for worker processes sharing one chat through a Broker.
+
+    Calls go over a small pool of connections to the broker's Unix socket
+    at ``path``, one call at a time per connection. Stream updates for
+    clients served by another worker are forwarded by the broker. The
+    limits are those of the broker's store; ``max_wait`` and
+    ``max_history`` are only kept for the interface.
+    """
+
+    def __init__(self, path, max_wait=300, max_history=200):
+        super().__init__(max_wait, max_history)
+        self.path = path
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self._pool = []  # Idle connections as (socket, reader)
+        self._pool_lock = threading.Lock()
+        self._subscriber = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock, sock.makefile('rb')
+
+    def _call(self, name, *args):
+        with self._pool_lock:
+            connection = self._pool.pop() if self._pool else None
+        if connection is None:
+            connection = self._connect()
+        sock, reader = connection
+        try:
+            send_message(sock, [name, *args])
+            reply = receive_message(reader)
+        except OSError:
+            sock.close()
+            raise
+        if reply is None:
+            sock.close()
+            raise BrokerError(f"The broker at {self.path} closed the connection")
+        with self._pool_lock:
+            self._pool.append(connection)
+        status, result = reply
+        if status != 'ok':
+            raise BrokerError(result)
+        return result
+
+    def _send(self, message):
+        with self._pool_lock:
+            connection = self._pool.pop() if self._pool else None
+        if connection is None:
+            connection = self._connect()
+        try:
+            send_message(connection[0], message)
+        except OSError:
+            connection[0].close()
+            raise
+        with self._pool_lock:
+            self._pool.append(connection)
+
+    # Cross-worker delivery
+    def set_local_delivery(self, deliver):
+        super().set_local_delivery(deliver)
+        if self._subscriber is None:
+            self._subscriber = threading.Thread(target=self._listen, daemon=True)
+            self._subscriber.start()
+
+    def publish(self, client_id, update):
+        if self._deliver is not None and self._deliver(client_id, update):
+            return
+        self.broadcast(client_id, update)
+
+    def broadcast(self, client_id, update):
+        # The broker forwards it to every worker but this one
+        self._send(['publish', self.worker, client_id, update])
+
+    def _listen(self):
+        while True:
+            try:
+                sock, reader = self._connect()
+                send_message(sock, ['subscribe', self.worker])
+                while True:
+                    message = receive_message(reader)
+                    if message is None:
+                        break
+                    self._deliver(*message)
+                sock.close()
+            except OSError:
+                logging.getLogger(__name__).warning("Lost the broker at %s, reconnecting", self.path)
+            time.sleep(1)
+
+    # Calls with records or match times to translate
+    def find_partner(self, client_id, now):
+        partner_id, waited = self._call('find_partner', client_id, now)
+        if waited is not None:
+            self._matched(waited)
+        return partner_id
+
+    def append_message(self, client_id, record):
+        record.log, record.seq = self._call('append_message', client_id, _fields(record))
+
+    def get_log(self, client_id, after=None):
+        log_id, records = self._call('get_log', client_id, after)
+        records = [_record(fields) for fields in records]
+        for record in records:
+            record.log = log_id
+        return log_id, records
+
+    # Everything else as is
+    def get_token(self, client_id):
+        return self._call('get_token', client_id)
+
+    def set_token(self, client_id, token):
+        self._call('set_token', client_id, token)
+
+    def drop_token(self, client_id):
+        self._call('drop_token', client_id)
+
+    def token_owner(self, token):
+        return self._call('token_owner', token)
+
+    def is_pending(self, client_id):
+        return self._call('is_pending', client_id)
+
+    def pending_since(self, client_id):
+        return self._call('pending_since', client_id)
+
+    def remove_pending(self, client_id):
+        self._call('remove_pending', client_id)
+
+    def is_active(self, client_id):
+        return self._call('is_active', client_id)
+
+    def get_partner(self, client_id):
+        return self._call('get_partner', client_id)
+
+    def end_chat(self, client_id):
+        return self._call('end_chat', client_id)
+
+    def touch(self, client_id, now):
+        self._call('touch', client_id, now)
+
+    def expire_sessions(self, before, limit=1000):
+        return self._call('expire_sessions', before, limit)
+
+    def stats(self):
+        return self._call('stats')
+
+    def update_message(self, client_id, seq, text):
+        self._call('update_message', client_id, seq, text)
+
+    def clear_messages(self, client_id):
+        self._call('clear_messages', client_id)
+
+    def remove_client(self, client_id):
+        self._call('remove_client', client_id)
@@ -0,0 +1,820 @@
+"""Chat session state backends.
+
+app.py keeps every piece of shared chat state (tokens, the waiting list,
+active pairs and message history) behind a ChatStore, so the same routes can
+run in a single process or across several workers:
+
+    CHAT_STORE_URL=redis://localhost:6379/0 gunicorn -w 4 app:app
+
+Without CHAT_STORE_URL the in-memory backend is used; with a ``file:``
+URL it is journaled to that directory and survives restarts:
+
+    CHAT_STORE_URL=file:///var/lib/rchat python app.py
+
+Streaming connections
+always stay local to the worker that serves them; ``publish`` hands an
+update to the local stream if there is one and otherwise forwards it to
+the other workers, over pub/sub with the Redis backend or through the
+local broker of workers.py (``broker:`` URLs, see broker.py).
+"""
+import collections
+import gc
+import heapq
+import itertools
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+import urllib.parse
+
+from journal import StateJournal
+from matchmaker import Matchmaker
+
+
+class ChatMessage:
+    """One line of chat history.
+
+    ``sender`` is the client who wrote it, or None for system notices.
+    ``audience`` limits who sees it: None for both sides of the chat, or a
+    single client id (system notices are always for one side only).
+    ``log`` and ``seq`` are set by the store: the id of the conversation
+    log and the message's position in it, which only ever increases.
+    ``fragments`` caches the message as rendered for display (see
+    app.message_fragments); the store resets it when the text changes.
+    """
+
+    __slots__ = ('seq', 'time', 'sender', 'audience', 'text', 'log', 'fragments')
+
+    def __init__(self, time, text, sender=None, audience=None, seq=0):
+        self.seq = seq
+        self.time = time
+        self.sender = sender
+        self.audience = audience
+        self.text = text
+        self.log = None
+        self.fragments = None
+
+    @property
+    def is_system(self):
+        return self.sender is None
+
+    def visible_to(self, viewer):
+        return self.audience is None or self.audience == viewer
+
+    def label_for(self, viewer):
+        """Sender name as shown to ``viewer``."""
+        return 'You' if self.sender == viewer else 'Random'
+
+    def to_json(self):
+        return json.dumps([self.seq, self.time, self.sender, self.audience, self.text])
+
+    @classmethod
+    def from_json(cls, data):
+        seq, time, sender, audience, text = json.loads(data)
+        return cls(time, text, sender, audience, seq)
+
+
+class ChatLog:
+    """Ring buffer of the last ``limit`` messages of one conversation.
+
+    Both sides of a chat share a single log; each viewer gets its own view
+    of it through ChatMessage.audience and label_for(). Its lock is the
+    pair's lock: appends from both sides land in sequence order, which
+    get() relies on.
+    """
+
+    __slots__ = ('id', 'records', '_seq', '_lock')
+
+    def __init__(self, limit, log_id=None, records=()):
+        self.id = log_id or secrets.token_hex(8)
+        self.records = collections.deque(records, maxlen=limit)
+        self._seq = itertools.count(self.records[-1].seq + 1 if self.records else 1)
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        with self._lock:
+            record.seq = next(self._seq)
+            record.log = self.id
+            self.records.append(record)
+
+    def get(self, seq):
+        records = self.records
+        if records:
+            index = seq - records[0].seq
+            if 0 <= index < len(records):
+                return records[index]
+        return None
+
+    def view(self, viewer, after=0):
+        """Records visible to ``viewer``, oldest first; with ``after``, only later ones.
+
+        Sequence numbers are contiguous, so the records after ``after`` are
+        taken from the end without walking the rest.
+        """
+        with self._lock:
+            if after and self.records:
+                missed = max(0, self.records[-1].seq - after)
+                records = list(itertools.islice(reversed(self.records), missed))[::-1]
+            else:
+                records = list(self.records)
+        return [record for record in records if record.visible_to(viewer)]
+
+
+class ExpiryIndex:
+    """Last activity of every client, so idle ones can be found oldest first.
+
+    ``touch`` pushes onto a heap and ``pop_idle`` pops only as far as the
+    cutoff, so expiring sessions costs O(log n) per expired client instead
+    of a scan over all of them. Entries superseded by a later touch are
+    skipped when popped.
+    """
+
+    def __init__(self):
+        self._seen = {}  # {client_id: last activity}
+        self._heap = []  # Heap of (last activity, client_id), including superseded entries
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __contains__(self, client_id):
+        return client_id in self._seen
+
+    def touch(self, client_id, now):
+        with self._lock:
+            if self._seen.get(client_id) == now:
+                return
+            self._seen[client_id] = now
+            heapq.heappush(self._heap, (now, client_id))
+            self._compact()
+
+    def discard(self, client_id):
+        with self._lock:
+            self._seen.pop(client_id, None)
+            self._compact()
+
+    def pop_idle(self, before, limit=None):
+        """Remove and return clients last active before ``before``, oldest first."""
+        idle = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] < before and (limit is None or len(idle) < limit):
+                seen, client_id = heapq.heappop(heap)
+                if self._seen.get(client_id) == seen:
+                    del self._seen[client_id]
+                    idle.append(client_id)
+        return idle
+
+    def _compact(self):
+        # Same bound as Matchmaker: rebuild once stale entries dominate
+        if len(self._heap) > 2 * len(self._seen) + 64:
+            self._heap = [(seen, client_id) for client_id, seen in self._seen.items()]
+            heapq.heapify(self._heap)
+
+
+class ChatStore:
+    """Interface shared by the chat state backends.
+
+    Users waiting more than ``max_wait`` seconds for a partner are dropped,
+    and only the last ``max_history`` messages of a conversation are kept.
+    """
+
+    def __init__(self, max_wait=300, max_history=200):
+        self.max_wait = max_wait
+        self.max_history = max_history
+        self._deliver = None
+        self._observe_match = None
+
+    def set_local_delivery(self, deliver):
+        """Register ``deliver(client_id, update) -> bool`` for local streams."""
+        self._deliver = deliver
+
+    def set_match_observer(self, observe):
+        """Register ``observe(seconds)``, called with each matched partner's wait."""
+        self._observe_match = observe
+
+    def _matched(self, waited):
+        if self._observe_match is not None:
+            self._observe_match(waited)
+
+    def stats(self):
+        """Return {name: count} for the sizes of the shared state.
+
+        Counts a backend can't get cheaply are left out.
+        """
+        raise NotImplementedError
+
+    def publish(self, client_id, update):
+        """Push a stream update (a JSON-serializable event) to the client, wherever it is connected."""
+        if self._deliver is not None:
+            self._deliver(client_id, update)
+
+    def broadcast(self, client_id, update):
+        """Push a stream update to the client's streams in the other workers only.
+
+        A single process has no other workers.
+        """
+
+    # Tokens
+    def get_token(self, client_id):
+        raise NotImplementedError
+
+    def set_token(self, client_id, token):
+        raise NotImplementedError
+
+    def drop_token(self, client_id):
+        raise NotImplementedError
+
+    def is_token_issued(self, token):
+        return self.token_owner(token) is not None
+
+    def token_owner(self, token):
+        """Return the client the token was issued to, or None."""
+        raise NotImplementedError
+
+    # Pairing
+    def find_partner(self, client_id, now):
+        """Pair the client with the longest-waiting user, or start waiting.
+
+        Returns the partner's id, or None if the client was queued instead.
+        Pairing is atomic: concurrent callers never get the same partner.
+        From then on both clients share the partner's message log.
+        """
+        raise NotImplementedError
+
+    def is_pending(self, client_id):
+        raise NotImplementedError
+
+    def pending_since(self, client_id):
+        raise NotImplementedError
+
+    def remove_pending(self, client_id):
+        raise NotImplementedError
+
+    def is_active(self, client_id):
+        raise NotImplementedError
+
+    def get_partner(self, client_id):
+        raise NotImplementedError
+
+    def end_chat(self, client_id):
+        """End the client's side of its chat; True if it had one.
+
+        Of several callers ending the same chat at once, in any worker,
+        only one gets True.
+        """
+        raise NotImplementedError
+
+    def touch(self, client_id, now):
+        """Record activity by the client (a page load, message or match)."""
+        raise NotImplementedError
+
+    def expire_sessions(self, before, limit=1000):
+        """Claim up to ``limit`` clients with no activity since ``before``.
+
+        Each idle client is returned once, even when several workers share
+        the store, so exactly one caller goes on to evict it.
+        """
+        raise NotImplementedError
+
+    # Messages
+    def append_message(self, client_id, record):
+        """Append a ChatMessage to the client's conversation log."""
+        raise NotImplementedError
+
+    def get_log(self, client_id, after=None):
+        """Return (log id, ChatMessages visible to the client, oldest first).
+
+        ``after`` is a (log id, seq) cursor: if it is for the current log,
+        only the messages after ``seq`` are returned. The log id is None if
+        the client has no messages.
+        """
+        raise NotImplementedError
+
+    def update_message(self, client_id, seq, text):
+        """Replace the text of message ``seq`` in the client's log."""
+        raise NotImplementedError
+
+    def clear_messages(self, client_id):
+        raise NotImplementedError
+
+    def remove_client(self, client_id):
+        """Forget everything stored for the client."""
+        raise NotImplementedError
+
+
+class MemoryChatStore(ChatStore):
+    """Single-process backend built on plain dicts."""
+
+    def __init__(self, max_wait=300, max_history=200):
+        super().__init__(max_wait, max_history)
+        self.active_chats = {}  # {client_id: {partner_id}}
+        self.pending_users = Matchmaker(max_wait, on_match=self._on_match)  # Waiting list, oldest first
+        self.chat_messages = {}  # {client_id: ChatLog}, one log shared by both sides of a chat
+        self.client_tokens = {}  # {client_id: submission_token} for security
+        self.token_owners = {}  # {submission_token: client_id}, reverse of client_tokens
+        self.last_seen = ExpiryIndex()  # Last activity per client, for expiry
+        self._pairing_lock = threading.Lock()
+        self._token_lock = threading.Lock()
+
+    def _journal(self, *op):
+        """Record a change for JournaledChatStore; kept in memory only here."""
+
+    def get_token(self, client_id):
+        return self.client_tokens.get(client_id)
+
+    def set_token(self, client_id, token):
+        with self._token_lock:
+            old_token = self.client_tokens.get(client_id)
+            if old_token is not None:
+                self.token_owners.pop(old_token, None)
+            self.client_tokens[client_id] = token
+            self.token_owners[token] = client_id
+            self._journal('token', client_id, token)
+
+    def drop_token(self, client_id):
+        with self._token_lock:
+            token = self.client_tokens.pop(client_id, None)
+            if token is not None:
+                self.token_owners.pop(token, None)
+                self._journal('untoken', client_id)
+
+    def token_owner(self, token):
+        return self.token_owners.get(token)
+
+    def find_partner(self, client_id, now):
+        # Hold the lock until both chat entries exist, so nobody sees the
+        # partner as neither waiting nor chatting in between
+        with self._pairing_lock:
+            partner_id = self.pending_users.join(client_id, now)
+            if partner_id is not None:
+                self.active_chats[client_id] = {'partner_id': partner_id}
+                self.active_chats[partner_id] = {'partner_id': client_id}
+                self._journal('unwait', client_id)
+                self._journal('unwait', partner_id)
+                self._journal('chat', client_id, partner_id)
+                self._journal('chat', partner_id, client_id)
+                self._share_log(client_id, partner_id)
+                self.last_seen.touch(partner_id, now)
+            else:
+                self._journal('wait', client_id, now)
+            self.last_seen.touch(client_id, now)
+            return partner_id
+
+    def _on_match(self, client_id, partner_id, waited):
+        self._matched(waited)
+
+    def _share_log(self, client_id, partner_id):
+        log = self._log(partner_id)
+        own_log = self.chat_messages.get(client_id)
+        if own_log is not None and own_log is not log:
+            # Copies: a former partner may still read the old log, whose
+            # records must keep their numbers
+            for record in list(own_log.records):
+                self._append(log, ChatMessage(record.time, record.text, record.sender, record.audience))
+        self.chat_messages[client_id] = log
+        self._journal('log', client_id, log.id)
+
+    def _log(self, client_id):
+        log = self.chat_messages.get(client_id)
+        if log is None:
+            log = self.chat_messages.setdefault(client_id, ChatLog(self.max_history))
+            self._journal('log', client_id, log.id)
+        return log
+
+    def _append(self, log, record):
+        log.append(record)
+        self._journal('msg', log.id, record.seq, record.time, record.sender, record.audience, record.text)
+
+    def is_pending(self, client_id):
+        return client_id in self.pending_users
+
+    def pending_since(self, client_id):
+        return self.pending_users.waiting_since(client_id)
+
+    def remove_pending(self, client_id):
+        self.pending_users.leave(client_id)
+        self._journal('unwait', client_id)
+
+    def is_active(self, client_id):
+        return client_id in self.active_chats
+
+    def get_partner(self, client_id):
+        return self.active_chats.get(client_id, {}).get('partner_id')
+
+    def end_chat(self, client_id):
+        if self.active_chats.pop(client_id, None) is None:
+            return False
+        self._journal('end', client_id)
+        return True
+
+    def touch(self, client_id, now):
+        self.last_seen.touch(client_id, now)
+
+    def expire_sessions(self, before, limit=1000):
+        return self.last_seen.pop_idle(before, limit)
+
+    def stats(self):
+        return {
+            'active_chats': len(self.active_chats),
+            'pending_users': len(self.pending_users),
+            'client_tokens': len(self.client_tokens),
+            'sessions': len(self.last_seen),
+        }
+
+    def append_message(self, client_id, record):
+        self._append(self._log(client_id), record)
+
+    def get_log(self, client_id, after=None):
+        log = self.chat_messages.get(client_id)
+        if log is None:
+            return None, []
+        return log.id, log.view(client_id, after[1] if after and after[0] == log.id else 0)
+
+    def update_message(self, client_id, seq, text):
+        log = self.chat_messages.get(client_id)
+        record = log.get(seq) if log is not None else None
+        if record is not None:
+            record.text = text
+            record.fragments = None
+
+    def clear_messages(self, client_id):
+        # Start a fresh log; a former partner keeps the old one
+        if self.chat_messages.pop(client_id, None) is not None:
+            self._journal('unlog', client_id)
+
+    def remove_client(self, client_id):
+        self.active_chats.pop(client_id, None)
+        self.pending_users.leave(client_id)
+        self.chat_messages.pop(client_id, None)
+        self.drop_token(client_id)
+        self.last_seen.discard(client_id)
+        self._journal('remove', client_id)
+
+
+class JournaledChatStore(MemoryChatStore):
+    """The in-memory backend, made to survive restarts.
+
+    Every change to tokens, the waiting list, pairs and message logs is
+    journaled in ``directory`` (see journal.py), and on start the state is
+    rebuilt from what is found there, so the links of open tabs (their
+    ``h`` and ``x``) and cursors into their logs stay valid across a
+    deploy or crash. Activity times are not journaled: a restored session
+    counts as active from the restart on. Neither are frames of the
+    "Searching for a random..." animation. Message text is written to
+    disk with the rest, and stays there until a snapshot drops the
+    journals it was in (see the README).
+    """
+
+    def __init__(self, directory, max_wait=300, max_history=200, max_journal_bytes=64 * 1024 * 1024):
+        super().__init__(max_wait, max_history)
+        self.journal = StateJournal(directory, self._snapshot, max_journal_bytes)
+        started = time.perf_counter()
+        # Restoring allocates millions of objects and frees none; collection
+        # passes over them would only slow it down
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._restore(time.time())
+        finally:
+            if collecting:
+                gc.enable()
+        self.recovery_seconds = time.perf_counter() - started
+
+    def _journal(self, *op):
+        self.journal.record(op)
+
+    def _snapshot(self):
+        """Yield the ops that rebuild the current state; see StateJournal."""
+        for client_id, token in list(self.client_tokens.items()):
+            yield 'token', client_id, token
+        for client_id, joined_at in self.pending_users.waiting():
+            yield 'wait', client_id, joined_at
+        for client_id, chat in list(self.active_chats.items()):
+            yield 'chat', client_id, chat['partner_id']
+        logs = {}
+        for client_id, log in list(self.chat_messages.items()):
+            logs[log.id] = log
+            yield 'log', client_id, log.id
+        for log in logs.values():
+            with log._lock:
+                records = list(log.records)
+            for record in records:
+                yield 'msg', log.id, record.seq, record.time, record.sender, record.audience, record.text
+
+    def _restore(self, now):
+        tokens, waiting, chats, log_ids, logs = {}, {}, {}, {}, {}
+        apply = {
+            'token': lambda client_id, token: tokens.__setitem__(client_id, token),
+            'untoken': lambda client_id: tokens.pop(client_id, None),
+            'wait': lambda client_id, joined_at: waiting.__setitem__(client_id, joined_at),
+            'unwait': lambda client_id: waiting.pop(client_id, None),
+            'chat': lambda client_id, partner_id: chats.__setitem__(client_id, partner_id),
+            'end': lambda client_id: chats.pop(client_id, None),
+            'log': lambda client_id, log_id: log_ids.__setitem__(client_id, log_id),
+            'unlog': lambda client_id: log_ids.pop(client_id, None),
+            'msg': lambda log_id, seq, *fields: logs.setdefault(log_id, {}).__setitem__(seq, fields),
+            'remove': lambda client_id: [state.pop(client_id, None) for state in (tokens, waiting, chats, log_ids)],
+        }
+        self.journal.replay(lambda op: apply[op[0]](*op[1:]))
+
+        for client_id, token in tokens.items():
+            self.client_tokens[client_id] = token
+            self.token_owners[token] = client_id
+        self.pending_users.restore(sorted(waiting.items(), key=lambda entry: entry[1]))
+        self.active_chats.update((client_id, {'partner_id': partner_id}) for client_id, partner_id in chats.items())
+        restored = {}
+        for client_id, log_id in log_ids.items():
+            log = restored.get(log_id)
+            if log is None:
+                log = restored[log_id] = self._restore_log(log_id, logs.get(log_id, {}))
+            self.chat_messages[client_id] = log
+        for client_id in tokens.keys() | waiting.keys() | chats.keys():
+            self.last_seen.touch(client_id, now)
+
+    def _restore_log(self, log_id, messages):
+        # Sequence numbers must stay contiguous (see ChatLog.get), so only
+        # the run ending at the newest message is kept
+        seq = max(messages, default=0)
+        records = []
+        while seq in messages and len(records) < self.max_history:
+            message_time, sender, audience, text = messages[seq]
+            records.append(ChatMessage(message_time, text, sender, audience, seq))
+            seq -= 1
+        records.reverse()
+        for record in records:
+            record.log = log_id
+        return ChatLog(self.max_history, log_id, records)
+
+    def stats(self):
+        return {**super().stats(), 'journal_bytes': self.journal.journal_bytes}
+
+
+class RedisChatStore(ChatStore):
+    """Backend shared by several workers through a Redis-protocol server.
+
+    ``client`` is any redis-py compatible client, e.g. ``redis.Redis`` for a
+    real server or ``fakeredis.FakeRedis`` in tests. Stream updates for
+    clients connected to another worker travel over one pub/sub channel.
+    """
+
+    SESSION_TTL = 3600  # Seconds before untouched session keys expire
+
+    def __init__(self, client, prefix='rchat:', max_wait=300, max_history=200):
+        super().__init__(max_wait, max_history)
+        self.redis = client
+        self.prefix = prefix
+        self.channel = prefix + 'updates'
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self._subscriber = None
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url, decode_responses=True), **kwargs)
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(parts)
+
+    # Cross-worker delivery
+    def set_local_delivery(self, deliver):
+        super().set_local_delivery(deliver)
+        if self._subscriber is None:
+            self._subscriber = threading.Thread(target=self._listen, daemon=True)
+            self._subscriber.start()
+
+    def publish(self, client_id, update):
+        if self._deliver is not None and self._deliver(client_id, update):
+            return
+        self.broadcast(client_id, update)
+
+    def broadcast(self, client_id, update):
+        self.redis.publish(self.channel, json.dumps({'worker': self.worker, 'client_id': client_id,
+                                                     'update': update}))
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message or message.get('type') != 'message':
+                        continue
+                    data = json.loads(message['data'])
+                    if data.get('worker') != self.worker:
+                        self._deliver(data['client_id'], data['update'])
+            except Exception:
+                # Updates published meanwhile are lost, as with any pub/sub
+                logging.getLogger(__name__).exception("Lost the Redis subscription, reconnecting")
+            time.sleep(1)
+
+    # Tokens
+    def get_token(self, client_id):
+        return self.redis.get(self._key('token', client_id))
+
+    def set_token(self, client_id, token):
+        old_token = self.get_token(client_id)
+        pipe = self.redis.pipeline()
+        if old_token:
+            pipe.delete(self._key('owner', old_token))
+        pipe.set(self._key('token', client_id), token, ex=self.SESSION_TTL)
+        pipe.set(self._key('owner', token), client_id, ex=self.SESSION_TTL)
+        pipe.execute()
+
+    def drop_token(self, client_id):
+        token = self.get_token(client_id)
+        pipe = self.redis.pipeline()
+        if token:
+            pipe.delete(self._key('owner', token))
+        pipe.delete(self._key('token', client_id))
+        pipe.execute()
+
+    def token_owner(self, token):
+        return self.redis.get(self._key('owner', token))
+
+    # Pairing
+    def find_partner(self, client_id, now):
+        pending = self._key('pending')
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(pending, '-inf', now - self.max_wait)
+        pipe.zrem(pending, client_id)  # Don't match with self
+        pipe.zpopmin(pending)
+        popped = pipe.execute()[-1]
+
+        if popped:
+            partner_id, joined_at = popped[0]
+            pipe = self.redis.pipeline()
+            for cid, other in ((client_id, partner_id), (partner_id, client_id)):
+                pipe.hset(self._key('chat', cid), mapping={'partner_id': other})
+                pipe.expire(self._key('chat', cid), self.SESSION_TTL)
+                pipe.zadd(self._key('seen'), {cid: now})
+                pipe.sadd(self._key('chats'), cid)
+            pipe.execute()
+            self._share_log(client_id, partner_id)
+            self._matched(now - joined_at)
+            return partner_id
+
+        pipe = self.redis.pipeline()
+        pipe.zadd(pending, {client_id: now})
+        pipe.zadd(self._key('seen'), {client_id: now})
+        pipe.execute()
+        return None
+
+    def is_pending(self, client_id):
+        return self.redis.zscore(self._key('pending'), client_id) is not None
+
+    def pending_since(self, client_id):
+        return self.redis.zscore(self._key('pending'), client_id)
+
+    def remove_pending(self, client_id):
+        self.redis.zrem(self._key('pending'), client_id)
+
+    def is_active(self, client_id):
+        return bool(self.redis.exists(self._key('chat', client_id)))
+
+    def get_partner(self, client_id):
+        return self.redis.hget(self._key('chat', client_id), 'partner_id')
+
+    def end_chat(self, client_id):
+        pipe = self.redis.pipeline()
+        pipe.delete(self._key('chat', client_id))
+        pipe.srem(self._key('chats'), client_id)
+        return bool(pipe.execute()[0])
+
+    def touch(self, client_id, now):
+        # Every key of a session in use is kept alive; expire_sessions
+        # removes them once it goes idle
+        token, log_id = self.redis.mget(self._key('token', client_id), self._key('log', client_id))
+        pipe = self.redis.pipeline()
+        pipe.expire(self._key('chat', client_id), self.SESSION_TTL)
+        pipe.expire(self._key('token', client_id), self.SESSION_TTL)
+        if token:
+            pipe.expire(self._key('owner', token), self.SESSION_TTL)
+        if log_id:
+            pipe.expire(self._key('log', client_id), self.SESSION_TTL)
+            pipe.expire(self._key('messages', log_id), self.SESSION_TTL)
+            pipe.expire(self._key('seq', log_id), self.SESSION_TTL)
+        pipe.zadd(self._key('seen'), {client_id: now})
+        pipe.execute()
+
+    def expire_sessions(self, before, limit=1000):
+        seen = self._key('seen')
+        idle = self.redis.zrangebyscore(seen, '-inf', f'({before}', start=0, num=limit)
+        if not idle:
+            return []
+        # ZREM succeeds for only one worker, which then owns the eviction
+        pipe = self.redis.pipeline()
+        for client_id in idle:
+            pipe.zrem(seen, client_id)
+        return [client_id for client_id, removed in zip(idle, pipe.execute()) if removed]
+
+    def stats(self):
+        # Tokens are plain keys, too costly to count; every session has one
+        pipe = self.redis.pipeline()
+        pipe.scard(self._key('chats'))
+        pipe.zcard(self._key('pending'))
+        pipe.zcard(self._key('seen'))
+        active_chats, pending_users, sessions = pipe.execute()
+        return {'active_chats': active_chats, 'pending_users': pending_users, 'sessions': sessions}
+
+    # Messages: each client points at a log id, and a log is a capped list
+    # of ChatMessage JSON shared by both sides of a chat.
+    def _log_id(self, client_id, create=True):
+        pointer = self._key('log', client_id)
+        log_id = self.redis.get(pointer)
+        if log_id is None and create:
+            log_id = secrets.token_hex(8)
+            if not self.redis.set(pointer, log_id, ex=self.SESSION_TTL, nx=True):
+                log_id = self.redis.get(pointer)
+        return log_id
+
+    def _append(self, log_id, records):
+        messages = self._key('messages', log_id)
+        first_seq = self.redis.incrby(self._key('seq', log_id), len(records)) - len(records) + 1
+        pipe = self.redis.pipeline()
+        for offset, record in enumerate(records):
+            record.seq = first_seq + offset
+            record.log = log_id
+            pipe.rpush(messages, record.to_json())
+        pipe.ltrim(messages, -self.max_history, -1)
+        pipe.expire(messages, self.SESSION_TTL)
+        pipe.expire(self._key('seq', log_id), self.SESSION_TTL)
+        pipe.execute()
+
+    def _records(self, log_id, start=0):
+        records = [ChatMessage.from_json(data) for data in
+                   self.redis.lrange(self._key('messages', log_id), start, -1)]
+        for record in records:
+            record.log = log_id
+        return records
+
+    def _share_log(self, client_id, partner_id):
+        log_id = self._log_id(partner_id)
+        own_log_id = self._log_id(client_id, create=False)
+        if own_log_id is not None and own_log_id != log_id:
+            records = self._records(own_log_id)
+            if records:
+                self._append(log_id, records)
+        self.redis.set(self._key('log', client_id), log_id, ex=self.SESSION_TTL)
+
+    def append_message(self, client_id, record):
+        self._append(self._log_id(client_id), [record])
+
+    def get_log(self, client_id, after=None):
+        log_id = self._log_id(client_id, create=False)
+        if log_id is None:
+            return None, []
+        start = 0
+        if after and after[0] == log_id:
+            # Sequence numbers are contiguous, so the index follows from the first one
+            first = self.redis.lindex(self._key('messages', log_id), 0)
+            if first is None:
+                return log_id, []
+            start = max(0, after[1] + 1 - ChatMessage.from_json(first).seq)
+        return log_id, [record for record in self._records(log_id, start) if record.visible_to(client_id)]
+
+    def update_message(self, client_id, seq, text):
+        log_id = self._log_id(client_id, create=False)
+        if log_id is None:
+            return
+        # Sequence numbers are contiguous, so the index follows from the first one
+        messages = self._key('messages', log_id)
+        first = self.redis.lindex(messages, 0)
+        if first is None:
+            return
+        index = seq - ChatMessage.from_json(first).seq
+        data = self.redis.lindex(messages, index) if index >= 0 else None
+        if data is not None:
+            record = ChatMessage.from_json(data)
+            if record.seq == seq:
+                record.text = text
+                self.redis.lset(messages, index, record.to_json())
+
+    def clear_messages(self, client_id):
+        # Start a fresh log; a former partner keeps the old one
+        self.redis.delete(self._key('log', client_id))
+
+    def remove_client(self, client_id):
+        self.drop_token(client_id)
+        self.end_chat(client_id)
+        self.remove_pending(client_id)
+        self.clear_messages(client_id)
+        self.redis.zrem(self._key('seen'), client_id)
+
+
+def create_store(url=None, **kwargs):
+    """Create the backend for ``url`` (in-memory if empty)."""
+    if not url:
+        return MemoryChatStore(**kwargs)
+    if url.startswith('file:'):
+        return JournaledChatStore(urllib.parse.urlparse(url).path, **kwargs)
+    if url.startswith('broker:'):
+        from broker import BrokerChatStore
+        return BrokerChatStore(urllib.parse.urlparse(url).path, **kwargs)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisChatStore.from_url(url, **kwargs)
+    raise ValueError(f"Unsupported chat store URL: {url}")
@@ -0,0 +1,63 @@
+"""gzip/deflate for the long-lived chat streams.
+
+A chat stream stays open for as long as the tab does and repeats the same
+few kilobytes of script and markup, so it compresses well, but every chunk
+has to reach the browser at once: each one is flushed on its own. The zlib
+state lives as long as the stream, so its window is kept small to bound
+the memory of many concurrent streams.
+"""
+import zlib
+
+# Preferred first; "deflate" is the zlib format, as HTTP defines it
+ENCODINGS = ('gzip', 'deflate')
+
+
+def negotiate(accept_encoding):
+    """Pick an encoding from an Accept-Encoding header, or None."""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+class StreamCompressor:
+    """Compresses one stream chunk by chunk, flushing after each.
+
+    zlib keeps about ``2 ** (window_bits + 2) + 2 ** (mem_level + 9)``
+    bytes per stream, plus its own bookkeeping: 14 KiB in all with the
+    defaults, against 262 KiB for zlib's own defaults. Chat chunks are a
+    few hundred bytes, so a 1 KiB window still finds the repeats between
+    consecutive ones (see ``python bench.py compression``).
+    """
+
+    def __init__(self, encoding, level=6, window_bits=10, mem_level=3):
+        self.encoding = encoding
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        wbits = window_bits + 16 if encoding == 'gzip' else window_bits
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED, wbits, mem_level)
+
+    def compress(self, chunk, reset=False):
+        """Compress ``chunk`` (str or bytes) into bytes the client can decode right away.
+
+        With ``reset`` later chunks can't refer back to this one, e.g. so
+        that text a partner sends can't be compressed against the session
+        token in the page (the BREACH attack).
+        """
+        data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+        compressed = self._zlib.compress(data) + self._zlib.flush(zlib.Z_FULL_FLUSH if reset else zlib.Z_SYNC_FLUSH)
+        self.raw_bytes += len(data)
+        self.compressed_bytes += len(compressed)
+        return compressed
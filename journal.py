@@ -0,0 +1,168 @@
+"""Snapshot plus append-only journal for state kept in memory.
+
+A restart of the in-memory chat store would otherwise forget every session
+at once, and all open tabs would come back as new users together. With a
+journal the state is rebuilt on start from the last snapshot and the
+changes journaled since, so their links keep working.
+"""
+import itertools
+import json
+import logging
+import os
+import threading
+
+from append_log import AppendLog
+
+SNAPSHOT = 'snapshot.jsonl'
+JOURNAL_PREFIX = 'journal.'
+READ_BATCH = 10000  # Lines decoded together on replay
+
+# One encoder for every op: json.dumps would build a new one each time
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_decoder = json.JSONDecoder()
+
+
+def _dumps(op):
+    return _encoder.encode(op) + '\n'
+
+
+class StateJournal:
+    """A snapshot of some state plus a journal of the changes since.
+
+    ``record(op)`` appends a change, a JSON-serializable list, to the
+    current journal file; AppendLog writes and fsyncs them in batches, so
+    a crash loses at most ``flush_interval`` seconds of changes. Once the
+    journals hold ``max_bytes`` a new one is started, ``snapshot()`` (an
+    iterable of ops that rebuild the whole state) is written beside it and
+    the journals it covers are deleted, so the files stay around one
+    snapshot plus ``max_bytes``, and twice that while a snapshot is
+    being written.
+
+    The snapshot is taken while changes go on, so it may already contain
+    some of the changes journaled after it. Every op must therefore set
+    or delete one key, so that replaying it over a newer state does no
+    harm.
+    """
+
+    def __init__(self, directory, snapshot, max_bytes=64 * 1024 * 1024, flush_interval=0.2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.compactions = 0  # Snapshots written so far
+        self._snapshot = snapshot
+        self._journal = None
+        self._number = 0  # Number of the journal being written
+        self.journal_bytes = 0  # Journaled since the last snapshot
+        self._compacting = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _journal_numbers(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(JOURNAL_PREFIX) and name[len(JOURNAL_PREFIX):].isdigit():
+                numbers.append(int(name[len(JOURNAL_PREFIX):]))
+        return sorted(numbers)
+
+    def _read_ops(self, path):
+        with open(path, encoding='utf-8') as file:
+            while True:
+                lines = list(itertools.islice(file, READ_BATCH))
+                if not lines:
+                    return
+                try:
+                    # Decoded as one array, much faster than line by line
+                    yield from _decoder.decode('[' + ','.join(lines) + ']')
+                    continue
+                except ValueError:
+                    pass
+                for line in lines:
+                    try:
+                        yield _decoder.decode(line)
+                    except ValueError:
+                        # A torn write at the end, from a crash
+                        logging.getLogger(__name__).warning("Skipping a damaged entry in %s", path)
+
+    def replay(self, apply):
+        """Call ``apply(op)`` for the snapshot's ops and then each journaled one, oldest first.
+
+        Call it once, before the first record(); journaling then goes on
+        in a new file.
+        """
+        first = 0
+        if os.path.exists(self._path(SNAPSHOT)):
+            ops = self._read_ops(self._path(SNAPSHOT))
+            header = next(ops, None) or {}
+            first = header.get('journal', 0)
+            for op in ops:
+                apply(op)
+        numbers = self._journal_numbers()
+        for number in numbers:
+            path = self._path(f'{JOURNAL_PREFIX}{number}')
+            if number < first:
+                # Left behind by a compaction that was cut short
+                os.remove(path)
+                continue
+            self.journal_bytes += os.path.getsize(path)
+            for op in self._read_ops(path):
+                apply(op)
+        self._number = max(numbers + [first - 1]) + 1
+        self._journal = self._open(self._number)
+
+    def _open(self, number):
+        # Unbounded queue: AppendLog writes past a full one out of order,
+        # and the order of the ops is what replaying them relies on
+        return AppendLog(self._path(f'{JOURNAL_PREFIX}{number}'), max_queue=0,
+                         flush_interval=self.flush_interval, max_bytes=0)
+
+    def record(self, op):
+        line = _dumps(op)
+        with self._lock:
+            self._journal.write(line)
+            self.journal_bytes += len(line)
+            due = self.journal_bytes >= self.max_bytes and not self._compacting
+        if due:
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        """Write a snapshot and delete the journals it covers; False if one is already being written."""
+        with self._lock:
+            if self._compacting:
+                return False
+            self._compacting = True
+            old = self._journal
+            self._number += 1
+            self._journal = self._open(self._number)
+            first, self.journal_bytes = self._number, 0
+        try:
+            old.close()
+            temporary = self._path(SNAPSHOT + '.tmp')
+            with open(temporary, 'w', encoding='utf-8') as file:
+                file.write(_dumps({'journal': first}))
+                for op in self._snapshot():
+                    file.write(_dumps(op))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self._path(SNAPSHOT))
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            for number in self._journal_numbers():
+                if number < first:
+                    os.remove(self._path(f'{JOURNAL_PREFIX}{number}'))
+            self.compactions += 1
+            return True
+        finally:
+            self._compacting = False
+
+    def flush(self):
+        """Wait until every change recorded so far is on disk."""
+        self._journal.flush()
+
+    def close(self):
+        self._journal.close()
@@ -0,0 +1,90 @@
+"""Rate limiting and load shedding for the chat routes.
+
+An address over its limit (or a server that is full) is turned away
+before any session work, for one dict lookup instead of a store
+round-trip and a new stream. Per-client buckets are only keyed on a
+session whose token checked out, so made-up ids can't each get a fresh
+burst; requests that would start a session share one bucket instead.
+"""
+import collections
+import threading
+import time
+
+
+class RateLimiter:
+    """Token buckets keyed by IP or client id, in a self-expiring table.
+
+    Every key may make ``burst`` requests at once and then ``rate`` per
+    second. The table is kept in last-use order. A bucket idle long enough
+    to have refilled completely is the same as no bucket, so such entries
+    are dropped from the old end as new requests come in. At most
+    ``max_keys`` buckets are kept; past that the oldest is forgotten,
+    which only ever lets its key through early.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.rejected = 0  # Requests turned away so far
+        self._refill_time = burst / rate
+        self._buckets = collections.OrderedDict()  # {key: (tokens, updated at)}, oldest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def hit(self, key, now=None):
+        """Take a token for ``key``.
+
+        Returns 0 if the request may go ahead, otherwise the number of
+        seconds until the key has a token again.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = self._buckets
+            while buckets:
+                oldest, (_, updated) = next(iter(buckets.items()))
+                if now - updated < self._refill_time and len(buckets) < self.max_keys:
+                    break
+                del buckets[oldest]
+
+            bucket = buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                buckets.move_to_end(key)
+            if tokens >= 1:
+                buckets[key] = (tokens - 1, now)
+                return 0
+            buckets[key] = (tokens, now)
+            self.rejected += 1
+            return (1 - tokens) / self.rate
+
+
+class AdmissionGate:
+    """Ceiling on concurrent streams; past it new streams are turned away.
+
+    Rejecting a stream up front keeps an overloaded server serving the
+    chats it already has, instead of running out of threads or memory.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.rejected = 0  # Streams turned away so far
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Claim a slot; returns False if the server is full."""
+        with self._lock:
+            if self.active >= self.limit:
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.active -= 1
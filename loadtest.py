@@ -0,0 +1,339 @@
+"""Load generator for the random chat.
+
+Opens N concurrent /rchat streams against a running server (or one it
+starts itself), lets them pair up, sends messages through /rchat/send at a
+fixed total rate and times each one until it shows up on the partner's
+stream:
+
+    python loadtest.py --serve asgi --streams 500 --rate 200 --duration 30 --output results.json
+    python loadtest.py --url http://127.0.0.1:5000 --pid 1234 --streams 200
+
+Latency and pairing percentiles, server memory per connection and errors
+are printed as JSON, and also written to ``--output`` so runs from
+different releases can be compared.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The input iframe of the chat page carries the session's credentials
+CREDENTIALS = re.compile(r'input\?h=([^&"]+)&t=([^&"]*)&x=([^&"]+)"')
+FOUND = 'A random was found'
+# Messages are numbered markers, so the receiver can look up when each was sent
+PARTNER_MESSAGE = re.compile(r'<b>Random:</b> (lt\d+x\d+)')
+
+SERVERS = {
+    'wsgi': lambda port: [sys.executable, '-c',
+                          f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+    'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'asgi:application',
+                          '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+}
+
+
+class Client:
+    """One simulated chatter: a stream plus a keep-alive connection for sends."""
+
+    def __init__(self, index):
+        self.index = index
+        self.client_id = None
+        self.token = None
+        self.opened_at = None
+        self.paired_at = None
+        self.ready = asyncio.Event()
+        self.sender = None  # (reader, writer) reused for /rchat/send
+        self.send_lock = asyncio.Lock()
+
+
+class LoadTest:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.errors = collections.Counter()
+        self.in_flight = {}  # {marker: sent at}
+        self.latencies = []
+        self.sent = 0
+
+    # HTTP/1.1, just enough of it for the chat routes
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return status, headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    async def _body_chunks(self, reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    return
+                data = await reader.readexactly(size)
+                await reader.readexactly(2)
+                yield data
+        else:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                yield data
+
+    async def stream(self, client):
+        """Hold the client's /rchat stream open and time what arrives on it."""
+        client.opened_at = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            self.errors['stream_connect'] += 1
+            client.ready.set()
+            return
+        try:
+            writer.write(f'GET /rchat HTTP/1.1\r\nHost: {self.host}\r\n\r\n'.encode())
+            status, headers = await self._read_head(reader)
+            if status != 200:
+                self.errors[f'stream_status_{status}'] += 1
+                return
+            page = ''
+            async for data in self._body_chunks(reader, headers):
+                now = time.perf_counter()
+                text = data.decode('utf-8', 'replace')
+                if client.client_id is None:
+                    page += text
+                    match = CREDENTIALS.search(page)
+                    if match:
+                        client.client_id, _, client.token = match.groups()
+                        client.ready.set()
+                    text = page
+                if client.paired_at is None and FOUND in text:
+                    client.paired_at = now
+                for marker in PARTNER_MESSAGE.findall(text):
+                    sent_at = self.in_flight.pop(marker, None)
+                    if sent_at is not None:
+                        self.latencies.append(now - sent_at)
+            self.errors['stream_closed'] += 1
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            self.errors['stream_broken'] += 1
+        finally:
+            client.ready.set()
+            writer.close()
+
+    async def send(self, client, marker):
+        body = json.dumps({'h': client.client_id, 'x': client.token, 'm': marker}).encode()
+        request = (f'POST /rchat/send HTTP/1.1\r\nHost: {self.host}\r\n'
+                   f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode() + body
+        async with client.send_lock:
+            try:
+                if client.sender is None:
+                    client.sender = await asyncio.open_connection(self.host, self.port)
+                reader, writer = client.sender
+                self.in_flight[marker] = time.perf_counter()
+                self.sent += 1
+                writer.write(request)
+                status, headers = await self._read_head(reader)
+                await reader.readexactly(int(headers.get('content-length', 0)))
+                if status >= 300:
+                    self.errors[f'send_status_{status}'] += 1
+                    self.in_flight.pop(marker, None)
+                if headers.get('connection', '').lower() == 'close':
+                    writer.close()
+                    client.sender = None
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+                self.errors['send_broken'] += 1
+                self.in_flight.pop(marker, None)
+                client.sender = None
+
+    async def run(self, args, server_pid):
+        clients = [Client(i) for i in range(args.streams)]
+        rss_idle = _rss(server_pid)
+
+        # Open the streams a batch at a time, so the server's accept queue keeps up
+        streams = []
+        for start in range(0, len(clients), args.connect_batch):
+            batch = clients[start:start + args.connect_batch]
+            streams.extend(asyncio.ensure_future(self.stream(client)) for client in batch)
+            await asyncio.gather(*(client.ready.wait() for client in batch))
+        ready = [client for client in clients if client.client_id is not None]
+
+        deadline = time.perf_counter() + args.pair_timeout
+        while time.perf_counter() < deadline and sum(c.paired_at is None for c in ready) > 1:
+            await asyncio.sleep(0.05)
+        paired = [client for client in ready if client.paired_at is not None]
+        rss_loaded = _rss(server_pid)
+
+        # Send at a fixed total rate, round-robin over the paired clients
+        sends = set()
+        if paired and args.rate > 0:
+            interval = 1.0 / args.rate
+            started = time.perf_counter()
+            next_at, count = started, 0
+            while next_at < started + args.duration:
+                while next_at <= time.perf_counter():
+                    client = paired[count % len(paired)]
+                    task = asyncio.ensure_future(self.send(client, f'lt{client.index}x{count}'))
+                    sends.add(task)
+                    task.add_done_callback(sends.discard)
+                    count += 1
+                    next_at += interval
+                await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        if sends:
+            await asyncio.gather(*sends)
+        await asyncio.sleep(args.grace)
+
+        for task in streams:
+            task.cancel()
+        await asyncio.gather(*streams, return_exceptions=True)
+        for client in clients:
+            if client.sender is not None:
+                client.sender[1].close()
+
+        lost = len(self.in_flight)
+        if lost:
+            self.errors['lost'] += lost
+        memory = None
+        if rss_idle is not None and rss_loaded is not None and ready:
+            memory = (rss_loaded - rss_idle) / len(ready)
+        return {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'revision': _revision(),
+            'target': f'http://{self.host}:{self.port}',
+            'server': args.serve,
+            'streams': args.streams,
+            'rate': args.rate,
+            'duration': args.duration,
+            'opened': len(ready),
+            'paired': len(paired),
+            'pairing_ms': _percentiles([c.paired_at - c.opened_at for c in paired]),
+            'messages': {'sent': self.sent, 'received': len(self.latencies), 'lost': lost},
+            'latency_ms': _percentiles(self.latencies),
+            'server_rss_bytes': {'idle': rss_idle, 'loaded': rss_loaded},
+            'memory_per_connection_bytes': round(memory) if memory is not None else None,
+            'errors': dict(self.errors),
+        }
+
+
+def _percentiles(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+    return {'p50': rank(0.50), 'p99': rank(0.99), 'max': round(ordered[-1] * 1000, 3)}
+
+
+def _rss(pid):
+    """Resident memory of a process in bytes (Linux only), or None."""
+    if pid is None:
+        return None
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(host, port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server did not start listening on {host}:{port}')
+
+
+def _raise_file_limit():
+    # Every simulated chatter needs two sockets
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', default='http://127.0.0.1:5000', help='server to test')
+    target.add_argument('--serve', choices=sorted(SERVERS), help='start app.py under this server instead')
+    parser.add_argument('--pid', type=int, help='server process, for memory per connection with --url')
+    parser.add_argument('--streams', type=int, default=100, help='concurrent /rchat streams')
+    parser.add_argument('--rate', type=float, default=50, help='messages per second, all clients together')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--pair-timeout', type=float, default=10, help='seconds to wait for pairing')
+    parser.add_argument('--grace', type=float, default=2, help='seconds to wait for the last deliveries')
+    parser.add_argument('--connect-batch', type=int, default=50, help='streams opened at a time')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    args = parser.parse_args()
+
+    _raise_file_limit()
+    server = None
+    if args.serve:
+        host, port = '127.0.0.1', _free_port()
+        # Every simulated chatter comes from 127.0.0.1 and most are new
+        # sessions, so per-IP and new-session limits would only measure themselves
+        env = {'RATE_LIMIT_BY_IP': '0', 'NEW_SESSION_RATE': '100000', **os.environ}
+        server = subprocess.Popen(SERVERS[args.serve](port), cwd=HERE, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pid = server.pid
+    else:
+        url = urlsplit(args.url)
+        host, port, pid = url.hostname, url.port or 80, args.pid
+    try:
+        _wait_for_port(host, port)
+        results = asyncio.run(LoadTest(host, port).run(args, pid))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = json.dumps(results, indent=2)
+    refused = results['errors'].get('stream_status_429', 0)
+    if refused:
+        # The server's rate limits, not its capacity, decided how many streams opened
+        print(report, file=sys.stderr)
+        sys.exit(f"{refused} of {args.streams} streams were refused with a 429; start the server with "
+                 "RATE_LIMIT_BY_IP=0 and a high NEW_SESSION_RATE (see the README)")
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Random chat matchmaking queue."""
+import collections
+import heapq
+import threading
+
+
+class Matchmaker:
+    """FIFO waiting list that pairs each newcomer with the longest-waiting user.
+
+    Joining, leaving and pairing are O(1) (amortized O(log n) for expiry).
+    Waiting users are dropped after ``max_wait`` seconds. Their deadlines
+    sit in a heap that is only popped as far as the current time on each
+    join, instead of scanning the whole list. Pairing happens under one
+    lock, so two concurrent joins can never take the same partner.
+
+    ``on_match(client_id, partner_id, waited)`` and ``on_expire(client_id)``
+    hooks run after the lock is released, e.g. to wake both waiting streams;
+    ``waited`` is how many seconds the partner spent on the list.
+    """
+
+    def __init__(self, max_wait=300, on_match=None, on_expire=None):
+        self.max_wait = max_wait
+        self.on_match = on_match
+        self.on_expire = on_expire
+        self._waiting = collections.OrderedDict()  # {client_id: joined_at}, oldest first
+        self._deadlines = []  # Heap of (expires_at, joined_at, client_id)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def __contains__(self, client_id):
+        return client_id in self._waiting
+
+    def waiting_since(self, client_id):
+        """Return when the client started waiting, or None."""
+        return self._waiting.get(client_id)
+
+    def join(self, client_id, now):
+        """Pair the client with the longest-waiting user, or queue it.
+
+        Returns the partner's id, or None if the client is now waiting.
+        """
+        with self._lock:
+            expired = self._expire(now)
+            self._waiting.pop(client_id, None)  # Don't match with self
+            if self._waiting:
+                partner_id, joined_at = self._waiting.popitem(last=False)
+            else:
+                partner_id = joined_at = None
+                self._waiting[client_id] = now
+                heapq.heappush(self._deadlines, (now + self.max_wait, now, client_id))
+            self._compact()
+
+        self._notify_expired(expired)
+        if partner_id is not None and self.on_match is not None:
+            self.on_match(client_id, partner_id, now - joined_at)
+        return partner_id
+
+    def leave(self, client_id):
+        """Take the client off the waiting list; returns True if it was waiting."""
+        with self._lock:
+            left = self._waiting.pop(client_id, None) is not None
+            self._compact()
+        return left
+
+    def waiting(self):
+        """Return [(client_id, joined_at)] of the waiting list, oldest first."""
+        with self._lock:
+            return list(self._waiting.items())
+
+    def restore(self, entries):
+        """Put (client_id, joined_at) entries back on the list, oldest first, e.g. after a restart."""
+        with self._lock:
+            for client_id, joined_at in entries:
+                self._waiting[client_id] = joined_at
+                heapq.heappush(self._deadlines, (joined_at + self.max_wait, joined_at, client_id))
+
+    def expire(self, now):
+        """Drop users who waited too long; returns their ids."""
+        with self._lock:
+            expired = self._expire(now)
+        self._notify_expired(expired)
+        return expired
+
+    def _expire(self, now):
+        expired = []
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, joined_at, client_id = heapq.heappop(deadlines)
+            # Skip entries left behind by users who paired, left or rejoined
+            if self._waiting.get(client_id) == joined_at:
+                del self._waiting[client_id]
+                expired.append(client_id)
+        return expired
+
+    def _compact(self):
+        # Stale heap entries are normally popped lazily; rebuild the heap if
+        # they ever outnumber the live ones so memory stays proportional.
+        if len(self._deadlines) > 2 * len(self._waiting) + 64:
+            self._deadlines = [(joined_at + self.max_wait, joined_at, client_id)
+                               for client_id, joined_at in self._waiting.items()]
+            heapq.heapify(self._deadlines)
+
+    def _notify_expired(self, expired):
+        if self.on_expire is not None:
+            for client_id in expired:
+                self.on_expire(client_id)
@@ -0,0 +1,110 @@
+"""Prometheus text-format metrics without extra dependencies.
+
+Each metric has its own small lock, so recording a value never waits on
+the chat's session or store locks. ``render`` builds the exposition text
+for the /metrics route.
+"""
+import bisect
+import threading
+
+# Seconds; from sub-millisecond deliveries up to the five minutes a match may take
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WAIT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Gauge:
+    """A value that goes up and down, e.g. the number of open streams."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def render(self):
+        return gauge(self.name, self.help, self.value)
+
+
+class Counter:
+    """A running total, e.g. of evicted streams."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return counter(self.name, self.help, self.value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by one label."""
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}  # {label value: [count per bucket..., +Inf count, sum]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for label_value, values in sorted(series.items(), key=lambda item: str(item[0])):
+            base = [(self.label, label_value)] if self.label else []
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(base + [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(base)} {_number(values[-1])}')
+            lines.append(f'{self.name}_count{_labels(base)} {cumulative}')
+        return lines
+
+
+def gauge(name, help, value):
+    """Exposition lines for a gauge computed at scrape time."""
+    return [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {_number(value)}']
+
+
+def counter(name, help, value):
+    """Exposition lines for a running total kept elsewhere."""
+    return [f'# HELP {name} {help}', f'# TYPE {name} counter', f'{name} {_number(value)}']
+
+
+def render(*groups):
+    """Join lists of exposition lines into a /metrics response body."""
+    return '\n'.join(line for group in groups for line in group) + '\n'
@@ -0,0 +1,109 @@
+"""The public "All" room: one shared log that every subscriber reads.
+
+In a 1:1 chat every update is copied onto the partner's queue. The room
+has thousands of readers, so a message is instead rendered to bytes once
+and appended to a ring holding the last ``size`` messages; each stream
+keeps nothing but its cursor, the sequence number of the last message it
+sent, and reads the entries after it when woken. Broadcasting one message
+costs one render and one append, plus a wakeup per waiting stream, and
+memory does not grow with the number of readers or with how far behind
+they are.
+"""
+import asyncio
+import collections
+import itertools
+import threading
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Room:
+    """Ring log of rendered messages plus the members currently reading it.
+
+    Entries are ``(audience, data)``: ``data`` is the bytes every reader
+    sends as is, ``audience`` None for everyone or the one member who
+    may see it (ghosted messages, notices to the sender). Sequence numbers
+    are implicit: the newest entry is ``seq``, the ones before it count
+    down from there.
+
+    Coroutines waiting on one event loop share a single future, so a post
+    schedules one callback per loop. They wait without a timeout of their
+    own (a timer each is what a broadcast to thousands would spend its
+    time on); call ``wake`` periodically to let them send keepalives.
+    """
+
+    def __init__(self, size=200):
+        self.size = size
+        self.seq = 0  # Messages posted so far, the number of the newest one
+        self.members = {}  # {member id: name}
+        self._entries = collections.deque(maxlen=size)
+        self._cond = threading.Condition(threading.Lock())
+        self._loop_futures = {}  # {loop: future}, resolved by the next post or wake
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member_id):
+        return member_id in self.members
+
+    def join(self, member_id, name):
+        self.members[member_id] = name
+
+    def leave(self, member_id):
+        self.members.pop(member_id, None)
+
+    def post(self, data, audience=None):
+        """Append a rendered message, wake every reader and return its number."""
+        with self._cond:
+            self.seq += 1
+            seq = self.seq
+            self._entries.append((audience, data))
+            self._cond.notify_all()
+            futures, self._loop_futures = self._loop_futures, {}
+        for loop, future in futures.items():
+            loop.call_soon_threadsafe(_wake, future)
+        return seq
+
+    def wake(self):
+        """Wake the coroutines waiting in wait_async without posting anything."""
+        with self._cond:
+            futures, self._loop_futures = self._loop_futures, {}
+        for loop, future in futures.items():
+            loop.call_soon_threadsafe(_wake, future)
+
+    def read(self, cursor, viewer):
+        """Return (new cursor, data of the entries after ``cursor`` that ``viewer`` may see).
+
+        A reader so far behind that the ring has dropped entries it never
+        read skips them.
+        """
+        with self._cond:
+            seq = self.seq
+            missed = min(seq - cursor, len(self._entries))
+            entries = list(itertools.islice(reversed(self._entries), missed)) if missed > 0 else []
+        entries.reverse()
+        return seq, [data for audience, data in entries if audience is None or audience == viewer]
+
+    def wait(self, cursor, timeout=None):
+        """Block until there is an entry after ``cursor``; returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.seq > cursor, timeout)
+
+    async def wait_async(self, cursor):
+        """Wait on the running event loop for the next post or wake.
+
+        Returns True if there is an entry after ``cursor``.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.seq > cursor:
+                return True
+            future = self._loop_futures.get(loop)
+            if future is None:
+                future = self._loop_futures[loop] = loop.create_future()
+        # Shielded: a reader that goes away must not cancel the others' future
+        await asyncio.shield(future)
+        return self.seq > cursor
@@ -0,0 +1,146 @@
+"""Spam defenses for the chat: ghost messages and flood lockdown.
+
+Mirrors what the original site does (see the README): a message that
+repeats the sender's previous one is "ghosted", i.e. only shown to the
+sender, and when many different senders post the same text the chat goes
+into a lockdown during which copies of that text are ghosted as well.
+"""
+import array
+import collections
+import hashlib
+import threading
+import time
+
+
+def normalize(text):
+    """Reduce a message to what makes it "the same" text: letters and digits, case-folded."""
+    folded = ''.join(ch for ch in str(text).casefold() if ch.isalnum())
+    return folded or str(text).strip()
+
+
+class SpamFilter:
+    """Duplicate and flood detection in O(1) time and memory per message.
+
+    Each client's last message is kept as a 64-bit hash (for at most
+    ``max_clients`` clients, least recently active dropped first). Every
+    other text is counted once per sender and window in a count-min
+    sketch of ``depth`` rows of ``width`` counters (over-counting by about
+    e * messages per window / width, so the default stays well under the
+    thresholds at 1000 messages a second). Whether a sender already
+    counted for a text is looked up in a bitmap of ``seen_bits`` bits,
+    two per (text, sender) pair; a false hit (about 0.3% of pairs at
+    60000 messages a window) only leaves a sender uncounted. The sketch
+    covers a sliding ``window``: counts from the previous window fade out
+    linearly over the current one. When any text has ``flood_threshold``
+    senders it is ghosted and the filter locks down for
+    ``lockdown_seconds`` (extended while the flood goes on). During a
+    lockdown any text from ``lockdown_threshold`` senders is ghosted, so
+    the next texts of an attack are caught sooner. Counting senders
+    rather than copies keeps a few chatty clients, or just a busy site,
+    from tripping it. Texts shorter than ``min_flood_length`` ("hi",
+    "m or f?") are common on their own and never count as a flood.
+    """
+
+    def __init__(self, window=60, flood_threshold=20, lockdown_threshold=5, lockdown_seconds=120,
+                 min_flood_length=12, width=32768, depth=4, seen_bits=1 << 21, max_clients=100000):
+        self.window = window
+        self.flood_threshold = flood_threshold
+        self.lockdown_threshold = lockdown_threshold
+        self.lockdown_seconds = lockdown_seconds
+        self.min_flood_length = min_flood_length
+        self.width = width
+        self.depth = depth
+        self.seen_bits = seen_bits
+        self.max_clients = max_clients
+        self.ghosted = 0  # Messages ghosted so far
+        self.lockdowns = 0  # Lockdowns started so far
+        self._last = collections.OrderedDict()  # {client_id: hash of last message}
+        self._current = self._new_sketch()
+        self._previous = self._new_sketch()
+        self._seen = bytearray(seen_bits // 8)  # (text, sender) pairs counted this window
+        self._window_start = None  # Set by the first message
+        self._locked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _new_sketch(self):
+        return array.array('I', bytes(4 * self.width * self.depth))
+
+    def _slots(self, digest):
+        # One counter per row, each picked by its own 4 bytes of the digest
+        return [row * self.width + int.from_bytes(digest[4 * row:4 * row + 4], 'little') % self.width
+                for row in range(self.depth)]
+
+    def _first_from_sender(self, digest, client_id):
+        """Mark the pair in the bitmap; True if it wasn't marked yet this window."""
+        pair = hashlib.blake2b(str(client_id).encode('utf-8'), digest_size=8, key=digest[:16]).digest()
+        first = False
+        for half in (pair[:4], pair[4:]):
+            bit = int.from_bytes(half, 'little') % self.seen_bits
+            mask = 1 << (bit & 7)
+            if not self._seen[bit >> 3] & mask:
+                self._seen[bit >> 3] |= mask
+                first = True
+        return first
+
+    def _advance(self, now):
+        if self._window_start is None:
+            self._window_start = now
+        elapsed = now - self._window_start
+        if elapsed >= 2 * self.window:
+            self._previous = self._new_sketch()
+            self._current = self._new_sketch()
+            self._window_start = now
+        elif elapsed >= self.window:
+            self._previous, self._current = self._current, self._new_sketch()
+            self._window_start += self.window
+        else:
+            return
+        self._seen = bytearray(self.seen_bits // 8)
+
+    def _estimate(self, slots, now):
+        fade = 1 - (now - self._window_start) / self.window
+        return min(self._current[slot] + self._previous[slot] * fade for slot in slots)
+
+    def check(self, client_id, text, now=None):
+        """Count a message; returns True if it should be ghosted."""
+        now = time.time() if now is None else now
+        normalized = normalize(text)
+        digest = hashlib.blake2b(normalized.encode('utf-8'), digest_size=max(8, 4 * self.depth)).digest()
+        key = digest[:8]
+        with self._lock:
+            repeat = self._last.get(client_id) == key
+            self._last[client_id] = key
+            self._last.move_to_end(client_id)
+            if len(self._last) > self.max_clients:
+                self._last.popitem(last=False)
+            if repeat:
+                self.ghosted += 1
+                return True
+            if len(normalized) < self.min_flood_length:
+                return False
+
+            self._advance(now)
+            slots = self._slots(digest)
+            if self._first_from_sender(digest, client_id):
+                for slot in slots:
+                    self._current[slot] += 1
+            count = self._estimate(slots, now)
+            if now < self._locked_until:
+                ghost = count >= self.lockdown_threshold
+            else:
+                ghost = count >= self.flood_threshold
+                if ghost:
+                    self.lockdowns += 1
+            if count >= self.flood_threshold:
+                self._locked_until = now + self.lockdown_seconds
+            if ghost:
+                self.ghosted += 1
+            return ghost
+
+    def under_attack(self, now=None):
+        """True while a lockdown is in effect."""
+        return (time.time() if now is None else now) < self._locked_until
+
+    def forget(self, client_id):
+        with self._lock:
+            self._last.pop(client_id, None)
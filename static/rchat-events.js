@@ -0,0 +1,53 @@
+// Client for /rchat/events, loaded by the chat page of /rchat?e=1.
+// Opening the event stream takes over from the page's HTML stream, which
+// then ends; without EventSource the page keeps using the HTML stream.
+// EventSource reconnects on its own and resumes after the last event it
+// got (its id, sent back as Last-Event-ID).
+(function () {
+    var url = document.currentScript.getAttribute("data-events");
+    var section = document.querySelector("section");
+    var box = document.querySelector("div");
+    if (!window.EventSource || !url) {
+        return;
+    }
+
+    // Append a line made of [tag, text] pairs and plain strings
+    function addLine(parts) {
+        var line = document.createElement("p");
+        parts.forEach(function (part) {
+            if (typeof part === "string") {
+                line.appendChild(document.createTextNode(part));
+            } else {
+                var node = document.createElement(part[0]);
+                node.textContent = part[1];
+                line.appendChild(node);
+            }
+        });
+        section.appendChild(line);
+        box.scrollTo(0, box.scrollHeight);
+    }
+
+    function apply(event) {
+        if (event.type === "message") {
+            addLine([["u", event.time + " - "], [event.from === "You" ? "s" : "b", event.from + ":"], " " + event.text]);
+        } else if (event.type === "search") {
+            var notes = section.querySelectorAll("p i");
+            for (var i = 0; i < notes.length; i++) {
+                if (notes[i].textContent.indexOf("Searching for a random") !== -1) {
+                    notes[i].textContent = event.text;
+                    break;
+                }
+            }
+        } else if (event.type === "reset") {
+            section.textContent = "";
+        } else if (event.type === "left") {
+            addLine([["i", "The random left."]]);
+        } else {
+            addLine([["i", event.text]]);
+        }
+    }
+
+    new EventSource(url).onmessage = function (message) {
+        apply(JSON.parse(message.data));
+    };
+})();
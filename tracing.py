@@ -0,0 +1,106 @@
+"""Opt-in tracing of chat messages from /rchat/send to the streams.
+
+When messages feel slow, the per-route request times of /metrics don't
+say where a message spent its time. A sampled message is stamped as it
+goes: received by /rchat/send, its session lock taken, appended to the
+log, put on a stream's queue, drained by the stream and handed to the
+server. The time between two stamps goes to a histogram labelled with
+the stage it ends, and the last traces are kept for /metrics/traces and
+appended to a file if one is given.
+
+Stamps are wall-clock times, so a trace may start in one worker and end
+in another. Each delivery of a message (to the partner, and the echo to
+the sender) is traced on its own. With tracing off no message carries a
+trace and the stream only checks a flag.
+"""
+import collections
+import json
+import random
+import threading
+import time
+
+from append_log import AppendLog
+from metrics import Histogram
+
+# Stamp names, in order; the histogram label of the time up to each one
+STAGES = {
+    'received': None,
+    'locked': 'lock_wait',  # /rchat/send waiting for the session lock
+    'appended': 'append',  # Spam check and append to the chat log
+    'enqueued': 'route',  # Publishing, and the hop to another worker if any
+    'drained': 'queue',  # Waiting on the stream's queue for the stream to wake up
+    'yielded': 'render',  # Rendering for the stream's transport
+}
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+class MessageTracer:
+    """Samples ``sample_rate`` of the messages and times their stages.
+
+    A trace is a dict ``{'id': ..., 'to': 'partner' or 'sender', 'stamps':
+    [[stage, time], ...]}`` riding on the stream event under ``'trace'``,
+    so it can cross workers with the event; ``collect`` takes it off again
+    before the event is rendered.
+    """
+
+    def __init__(self, sample_rate=0.0, keep=500, path=None):
+        self.sample_rate = sample_rate
+        self.enabled = sample_rate > 0
+        self.stages = Histogram('rchat_message_stage_seconds',
+                                'Time sampled messages spent in each stage, from /rchat/send to the stream.',
+                                label='stage')
+        self._recent = collections.deque(maxlen=keep)  # Finished traces, newest last
+        self._lock = threading.Lock()
+        self._log = AppendLog(path) if path else None
+
+    def start(self):
+        """Return a new trace stamped 'received', or None for a message that is not sampled."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        return {'id': f'{random.getrandbits(32):08x}', 'stamps': [['received', time.time()]]}
+
+    @staticmethod
+    def stamp(trace, stage):
+        if trace is not None:
+            trace['stamps'].append([stage, time.time()])
+
+    @staticmethod
+    def attach(event, trace, to):
+        """Add a copy of ``trace`` to the stream event for the delivery ``to`` one side."""
+        if trace is not None:
+            event['trace'] = {'id': trace['id'], 'to': to, 'stamps': [list(stamp) for stamp in trace['stamps']]}
+        return event
+
+    def enqueued(self, event):
+        if self.enabled and 'trace' in event:
+            self.stamp(event['trace'], 'enqueued')
+
+    def collect(self, events):
+        """Take the traces off drained ``events``, stamped 'drained'."""
+        if not self.enabled:
+            return ()
+        traces = [event.pop('trace') for event in events if 'trace' in event]
+        for trace in traces:
+            self.stamp(trace, 'drained')
+        return traces
+
+    def finish(self, traces):
+        """Stamp ``traces`` 'yielded' and record them."""
+        for trace in traces:
+            self.stamp(trace, 'yielded')
+            stamps = trace['stamps']
+            for (_, start), (stage, end) in zip(stamps, stamps[1:]):
+                if STAGES.get(stage):
+                    self.stages.observe(max(0.0, end - start), STAGES[stage])
+            self.stages.observe(max(0.0, stamps[-1][1] - stamps[0][1]), 'total')
+            with self._lock:
+                self._recent.append(trace)
+            if self._log is not None:
+                self._log.write(_encoder.encode(trace) + '\n')
+
+    def recent(self, limit=None):
+        """The last finished traces, oldest first."""
+        with self._lock:
+            traces = list(self._recent)
+        return traces[-limit:] if limit else traces
@@ -0,0 +1,113 @@
+"""Run the chat on several cores: a master process and N workers on one port.
+
+A Python process runs its code on one core at a time (the GIL), so a
+single ``python app.py`` can't use more than one. Here the master binds
+the port, serves the chat state to the workers through the broker (see
+broker.py) and starts ``--workers`` processes that take connections from
+that port, so chatters served by different workers still pair and talk:
+
+    python workers.py --workers 4 --port 5000
+    CHAT_STORE_URL=file:///var/lib/ableonion python workers.py --server asgi
+
+The master's CHAT_STORE_URL picks the store the broker serves. With
+SO_REUSEPORT (Linux, the BSDs) each worker gets a listening socket of its
+own and the kernel spreads new connections over them; elsewhere they
+share one. A worker that exits is started again.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def listening_sockets(host, port, count, backlog=1024):
+    """One listening socket per worker, or a single shared one without SO_REUSEPORT."""
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    sockets = []
+    for _ in range(count if reuse_port else 1):
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+        sockets.append(sock)
+    return [sockets[index % len(sockets)] for index in range(count)]
+
+
+def serve(fd, host, port, server):
+    """Serve the chat on the inherited listening socket ``fd`` (in a worker)."""
+    if server == 'asgi':
+        import uvicorn
+        uvicorn.Server(uvicorn.Config('asgi:application', fd=fd, log_level='warning')).run()
+    else:
+        from werkzeug.serving import make_server
+        import app
+        make_server(host, port, app.app, threaded=True, fd=fd).serve_forever()
+
+
+def run(workers, host, port, server):
+    """Start the broker and the workers, and keep them running until interrupted."""
+    # The broker serves the store app.py would use on its own
+    import app
+    from broker import Broker
+
+    directory = tempfile.mkdtemp(prefix='ableonion-')
+    broker = Broker(os.path.join(directory, 'broker.sock'), app.store)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    env = {**os.environ, 'CHAT_STORE_URL': f'broker://{broker.path}'}
+
+    def start(sock):
+        fd = sock.fileno()
+        command = [sys.executable, os.path.abspath(__file__), '--serve-fd', str(fd),
+                   '--host', host, '--port', str(port), '--server', server]
+        return subprocess.Popen(command, pass_fds=(fd,), env=env, cwd=HERE)
+
+    sockets = listening_sockets(host, port, workers)
+    processes = [start(sock) for sock in sockets]
+    logging.getLogger(__name__).warning("Serving on %s:%d with %d %s workers", host, port, workers, server)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    try:
+        while not stopping.wait(1):
+            for index, process in enumerate(processes):
+                if process.poll() is not None:
+                    logging.getLogger(__name__).warning(
+                        "Worker %d exited with %s, starting it again", process.pid, process.returncode)
+                    processes[index] = start(sockets[index])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        broker.shutdown()
+        broker.server_close()
+        os.rmdir(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi',
+                        help='threaded Werkzeug server or uvicorn (asgi.py) in each worker')
+    parser.add_argument('--serve-fd', type=int, help=argparse.SUPPRESS)  # Set for the workers
+    args = parser.parse_args()
+    if args.serve_fd is not None:
+        serve(args.serve_fd, args.host, args.port, args.server)
+    else:
+        run(args.workers, args.host, args.port, args.server)
+
+
+if __name__ == '__main__':
+    main()